@@ -0,0 +1,111 @@
+"""
+Memory benchmark of the notification parsing on messages with large attachments.
+
+Builds VolunteerMatch notifications carrying a multi-megabyte attachment
+(after the text, before it, sent as one binary line without any line
+break, and an HTML-only one in a non utf-8 charset) and measures the peak memory allocated and the time taken to extract the
+fields by parsing the whole message with the email package, and by
+streaming it through message_parser.parse_bytes, at once and in 64 KB
+chunks as it would come off a socket.
+
+Usage: python bench_message_memory.py [attachment sizes in MB...]
+"""
+
+import email
+import os
+import sys
+import time
+import tracemalloc
+from email import encoders
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import message_parser
+
+CHUNK_SIZE = 64 * 1024
+BINARY_PLACEHOLDER = 'binary attachment goes here'
+NAME = 'Zoë Müller'
+ADDRESS = 'zoe.muller@example.com'
+
+
+def notification(megabytes: 'int', layout: 'str') -> 'bytes':
+    plain = 'A volunteer answered your listing.\nName: {0}\nEmail: {1}\n'.format(NAME, ADDRESS)
+    rich = '<p>Name: <b>{0}</b></p><p>Email: {1}</p>'.format(NAME, ADDRESS)
+    data = os.urandom(megabytes * 1024 * 1024)
+    if layout == 'binary attachment':
+        # the body is put in after the message is generated, the generator cannot write raw binary
+        attachment = MIMEApplication(b'', Name='resume.pdf', _encoder=encoders.encode_noop)
+        attachment['Content-Transfer-Encoding'] = 'binary'
+        attachment.set_payload(BINARY_PLACEHOLDER)
+    else:
+        attachment = MIMEApplication(data, Name='resume.pdf')
+    if layout == 'html only':
+        text = MIMEText(rich, 'html', 'iso-8859-1')
+    else:
+        text = MIMEMultipart('alternative')
+        text.attach(MIMEText(plain, 'plain', 'iso-8859-1'))
+        text.attach(MIMEText(rich, 'html', 'utf-8'))
+    msg = MIMEMultipart('mixed')
+    for part in ([attachment, text] if layout in ('attachment first', 'binary attachment') else [text, attachment]):
+        msg.attach(part)
+    msg['Subject'] = 'Someone wants to help: Volunteer with us and maintain your OPT status!'
+    if layout == 'binary attachment':
+        return msg.as_bytes().replace(BINARY_PLACEHOLDER.encode(), data.replace(b'\r', b' ').replace(b'\n', b' '))
+    return msg.as_bytes()
+
+
+def whole_message(raw: 'bytes') -> 'dict':
+    """Parse the whole message with the email package and read its text parts, the way it was done before."""
+    msg = email.message_from_bytes(raw)
+    for content_type in message_parser.TEXT_TYPES:
+        part = next((part for part in msg.walk() if part.get_content_type() == content_type), None)
+        if part is None:
+            continue
+        text = message_parser.decode_text(part.get_payload(decode=True) or b'', part.get_content_charset())
+        if content_type == 'text/html':
+            text = message_parser.html_to_text(text)
+        fields = message_parser.extract_fields(text)
+        if 'email' in fields:
+            return fields
+    return {}
+
+
+def streamed(raw: 'bytes') -> 'dict':
+    return message_parser.parse_bytes(raw, 'email')
+
+
+def streamed_chunks(raw: 'bytes') -> 'dict':
+    view = memoryview(raw)
+    return message_parser.parse_bytes((bytes(view[i:i + CHUNK_SIZE]) for i in range(0, len(raw), CHUNK_SIZE)),
+                                      'email')
+
+
+def measure(parse, raw: 'bytes') -> 'tuple[dict, float, float]':
+    """Return the fields, the peak memory allocated in MB and the seconds taken."""
+    tracemalloc.start()
+    started = time.perf_counter()
+    fields = parse(raw)
+    seconds = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return fields, peak / 1024 / 1024, seconds
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [1, 5, 20]
+    cases = [('whole message', whole_message), ('streamed', streamed), ('streamed, 64 KB', streamed_chunks)]
+    print('{0:<18} {1:<16} {2:>9} {3:>10} {4:>9}'.format('layout', 'parser', 'message', 'peak', 'time'))
+    for megabytes in sizes:
+        for layout in ('text first', 'attachment first', 'binary attachment', 'html only'):
+            raw = notification(megabytes, layout)
+            for label, parse in cases:
+                fields, peak, seconds = measure(parse, raw)
+                # every parser must read the name in its declared charset
+                assert (fields.get('name'), fields.get('email')) == (NAME, ADDRESS), fields
+                print('{0:<18} {1:<16} {2:6.1f} MB {3:7.2f} MB {4:6.1f} ms'.format(
+                    layout, label, len(raw) / 1024 / 1024, peak, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Micro-benchmark of the notification field extraction.
+
+Builds a corpus of sample VolunteerMatch and Google Form notification emails
+(multipart, HTML-only and plain) and times message_parser.parse_bytes on
+their raw bytes, as imap_fetch hands them over, against the
+character-by-character slicing loop it replaced.
+
+Usage: python bench_message_parser.py [number of messages]
+"""
+
+import re
+import sys
+import timeit
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import message_parser
+
+FILLER = ('VolunteerMatch connects good people with good causes. '
+          'Please respond to this volunteer within 48 hours. ') * 40
+
+
+def volunteer_match_message(i: 'int', html_only: 'bool' = False):
+    plain = '{0}\nName: Volunteer{1} Person\nEmail: volunteer{1}@example.com\nPhone: 555-0100\n{0}'.format(FILLER, i)
+    rich = ('<html><body><p>{0}</p><table><tr><td>Name:</td><td><b>Volunteer{1} Person</b></td></tr>'
+            '<tr><td>Email:</td><td><a href="mailto:volunteer{1}@example.com">volunteer{1}@example.com</a></td></tr>'
+            '</table><p>{0}</p></body></html>').format(FILLER, i)
+    if html_only:
+        msg = MIMEText(rich, 'html')
+    else:
+        msg = MIMEMultipart('alternative')
+        msg.attach(MIMEText(plain, 'plain'))
+        msg.attach(MIMEText(rich, 'html'))
+    msg['Subject'] = 'Someone wants to help: Volunteer with us and maintain your OPT status!'
+    return msg
+
+
+def google_form_message(i: 'int'):
+    msg = MIMEText('{0}\nView Response: applicant{1}@example.com\n{0}'.format(FILLER, i), 'plain')
+    msg['Subject'] = 'Your form, Zenativity Volunteer Application Form, has new responses.'
+    return msg
+
+
+def legacy_volunteer_match(msg):
+    """The loop used before message_parser, kept here for comparison."""
+    content = ""
+    for part in msg.walk():
+        try:
+            content += part.get_payload(decode=True).decode()
+        except Exception:
+            pass
+    candidate_name = candidate_email = None
+    for i in range(len(content) - 10):
+        if content[i:i + 4] == "Name":
+            candidate_name = re.search(r"(\w+)\s+(\w+)", content[i + 6:i + 30]).group()
+        if content[i:i + 5] == "Email":
+            found = re.search(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', content[i + 6:i + 106])
+            candidate_email = found.group(0) if found else None
+            break
+    return candidate_name, candidate_email
+
+
+def legacy_google_form(msg):
+    """The loop used before message_parser, kept here for comparison."""
+    content = msg.get_payload(decode=True).decode()
+    for i in range(len(content) - 10):
+        if content[i:i + 15] == "View Response: ":
+            return re.search(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', content[i + 6:i + 100]).group(0)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    volunteer = [volunteer_match_message(i) for i in range(count)]
+    html_only = [volunteer_match_message(i, html_only=True) for i in range(count)]
+    forms = [google_form_message(i) for i in range(count)]
+    # the parser reads the bytes of the server, the legacy loop needed the parsed message
+    volunteerRaw, htmlOnlyRaw, formsRaw = ([msg.as_bytes() for msg in corpus] for corpus in (volunteer, html_only, forms))
+
+    # both implementations must agree on the corpus they can both handle
+    for msg, raw in zip(volunteer, volunteerRaw):
+        fields = message_parser.parse_bytes(raw, 'email')
+        assert legacy_volunteer_match(msg) == (fields['name'], fields['email'])
+    for msg, raw in zip(forms, formsRaw):
+        assert legacy_google_form(msg) == message_parser.parse_bytes(raw, 'response')['response']
+    for i, raw in enumerate(htmlOnlyRaw):
+        assert message_parser.parse_bytes(raw, 'email')['email'] == 'volunteer{0}@example.com'.format(i)
+
+    cases = [
+        ('volunteer match, legacy', lambda: [legacy_volunteer_match(msg) for msg in volunteer]),
+        ('volunteer match, parser', lambda: [message_parser.parse_bytes(raw, 'email') for raw in volunteerRaw]),
+        ('html only, parser', lambda: [message_parser.parse_bytes(raw, 'email') for raw in htmlOnlyRaw]),
+        ('google form, legacy', lambda: [legacy_google_form(msg) for msg in forms]),
+        ('google form, parser', lambda: [message_parser.parse_bytes(raw, 'response') for raw in formsRaw]),
+    ]
+    for label, run in cases:
+        best = min(timeit.repeat(run, number=1, repeat=5))
+        print('{0:<26} {1:8.2f} ms  {2:8.1f} us/msg'.format(label, best * 1000, best * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Import time of the daily.py entry point.
+
+Imports daily in fresh interpreters with python -X importtime, prints the
+median total and the modules that cost the most, and checks that none of the
+heavy dependencies, which are only needed once there is mail to answer, got
+imported at startup. Exits with status 1 if one did.
+
+Usage: python bench_startup.py [number of runs]
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+ENTRY_POINT = 'daily'
+# loaded on first use only, see google_clients, credentials_manager and mail_transport
+DEFERRED = ('googleapiclient', 'google_auth_oauthlib', 'google.auth', 'google.oauth2',
+            'httplib2', 'smtplib', 'imaplib', 'email.mime')
+TOP = 10
+
+
+def import_times(module: 'str') -> 'tuple[dict[str, int], dict[str, int], list[str]]':
+    """
+    Import module in a fresh interpreter
+
+    Returns
+    -------
+    tuple[dict[str, int], dict[str, int], list[str]]
+        Self and cumulative import time of every module in microseconds,
+        and the DEFERRED modules that were imported
+    """
+    check = 'import sys, {0}; print(" ".join(m for m in {1!r} if m in sys.modules))'.format(module, DEFERRED)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', check],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    self_times, cumulative_times = {}, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        self_times[name.strip()] = int(self_time)
+        cumulative_times[name.strip()] = int(cumulative)
+    return self_times, cumulative_times, result.stdout.split()
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    totals = []
+    for _ in range(runs):
+        self_times, cumulative_times, loaded = import_times(ENTRY_POINT)
+        totals.append(cumulative_times[ENTRY_POINT])
+
+    print("import {0}: {1:.1f} ms (median of {2} runs)".format(ENTRY_POINT, statistics.median(totals) / 1000, runs))
+    print("slowest modules (self time of the last run):")
+    for name, spent in sorted(self_times.items(), key=lambda item: -item[1])[:TOP]:
+        print("    {0:>8.1f} ms  {1}".format(spent / 1000, name))
+
+    if loaded:
+        print("imported at startup but should be deferred: " + ", ".join(loaded))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
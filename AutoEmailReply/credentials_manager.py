@@ -0,0 +1,116 @@
+"""
+Shared google api credentials for the whole process.
+
+token.json is read once; every caller then gets the same in-memory
+Credentials. The access token is refreshed a few minutes ahead of its
+expiry instead of by whichever request happens to hit it expired, and the
+refresh is serialized: when several worker threads find the token expiring
+at once, one of them refreshes it and the others reuse the new token. Every
+refresh is written back to token.json atomically, so a crash never leaves a
+half written token behind.
+
+The google auth libraries are imported on first use, and the OAuth login
+flow only when there is no usable token.
+
+AutoEmailReply and AutoScanWeeklyReport keep identical copies of this
+module, check_shared_modules.py tells when they drift apart.
+"""
+
+import datetime
+import os
+import threading
+
+TOKEN_PATH = 'token.json'
+CLIENT_SECRETS_PATH = 'credentials.json'
+# refresh the access token when it has less than this left
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+_credentials = {}
+_lock = threading.RLock()
+
+
+def _expires_soon(creds: 'Credentials') -> 'bool':
+    if not creds.token:
+        return True
+    if creds.expiry is None:
+        return False
+    # google-auth keeps the expiry as a naive UTC datetime
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return creds.expiry - REFRESH_MARGIN <= now
+
+
+def _save(creds: 'Credentials', token_path: 'str'):
+    """Write the credentials to token_path, replacing the file atomically."""
+    temporary = token_path + '.tmp'
+    with open(temporary, 'w') as token:
+        token.write(creds.to_json())
+    os.replace(temporary, token_path)
+
+
+def _guard_refresh(creds: 'Credentials', token_path: 'str'):
+    """
+    Serialize the refreshes of creds and save every new token
+
+    The authorized HTTP connections refresh the credentials themselves when a
+    request finds them expired or gets a 401; each thread has its own
+    connection, so without the lock they would all refresh at once.
+    """
+    refresh = creds.refresh
+
+    def locked_refresh(request):
+        token = creds.token
+        with _lock:
+            # another thread refreshed it while this one waited
+            if creds.token != token and not _expires_soon(creds):
+                return
+            refresh(request)
+            _save(creds, token_path)
+            print("Refreshed the google api access token, valid until {0} UTC".format(creds.expiry))
+
+    creds.refresh = locked_refresh
+
+
+def get_credentials(scopes: 'list[str]', token_path: 'str' = TOKEN_PATH,
+                    client_secrets_path: 'str' = CLIENT_SECRETS_PATH) -> 'Credentials':
+    """
+    Return the google api credentials of this process, valid for a few more minutes at least
+
+    Loads token_path on the first call, and logs in through the browser when
+    there is no usable token. Later calls return the same Credentials,
+    refreshed first if they are about to expire.
+
+    Parameters
+    ----------
+    scopes : list[str]
+        Scopes of the token
+
+    token_path : str
+        File storing the access and refresh tokens
+
+    client_secrets_path : str
+        OAuth client of the project, used to log in
+
+    Returns
+    -------
+    Credentials
+        Credentials of google api
+    """
+    key = (token_path, tuple(scopes))
+    with _lock:
+        creds = _credentials.get(key)
+        if creds is None and os.path.exists(token_path):
+            from google.oauth2.credentials import Credentials
+            creds = Credentials.from_authorized_user_file(token_path, scopes)
+            _guard_refresh(creds, token_path)
+        if creds is None or (_expires_soon(creds) and not creds.refresh_token):
+            # no usable token, let the user log in
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(client_secrets_path, scopes)
+            creds = flow.run_local_server(port=0)
+            _save(creds, token_path)
+            _guard_refresh(creds, token_path)
+        elif _expires_soon(creds):
+            from google.auth.transport.requests import Request
+            creds.refresh(Request())
+        _credentials[key] = creds
+        return creds
@@ -1,15 +1,207 @@
-import imaplib
-import smtplib
-import email
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+"""
+Daily auto reply run for every workflow, as one pipeline.
+
+A single IMAP session serves both workflows. The main thread owns it and
+fetches the new notifications; the parse, enrich (Sheets lookup) and send
+stages each run in their own thread connected by bounded queues, so the
+network latency of one stage overlaps with the work of the others.
+"""
+
+import argparse
+import queue
+import threading
+
 import config     # stores the email
-from datetime import datetime, timedelta
-import re
 
+import imap_fetch
+import instrumentation
+import mail_transport
+import reply_store
 import volunteer_match_reply
 import google_form_reply
 
+WORKFLOWS = [volunteer_match_reply, google_form_reply]
+
+IMAP_SERVER = 'imap.gmail.com'
+IMAP_PORT = 993
+
+# maximum number of messages waiting between two stages
+QUEUE_SIZE = 20
+
+_DONE = None
+
+
+def _run_stage(work, inbox: 'queue.Queue', outbox: 'queue.Queue', results: 'queue.Queue'):
+    """
+    Apply work to every item of inbox and pass the result on to outbox
+
+    Items are (workflow, uid, value) tuples. A failing item is dropped from
+    the pipeline and reported on results as (workflow, uid, False), or as
+    (workflow, uid, None) when it hit a network error, see reply_store.is_transient.
+    """
+    while True:
+        item = inbox.get()
+        if item is _DONE:
+            outbox.put(_DONE)
+            return
+        workflow, uid, value = item
+        try:
+            outbox.put((workflow, uid, work(workflow, value)))
+        except Exception as err:
+            print("{0} failed on message {1}: {2}".format(workflow.WORKFLOW, uid, err))
+            results.put((workflow, uid, None if reply_store.is_transient(err) else False))
+
+
+def run_pipeline(mail, jobs: 'list[tuple]', transport, smtp_username: 'str') -> 'list[tuple]':
+    """
+    Fetch, parse, enrich and reply to the new messages of every workflow
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection with the inbox selected, only used from this thread
+
+    jobs : list[tuple]
+        (workflow module, UIDs of its new messages) pairs
+
+    transport : mail_transport.MailTransport
+        Shared SMTP transport
+
+    smtp_username : str
+        The address we reply from
+
+    Returns
+    -------
+    list[tuple]
+        (workflow module, uid, handled) for every fetched message, handled
+        being True, False for a failure or None for a network error
+    """
+    fetched = queue.Queue(QUEUE_SIZE)
+    parsed = queue.Queue(QUEUE_SIZE)
+    enriched = queue.Queue(QUEUE_SIZE)
+    # the last stage reports straight into the unbounded results queue
+    results = queue.Queue()
+
+    def send(workflow, candidate):
+        # sending is serialized in this one thread, so a candidate appearing
+        # twice in the run is caught by the reply store on the second time
+        message = workflow.compose(candidate, smtp_username)
+        if message is not None:
+            print(smtp_username, message["To"])
+            transport.send(message["To"], message)
+            reply_store.record_reply(workflow.WORKFLOW, message["To"], workflow.topic(candidate))
+        return True
+
+    stages = [
+        threading.Thread(target=_run_stage, args=(lambda workflow, msg: workflow.parse(msg), fetched, parsed, results)),
+        threading.Thread(target=_run_stage, args=(lambda workflow, candidate: workflow.enrich(candidate), parsed, enriched, results)),
+        threading.Thread(target=_run_stage, args=(send, enriched, results, results)),
+    ]
+    for stage in stages:
+        stage.start()
+
+    # the producer stays on this thread, imaplib connections are not thread safe
+    try:
+        for workflow, uids in jobs:
+            for uid, msg in imap_fetch.fetch_messages(mail, uids):
+                fetched.put((workflow, uid, msg))
+    finally:
+        fetched.put(_DONE)
+        for stage in stages:
+            stage.join()
+
+    handled = []
+    while not results.empty():
+        item = results.get()
+        if item is not _DONE:
+            handled.append(item)
+    return handled
+
+
+def connect():
+    """
+    Open the IMAP session shared by every workflow
+
+    Returns
+    -------
+    imaplib.IMAP4_SSL
+        Logged in IMAP connection
+    """
+    import imaplib
+
+    with instrumentation.timed('imap connect'):
+        mail = instrumentation.instrument_imap(imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT))
+    mail.login(config.USER, config.PASSWORD)
+    return mail
+
+
+def process_new_mail(mail):
+    """
+    Reply to every notification that arrived since the last checkpoint
+
+    Leaves the inbox selected.
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection
+    """
+    smtp_username = config.USER
+    smtp_password = config.PASSWORD
+
+    # pick up replies sent since the last run, then find the new notifications
+    reply_store.sync_sent_mail(mail)
+    jobs = []
+    states = {}
+    for workflow in WORKFLOWS:
+        uids, states[workflow] = reply_store.search_new_messages(mail, workflow.WORKFLOW, workflow.SEARCH_CRITERIA)
+        jobs.append((workflow, uids))
+
+    # nothing new: no Google client, SMTP session or worker thread is set up
+    if not any(uids for workflow, uids in jobs):
+        print("No new notifications")
+        for workflow, uids in jobs:
+            reply_store.update_checkpoint(workflow.WORKFLOW, states[workflow], uids, [], [])
+        return
+
+    google_form_reply.reset_email_index()
+    transport = mail_transport.get_transport(smtp_username, smtp_password)
+    handled = run_pipeline(mail, jobs, transport, smtp_username)
+
+    # Only mark the notifications we are done with as seen
+    for workflow, uids in jobs:
+        done_uids = [uid for done_workflow, uid, ok in handled if done_workflow is workflow and ok]
+        failed_uids = [uid for done_workflow, uid, ok in handled if done_workflow is workflow and ok is False]
+        imap_fetch.mark_seen(mail, done_uids)
+        reply_store.update_checkpoint(workflow.WORKFLOW, states[workflow], uids, done_uids, failed_uids)
+
+
+def main():
+    # one IMAP session for every workflow
+    mail = connect()
+    process_new_mail(mail)
+
+    mail.close()
+    mail.logout()
+
+
 if __name__ == "__main__":
-    volunteer_match_reply.reply()
-    google_form_reply.reply()
+    parser = argparse.ArgumentParser(description="Auto reply to volunteer match and google form notifications")
+    parser.add_argument('--daemon', action='store_true',
+                        help="keep running and reply as soon as new mail arrives (IMAP IDLE)")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="write the latency and status of every IMAP, SMTP and Google call to PATH "
+                             "(Prometheus textfile if it ends in .prom, JSON otherwise)")
+    parser.add_argument('--profile', metavar='PATH', help="run under cProfile and save the stats to PATH")
+    args = parser.parse_args()
+
+    with instrumentation.profiled(args.profile):
+        if args.daemon:
+            import idle_daemon
+            idle_daemon.run(connect, process_new_mail, args.metrics)
+        else:
+            try:
+                main()
+            finally:
+                if args.metrics:
+                    instrumentation.write(args.metrics, 'daily')
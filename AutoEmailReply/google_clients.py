@@ -0,0 +1,137 @@
+"""
+Shared factory for the google api clients.
+
+Every Sheets/Drive client is built once per process, api and version from
+the discovery document bundled with googleapiclient (no discovery request),
+and shared by every thread: building one generates the docstrings of every
+method, which is most of its memory. Collections like
+spreadsheets().values() are cached the same way, googleapiclient builds a
+new Resource on every such call.
+
+The clients hold no connection of their own. Requests are sent with
+request.execute(http=get_http(creds)) on the authorized keep-alive HTTP
+connection of the calling thread: httplib2 connections are not thread safe,
+so threads never share them, and within a thread every call reuses the same
+TLS connection. Every request of these connections is paced and retried by
+rate_limiter.
+
+googleapiclient and the HTTP libraries are imported on the first client
+built, so importing this module costs nothing on runs that never call Google.
+
+AutoEmailReply and AutoScanWeeklyReport keep identical copies of this
+module, check_shared_modules.py tells when they drift apart.
+"""
+
+import threading
+
+import instrumentation
+import rate_limiter
+
+# seconds before a google api request is abandoned
+HTTP_TIMEOUT = 60
+# base URL of the requests of an api served somewhere else than by Google
+# (a local stand-in, see loadtest). example: {'drive': 'http://127.0.0.1:8080/drive/v3/'}
+API_ENDPOINTS = {}
+
+_local = threading.local()
+_clients = {}
+_resources = {}
+_clients_lock = threading.Lock()
+
+
+class _NoHttp:
+    """HTTP transport of the shared clients, every request must bring the connection of its thread."""
+
+    def request(self, *args, **kwargs):
+        raise RuntimeError("google api requests are sent with execute(http=google_clients.get_http(creds))")
+
+
+def get_http(creds):
+    """
+    Return the authorized keep-alive HTTP connection of the calling thread
+
+    Parameters
+    ----------
+    creds : Credentials
+        Credentials of google api
+
+    Returns
+    -------
+    google_auth_httplib2.AuthorizedHttp
+        HTTP transport that adds (and refreshes) the access token
+    """
+    import google_auth_httplib2
+    import httplib2
+
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    # keyed on the credentials themselves, an id could be reused by new ones
+    # once the old ones are collected; there is one per process anyway
+    if creds not in connections:
+        # every attempt is recorded, retries of the rate limiter included
+        connections[creds] = rate_limiter.limit_http(instrumentation.instrument_http(
+            google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))))
+    return connections[creds]
+
+
+def get_service(api: 'str', version: 'str'):
+    """
+    Return the google api client of the process, building it on first use
+
+    Parameters
+    ----------
+    api : str
+        Name of the api. example: sheets
+
+    version : str
+        Version of the api. example: v4
+
+    Returns
+    -------
+    googleapiclient.discovery.Resource
+        The api client, its requests are executed with http=get_http(creds)
+    """
+    from googleapiclient.discovery import build
+
+    with _clients_lock:
+        key = (api, version)
+        if key not in _clients:
+            _clients[key] = build(api, version, http=_NoHttp(),
+                                  static_discovery=True, cache_discovery=False,
+                                  client_options={'api_endpoint': API_ENDPOINTS[api]} if api in API_ENDPOINTS else None)
+        return _clients[key]
+
+
+def get_resource(api: 'str', version: 'str', *path: 'str'):
+    """
+    Return a collection of the google api client of the process, building it on first use
+
+    Parameters
+    ----------
+    api : str
+        Name of the api. example: sheets
+
+    version : str
+        Version of the api. example: v4
+
+    path : str
+        Collections to walk down from the client. example: 'spreadsheets', 'values'
+
+    Returns
+    -------
+    googleapiclient.discovery.Resource
+        service.spreadsheets().values() for the example, its requests are
+        executed with http=get_http(creds)
+    """
+    key = (api, version) + path
+    resource = _resources.get(key)
+    if resource is None:
+        resource = get_service(api, version)
+        with _clients_lock:
+            if key not in _resources:
+                for name in path:
+                    resource = getattr(resource, name)()
+                _resources[key] = resource
+            resource = _resources[key]
+    return resource
@@ -1,193 +1,311 @@
-import imaplib
-import smtplib
-import email
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import config     # stores the email
-from datetime import datetime, timedelta
-import re
+import threading
 
-import os.path
-# libraries for google API
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+import credentials_manager
+import google_clients
+import imap_fetch
+import instrumentation
+import mail_transport
+import message_parser
+import reply_store
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive.metadata.readonly']
 
 SPREADSHEET_ID = '1zM-9tdsbCMwqEdGILtiHE6WPUMCkpEk5kdKcYBAICA4'
-RANGE_NAME = 'N:N'
+# Name, selected programs and email columns of the form responses
+RESPONSE_RANGES = ['B:B', 'L:L', 'N:N']
+OPT_OPTION = 'OPT (Optional Practical Training) Maintenance'
 
+# Name of this workflow in the reply store and the subject of our replies
+WORKFLOW = 'google_form'
+REPLY_SUBJECT = 'Zenativity Volunteer Opportunity'
 
-def get_values(spreadsheet_id: 'str', range_name: 'str', creds: 'Credentials') -> 'list[list[str]]':
+# Search for emails with the desired subject line
+subject1 = 'Your form, Zenativity Volunteer Application Form, has new responses.'
+SEARCH_CRITERIA = 'SUBJECT "{0}"'.format(subject1)
+
+# responses sheet indexed by applicant email, read once per run, or the error reading it
+_email_index = None
+_email_index_error = None
+_email_index_lock = threading.Lock()
+
+
+def batch_get_values(spreadsheet_id: 'str', ranges: 'list[str]', creds: 'Credentials') -> 'list[list[str]]':
     """
-    Get the value from a google sheets by specific sheets id, range and credentials
+    Get several column ranges from a google sheets in a single batchGet request
 
     Parameters
     ----------
     spreadsheet_id : str
         The id of the spreadsheet.
 
-    range_name : str
-        Sheets name, colume and row name of the cells you want to retrieve. example: A1:C2
+    ranges : list[str]
+        Column ranges you want to retrieve. example: ['B:B', 'N:N']
 
     creds : Credentials
         Credentials of google api
-    
+
     Returns
     -------
     list[list[str]]
-        The value of the cells you retrived
+        One list of cell values per requested range, in the same order as ranges,
+        None if the sheet could not be read
     """
+    from googleapiclient.errors import HttpError
+
     try:
-        service = build('sheets', 'v4', credentials=creds)
-
-        # Call the Sheets API
-        sheet = service.spreadsheets()
-        result = sheet.values().get(spreadsheetId=spreadsheet_id,
-                                    range=range_name).execute()
-        values = result.get('values', [])
-        
-        return values
+        # Call the Sheets API once for all ranges
+        values_resource = google_clients.get_resource('sheets', 'v4', 'spreadsheets', 'values')
+        result = values_resource.batchGet(spreadsheetId=spreadsheet_id,
+                                          ranges=ranges,
+                                          majorDimension='COLUMNS').execute(
+            http=google_clients.get_http(creds))
+        columns = []
+        for valueRange in result.get('valueRanges', []):
+            values = valueRange.get('values', [])
+            columns.append(values[0] if values else [])
+
+        return columns
     except HttpError as err:
         print(err)
 
-def extractEmail_form(content):
-    email = re.search(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', content)
+def get_credentials() -> 'Credentials':
+    """
+    Return the google api credentials of the process, see credentials_manager
 
-    if email:
-        return email.group(0)
-    
-def get_name_check_by_email(email):
-    #get credentials
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-
-
-    emails = get_values(SPREADSHEET_ID, RANGE_NAME, creds)
-    row = 0
-    for i in range(len(emails) - 1, -1, -1):
-        if emails[i][0] == email:
-            row = i + 1
-            break
+    Returns
+    -------
+    Credentials
+        Credentials of google api
+    """
+    return credentials_manager.get_credentials(SCOPES)
+
+def build_email_index(creds: 'Credentials') -> 'dict[str, tuple[str, bool]]':
+    """
+    Read the form responses once and index them by applicant email
+
+    Parameters
+    ----------
+    creds : Credentials
+        Credentials of google api
+
+    Returns
+    -------
+    dict[str, tuple[str, bool]]
+        Applicant email -> (name, whether OPT maintenance was selected),
+        taken from the latest response row of that email
+    """
+    columns = batch_get_values(SPREADSHEET_ID, RESPONSE_RANGES, creds)
+    if columns is None:
+        # a network error for reply_store, the notifications are tried again next run
+        raise ConnectionError("Could not read the form responses sheet")
+    names, options, emails = columns
+
+    index = {}
+    for row, address in enumerate(emails):
+        if address == "":
+            continue
+        # later rows overwrite earlier ones, so the latest response wins
+        name = names[row] if row < len(names) else ""
+        option = options[row] if row < len(options) else ""
+        index[address] = (name, OPT_OPTION in option.split(','))
+
+    return index
+
+def get_name_check_by_email(email, email_index):
     # Throw err if didn't find mail
-    if row == 0:
+    if email not in email_index:
         raise Exception("Didn't find profile")
-    
-    name = get_values(SPREADSHEET_ID, 'B' + str(row), creds)[0][0]
-    check = 'OPT (Optional Practical Training) Maintenance' in get_values(SPREADSHEET_ID, 'L' + str(row), creds)[0][0].split(',')
-    return name, check
-
-def getCandidateEmailnNameCheck(msg):
-    if msg.is_multipart():
-        content = ""
-        for part in msg.get_payload():
+
+    return email_index[email]
+
+def get_email_index() -> 'dict[str, tuple[str, bool]]':
+    """
+    Return the email index of this run, reading the responses sheet on first use
+
+    Safe to call from several threads, the sheet is only read once: if that
+    fails, the same error is raised for every applicant until reset_email_index.
+
+    Returns
+    -------
+    dict[str, tuple[str, bool]]
+        The index built by build_email_index
+    """
+    global _email_index, _email_index_error
+    with _email_index_lock:
+        if _email_index_error is not None:
+            raise _email_index_error
+        if _email_index is None:
             try:
-                nn = part.get_payload(decode=True).decode()
-                content += nn
-            except:
-                pass
-    else:
-        content = msg.get_payload(decode=True).decode()
-    for i in range(len(content)-10):
-        if(content[i:i+15] == "View Response: "):
-            candidate_email = extractEmail_form(content[i+6:i+100])
-            name, check = get_name_check_by_email(candidate_email)
-            return (candidate_email, name, check)
-        
-    raise Exception("Didn't find email after View Response:")
+                _email_index = build_email_index(get_credentials())
+            except Exception as err:
+                _email_index_error = err
+                raise
+        return _email_index
+
+def reset_email_index():
+    """Forget the email index so the next run reads the responses sheet again."""
+    global _email_index, _email_index_error
+    with _email_index_lock:
+        _email_index = _email_index_error = None
+
+def parse(msg) -> 'dict':
+    """
+    Read the applicant email out of a form response notification
+
+    Parameters
+    ----------
+    msg : email.message.Message
+        The notification message
+
+    Returns
+    -------
+    dict
+        'email' of the applicant
+    """
+    fields = message_parser.parse_message(msg, 'response')
+    if not fields:
+        raise Exception("Didn't find email after View Response:")
+
+    return {'email': fields['response']}
+
+def enrich(candidate: 'dict') -> 'dict':
+    """
+    Add the name and OPT check of the applicant from the responses sheet
+
+    Parameters
+    ----------
+    candidate : dict
+        Candidate returned by parse
+
+    Returns
+    -------
+    dict
+        The candidate with 'name' and 'check' added
+    """
+    name, check = get_name_check_by_email(candidate['email'], get_email_index())
+    return dict(candidate, name=name, check=check)
+
+def topic(candidate: 'dict') -> 'str':
+    """Return what the reply to a candidate is about, the form has a single one."""
+    return ''
+
+def compose(candidate: 'dict', smtp_username: 'str'):
+    """
+    Compose the reply to one form applicant
+
+    Parameters
+    ----------
+    candidate : dict
+        Candidate returned by enrich
+
+    smtp_username : str
+        The address we reply from
+
+    Returns
+    -------
+    email.message.Message
+        The reply, or None if the applicant did not ask for OPT maintenance
+        or already got a reply
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    if not candidate['check']:
+        return None
+
+    # anyone we ever wrote to, from any workflow or by hand, is not answered again
+    if reply_store.has_mailed(candidate['email']):
+        print("have sent to " + candidate['email'])
+        return None
+
+    sender_email = candidate['email']
+    to_name = candidate['name']
+
+
+    # Compose the reply message
+    reply_subject = REPLY_SUBJECT
+
+
+    # parallel reply email
+    reply_name = 'Hi {0}, it was nice chatting with you today!'.format(to_name)
+
+    # create http email content
+    message = MIMEMultipart()
+    message["From"] = smtp_username
+    message["To"] = sender_email
+    message["Subject"] = reply_subject
+
+    # parallel reply email
+    reply_body = 'Hi {0}, Thank you for your interest in this volunteer opportunity! We are glad to connect with you and get to know you better! Please make an appointment with us using the following link: {1}'.format(to_name, config.CALENDLY_LINK)
+    html = """
+    <html>
+        <body>
+            <p>{0}</p>
+        </body>
+    </html>
+    """.format(reply_body)
+
+    # Add HTML content to message body
+    body = MIMEText(html, "html")
+    message.attach(body)
+
+    return message
 
 
     
 
 def reply():
-    smtp_server = 'smtp.gmail.com'
-    smtp_port = 587
     smtp_username = config.USER
     smtp_password = config.PASSWORD
 
+    import imaplib
+
     # IMAP settings
-    mail = imaplib.IMAP4_SSL('imap.gmail.com')
+    mail = instrumentation.instrument_imap(imaplib.IMAP4_SSL('imap.gmail.com'))
     mail.login(smtp_username, smtp_password)
-    mail.select('inbox')
-
-    # Search for emails with the desired subject line
-    since_date = (datetime.now() - timedelta(days=2)).strftime('%d-%b-%Y')
-    subject1 = 'Your form, Zenativity Volunteer Application Form, has new responses.'
-    typ, data = mail.search(None, '(UNSEEN SUBJECT "{0}" SINCE {1})'.format(subject1, since_date))
-    print(data)
-
-    sending_list = []
-    for num in data[0].split():
-        typ, msg_data = mail.fetch(num, '(RFC822)')
-
-        msg_str = msg_data[0][1].decode('utf-8')
-        msg = email.message_from_string(msg_str)
-
-        sending_list.append(getCandidateEmailnNameCheck(msg))
-    print(sending_list)
-       
-    # check sent box
-    mail.select('"[Gmail]/Sent Mail"')
-    for to_email, to_name, to_check in sending_list:
-        if not to_check:
-            continue
 
-        typ, data = mail.search(None, '(TO "{0}")'.format(to_email))
-        if len(data[0].split()) > 0:
-            print(data, len(data))
-            print("have sent to " + to_email)
+    # pick up replies sent since the last run, then work on the inbox
+    reply_store.sync_sent_mail(mail)
+    uids, inbox_state = reply_store.search_new_messages(mail, WORKFLOW, SEARCH_CRITERIA)
+
+    # the responses sheet is read once per run, when the first applicant is looked up
+    reset_email_index()
+
+    outgoing = []
+    outgoing_uids = []
+    handled_uids = []
+    failed_uids = []
+    for uid, msg in imap_fetch.fetch_messages(mail, uids):
+        # a bad notification is left for the next run, see reply_store.update_checkpoint
+        try:
+            candidate = enrich(parse(msg))
+            print(candidate)
+
+            message = compose(candidate, smtp_username)
+        except Exception as err:
+            print("{0} failed on message {1}: {2}".format(WORKFLOW, uid, err))
+            if not reply_store.is_transient(err):
+                failed_uids.append(uid)
             continue
-        
-        sender_email = to_email
-
-
-        # Compose the reply message
-        reply_subject = 'Zenativity Volunteer Opportunity'
-
-
-        # parallel reply email
-        reply_name = 'Hi {0}, it was nice chatting with you today!'.format(to_name)
-
-        # create http email content
-        message = MIMEMultipart()
-        message["From"] = smtp_username
-        message["To"] = sender_email
-        message["Subject"] = reply_subject
-
-        # parallel reply email
-        reply_body = 'Hi {0}, Thank you for your interest in this volunteer opportunity! We are glad to connect with you and get to know you better! Please make an appointment with us using the following link: {1}'.format(to_name, config.CALENDLY_LINK)
-        html = """
-        <html>
-            <body>
-                <p>{0}</p>
-            </body>
-        </html>
-        """.format(reply_body)
-
-        # Add HTML content to message body
-        body = MIMEText(html, "html")
-        message.attach(body)
-
-        # Send the reply message
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            server.sendmail(smtp_username, sender_email, message.as_string())
-    
+        if message is None or candidate['email'] in [to for to, queued in outgoing]:
+            handled_uids.append(uid)
+            continue
+
+        outgoing.append((candidate['email'], message))
+        outgoing_uids.append(uid)
+
+    # Send all reply messages over one shared session
+    transport = mail_transport.get_transport(smtp_username, smtp_password)
+    sent = transport.send_batch(outgoing)
+    for uid, (to_email, message), ok in zip(outgoing_uids, outgoing, sent):
+        if ok:
+            reply_store.record_reply(WORKFLOW, to_email)
+            handled_uids.append(uid)
+
+    # Only mark the notifications we are done with as seen
+    imap_fetch.mark_seen(mail, handled_uids)
+    reply_store.update_checkpoint(WORKFLOW, inbox_state, uids, handled_uids, failed_uids)
+
     mail.close()
     mail.logout()
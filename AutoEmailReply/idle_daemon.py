@@ -0,0 +1,157 @@
+"""
+Long running auto reply daemon built on IMAP IDLE.
+
+Keeps one authenticated IMAP connection idling on the inbox. When the server
+announces new messages (EXISTS) the daemon leaves IDLE, runs the same
+pipeline as daily.py (which only looks at UIDs after the checkpoints) and
+goes back to IDLE. IDLE is renewed before the server's 29 minute timeout and
+a dropped connection is re-established with exponential backoff. Any other
+error of a batch (Sheets, SMTP, a bad sheet result) is logged and handled
+the same way, so the daemon keeps running.
+
+The connect and process_new_mail functions are passed in by daily.py, which
+runs as __main__: importing daily here would load it a second time, with its
+own module state.
+
+Usage: python daily.py --daemon
+"""
+
+import imaplib
+import random
+import re
+import select
+import ssl
+import time
+import traceback
+
+import instrumentation
+
+# re-enter IDLE before the server drops it (RFC 3501 allows 30 minutes)
+IDLE_TIMEOUT = 25 * 60
+MIN_BACKOFF = 5
+MAX_BACKOFF = 15 * 60
+
+_EXISTS = re.compile(rb'^\* \d+ EXISTS')
+
+
+def _buffered(mail) -> 'bool':
+    """Check, without blocking, if imaplib already has unread data buffered."""
+    mail.sock.setblocking(False)
+    try:
+        return bool(mail.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.setblocking(True)
+
+
+def _read_line(mail, deadline: 'float') -> 'bytes':
+    """Read one server line, or return None once deadline has passed."""
+    while not _buffered(mail):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        readable, _, _ = select.select([mail.sock], [], [], remaining)
+        if readable:
+            break
+    line = mail.readline()
+    if not line:
+        raise mail.abort('connection closed while idling')
+    return line
+
+
+def idle(mail, timeout: 'float' = IDLE_TIMEOUT) -> 'bool':
+    """
+    Wait in IDLE on the selected mailbox until new mail arrives or timeout expires
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection with the inbox selected
+
+    timeout : float
+        Seconds to stay in IDLE at most
+
+    Returns
+    -------
+    bool
+        True if the server reported new messages
+    """
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    line = mail.readline()
+    if not line.startswith(b'+'):
+        raise mail.error('IDLE not accepted: ' + line.decode(errors='replace'))
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while not new_mail:
+        line = _read_line(mail, deadline)
+        if line is None:
+            break
+        new_mail = bool(_EXISTS.match(line))
+
+    mail.send(b'DONE\r\n')
+    # an EXISTS may still arrive before the server confirms the end of IDLE
+    while True:
+        line = mail.readline()
+        if not line:
+            raise mail.abort('connection closed while leaving IDLE')
+        if line.startswith(tag):
+            break
+        new_mail = new_mail or bool(_EXISTS.match(line))
+    return new_mail
+
+
+def _close(mail):
+    """Log out of a connection that may already be broken, always closing its socket."""
+    try:
+        mail.logout()
+    except Exception:
+        try:
+            mail.shutdown()
+        except Exception:
+            pass
+
+
+def run(connect, process_new_mail, metrics: 'str' = None):
+    """
+    Serve auto replies forever, reconnecting with backoff when the connection drops
+
+    Parameters
+    ----------
+    connect : callable
+        Returns a logged in IMAP connection, see daily.connect
+
+    process_new_mail : callable
+        Replies to the new notifications on a connection, see daily.process_new_mail
+
+    metrics : str
+        File the call metrics are rewritten to after every batch of replies,
+        see instrumentation.write. None to not write any
+    """
+    backoff = MIN_BACKOFF
+    while True:
+        mail = None
+        try:
+            mail = connect()
+            backoff = MIN_BACKOFF
+            # catch up on whatever arrived while we were not connected
+            process_new_mail(mail)
+            while True:
+                if metrics:
+                    instrumentation.write(metrics, 'daemon')
+                if idle(mail):
+                    process_new_mail(mail)
+        except (imaplib.IMAP4.abort, imaplib.IMAP4.error, OSError) as err:
+            reason = "IMAP connection lost ({0})".format(err)
+        except Exception as err:
+            # the state of the session is unknown, start over on a new one
+            traceback.print_exc()
+            reason = "Batch failed ({0!r})".format(err)
+        if mail is not None:
+            _close(mail)
+        delay = backoff + random.uniform(0, backoff / 2)
+        print("{0}, reconnecting in {1:.0f}s".format(reason, delay))
+        time.sleep(delay)
+        backoff = min(backoff * 2, MAX_BACKOFF)
@@ -0,0 +1,215 @@
+"""
+Batched IMAP helpers shared by the reply workflows.
+
+Messages are addressed by UID and fetched in chunks of several messages per
+FETCH command. Only the header fields we use and the first body part are
+downloaded (attachments never are), and BODY.PEEK keeps the \\Seen flag
+untouched so a message is only marked seen once it has been replied to.
+The first body part is fetched up to MAX_BODY_BYTES and handed on as raw
+bytes, message_parser reads its text out of them.
+"""
+
+import email
+import email.parser
+import re
+
+import message_parser
+
+FETCH_CHUNK_SIZE = 50
+# notifications are a few KB, a larger first part is an attachment or a forwarded message
+MAX_BODY_BYTES = 256 * 1024
+HEADER_FIELDS = 'SUBJECT FROM TO DATE MIME-VERSION CONTENT-TYPE CONTENT-TRANSFER-ENCODING'
+FETCH_ITEMS = '(UID BODY.PEEK[HEADER.FIELDS ({0})] BODY.PEEK[1.MIME] BODY.PEEK[1]<0.{1}>)'.format(
+    HEADER_FIELDS, MAX_BODY_BYTES)
+
+_MESSAGE_START = re.compile(rb'^\d+ \(')
+_UID = re.compile(rb'UID (\d+)')
+_SECTION = re.compile(rb'BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$')
+_CONTENT_HEADERS = ('Content-Type', 'Content-Transfer-Encoding')
+
+
+def select_mailbox(mail, mailbox: 'str', readonly: 'bool' = False) -> 'tuple[int, int]':
+    """
+    Select a mailbox and return its UIDVALIDITY and UIDNEXT
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection
+
+    mailbox : str
+        Name of the mailbox. example: inbox
+
+    readonly : bool
+        Open the mailbox with EXAMINE so nothing in it can be changed
+
+    Returns
+    -------
+    tuple[int, int]
+        UIDVALIDITY and UIDNEXT of the mailbox, 0 for the ones the server did not report
+    """
+    mail.select(mailbox, readonly=readonly)
+    codes = []
+    for code in ('UIDVALIDITY', 'UIDNEXT'):
+        typ, data = mail.response(code)
+        codes.append(int(data[-1]) if data and data[-1] is not None else 0)
+    return tuple(codes)
+
+
+def search_uids(mail, criteria: 'str') -> 'list[bytes]':
+    """
+    Run a UID SEARCH on the selected mailbox
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection with a mailbox selected
+
+    criteria : str
+        IMAP search criteria. example: (UNSEEN SUBJECT "hello")
+
+    Returns
+    -------
+    list[bytes]
+        UIDs of the matching messages
+    """
+    typ, data = mail.uid('SEARCH', None, criteria)
+    print(data)
+    return data[0].split()
+
+
+def _chunks(uids, size):
+    for i in range(0, len(uids), size):
+        yield uids[i:i + size]
+
+
+def _uid_set(uids) -> 'str':
+    return ','.join(uid.decode() if isinstance(uid, bytes) else str(uid) for uid in uids)
+
+
+def _parse_fetch_response(data) -> 'list[dict]':
+    """Group the flat imaplib FETCH response into one dict of sections per message."""
+    messages = []
+    current = None
+    for item in data:
+        if isinstance(item, tuple):
+            prefix, literal = item
+            if _MESSAGE_START.match(prefix):
+                current = {}
+                messages.append(current)
+            if current is None:
+                continue
+            uid = _UID.search(prefix)
+            if uid:
+                current[b'UID'] = uid.group(1)
+            section = _SECTION.search(prefix)
+            if section:
+                current[section.group(1).upper()] = literal
+        elif isinstance(item, bytes) and current is not None:
+            # some servers send the UID after the last literal
+            uid = _UID.search(item)
+            if uid:
+                current[b'UID'] = uid.group(1)
+    return messages
+
+
+def _header_section(sections: 'dict') -> 'bytes':
+    for name, value in sections.items():
+        if name.startswith(b'HEADER'):
+            return value
+    return b''
+
+
+def _build_message(sections: 'dict') -> 'message_parser.RawMessage':
+    """
+    Build a message from the fetched header fields and first body part.
+
+    The top level headers are kept so Subject/From still work; for multipart
+    messages the content headers are replaced by the ones of part 1, which
+    makes the result look like a message containing only that part. The body
+    is not parsed here, it stays the bytes the server sent.
+    """
+    header = _header_section(sections)
+
+    msg = email.parser.BytesHeaderParser(_class=message_parser.RawMessage).parsebytes(header)
+    if msg.get_content_maintype() == 'multipart':
+        part_header = email.parser.BytesHeaderParser().parsebytes(sections.get(b'1.MIME', b''))
+        for name in _CONTENT_HEADERS:
+            del msg[name]
+            if part_header[name] is not None:
+                msg[name] = part_header[name]
+
+    msg.body = sections.get(b'1', b'')
+    return msg
+
+
+def fetch_messages(mail, uids: 'list[bytes]', chunk_size: 'int' = FETCH_CHUNK_SIZE):
+    """
+    Fetch messages by UID, several per FETCH command, without marking them seen
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection with a mailbox selected
+
+    uids : list[bytes]
+        UIDs of the messages to fetch
+
+    chunk_size : int
+        Number of messages requested per FETCH command
+
+    Yields
+    ------
+    tuple[bytes, message_parser.RawMessage]
+        UID and a message holding the selected headers and the first body part
+    """
+    for chunk in _chunks(uids, chunk_size):
+        typ, data = mail.uid('FETCH', _uid_set(chunk), FETCH_ITEMS)
+        for sections in _parse_fetch_response(data):
+            yield sections.get(b'UID'), _build_message(sections)
+
+
+def fetch_headers(mail, uids: 'list[bytes]', fields: 'str', chunk_size: 'int' = FETCH_CHUNK_SIZE):
+    """
+    Fetch only some header fields of messages by UID, several per FETCH command
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection with a mailbox selected
+
+    uids : list[bytes]
+        UIDs of the messages to fetch
+
+    fields : str
+        Space separated header names. example: TO SUBJECT
+
+    chunk_size : int
+        Number of messages requested per FETCH command
+
+    Yields
+    ------
+    tuple[bytes, email.message.Message]
+        UID and a message holding only the requested headers
+    """
+    items = '(UID BODY.PEEK[HEADER.FIELDS ({0})])'.format(fields)
+    for chunk in _chunks(uids, chunk_size):
+        typ, data = mail.uid('FETCH', _uid_set(chunk), items)
+        for sections in _parse_fetch_response(data):
+            yield sections.get(b'UID'), email.message_from_bytes(_header_section(sections))
+
+
+def mark_seen(mail, uids: 'list[bytes]'):
+    """
+    Set the \\Seen flag on the given messages of the selected mailbox
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection with a mailbox selected
+
+    uids : list[bytes]
+        UIDs of the messages to mark
+    """
+    for chunk in _chunks(uids, FETCH_CHUNK_SIZE):
+        mail.uid('STORE', _uid_set(chunk), '+FLAGS', '(\\Seen)')
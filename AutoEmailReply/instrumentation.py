@@ -0,0 +1,296 @@
+"""
+Per-run instrumentation of every network call.
+
+IMAP commands, SMTP connections and sends and Sheets/Drive requests are
+timed and recorded per endpoint: number of calls by status (HTTP status,
+SMTP reply code, IMAP OK/NO/BAD, or 'error' when the call raised), a
+latency histogram and the bytes sent and received. HTTP 429 and 5xx
+answers show up as their own statuses.
+
+The entry points write the summary of the run with write() to a JSON file
+or, for a name ending in .prom, a Prometheus textfile, and can run under
+cProfile with profiled().
+
+AutoEmailReply and AutoScanWeeklyReport keep identical copies of this
+module, check_shared_modules.py tells when they drift apart.
+"""
+
+import contextlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import urllib.parse
+from collections import Counter
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+METRIC_PREFIX = 'zenativity'
+
+_ID_SEGMENT_RE = re.compile(r'^(spreadsheets|files)$')
+
+_started = time.time()
+_endpoints = {}
+_lock = threading.Lock()
+
+
+class _Endpoint:
+    def __init__(self):
+        self.statuses = Counter()
+        self.buckets = [0] * len(BUCKETS)
+        self.seconds = 0.0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+
+def record(endpoint: 'str', seconds: 'float', status, bytes_sent: 'int' = 0, bytes_received: 'int' = 0):
+    """
+    Record one call
+
+    Parameters
+    ----------
+    endpoint : str
+        Protocol and operation. example: imap UID FETCH
+
+    seconds : float
+        How long the call took
+
+    status : int or str
+        Outcome of the call. example: 200, 429, 'OK', 'error'
+
+    bytes_sent : int
+        Bytes written to the server
+
+    bytes_received : int
+        Bytes read from the server
+    """
+    with _lock:
+        stats = _endpoints.get(endpoint)
+        if stats is None:
+            stats = _endpoints[endpoint] = _Endpoint()
+        stats.statuses[str(status)] += 1
+        stats.seconds += seconds
+        stats.bytes_sent += bytes_sent
+        stats.bytes_received += bytes_received
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                stats.buckets[i] += 1
+                break
+
+
+@contextlib.contextmanager
+def timed(endpoint: 'str'):
+    """
+    Time the block as one call of endpoint
+
+    Yields a dict where the block can set 'status', 'bytes_sent' and
+    'bytes_received'. The call is recorded with status 'error' if the block raises.
+    """
+    call = {'status': 'ok', 'bytes_sent': 0, 'bytes_received': 0}
+    started = time.perf_counter()
+    try:
+        yield call
+    except BaseException:
+        # keep a status the block already knew, like an SMTP reply code
+        if call['status'] == 'ok':
+            call['status'] = 'error'
+        raise
+    finally:
+        record(endpoint, time.perf_counter() - started, call['status'], call['bytes_sent'], call['bytes_received'])
+
+
+def instrument_imap(mail):
+    """
+    Record every command of an IMAP connection
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        The connection, wrapped in place
+
+    Returns
+    -------
+    imaplib.IMAP4
+        The same connection
+    """
+    transferred = {'sent': 0, 'received': 0}
+    send, read, readline, simple_command = mail.send, mail.read, mail.readline, mail._simple_command
+
+    def counted_send(data):
+        transferred['sent'] += len(data)
+        return send(data)
+
+    def counted_read(size):
+        data = read(size)
+        transferred['received'] += len(data)
+        return data
+
+    def counted_readline():
+        line = readline()
+        transferred['received'] += len(line)
+        return line
+
+    def timed_command(name, *args):
+        # UID commands are told apart by the command they carry
+        endpoint = 'imap ' + name + (' ' + args[0].upper() if name == 'UID' and args else '')
+        sent, received = transferred['sent'], transferred['received']
+        with timed(endpoint) as call:
+            result = simple_command(name, *args)
+            call['status'] = result[0]
+            call['bytes_sent'] = transferred['sent'] - sent
+            call['bytes_received'] = transferred['received'] - received
+        return result
+
+    mail.send = counted_send
+    mail.read = counted_read
+    mail.readline = counted_readline
+    mail._simple_command = timed_command
+    return mail
+
+
+def _google_endpoint(method: 'str', uri: 'str') -> 'str':
+    """Name a Sheets/Drive request by its method and path, without ids and ranges."""
+    segments = urllib.parse.urlsplit(uri).path.strip('/').split('/')
+    for i in range(1, len(segments)):
+        if _ID_SEGMENT_RE.match(segments[i - 1]):
+            # keep a custom method like :batchGet
+            segments[i] = '{id}' + segments[i][segments[i].find(':'):] if ':' in segments[i] else '{id}'
+        elif segments[i - 1] == 'values':
+            segments[i] = '{range}'
+    return 'google ' + method + ' /' + '/'.join(segments)
+
+
+def instrument_http(http):
+    """
+    Record every request of a google api HTTP connection
+
+    Parameters
+    ----------
+    http : google_auth_httplib2.AuthorizedHttp
+        The connection, wrapped in place
+
+    Returns
+    -------
+    google_auth_httplib2.AuthorizedHttp
+        The same connection
+    """
+    request = http.request
+
+    def timed_request(uri, method='GET', body=None, *args, **kwargs):
+        with timed(_google_endpoint(method, uri)) as call:
+            call['bytes_sent'] = len(body) if body else 0
+            response, content = request(uri, method, body, *args, **kwargs)
+            call['status'] = response.status
+            call['bytes_received'] = len(content or b'')
+        return response, content
+
+    http.request = timed_request
+    return http
+
+
+def summary() -> 'dict':
+    """
+    Return the calls recorded so far
+
+    Returns
+    -------
+    dict
+        'run_seconds' since the process started and, per endpoint, 'calls',
+        'statuses', 'seconds', 'bytes_sent', 'bytes_received' and the
+        cumulative latency 'histogram' (bucket upper bound to calls)
+    """
+    with _lock:
+        endpoints = {}
+        for name, stats in sorted(_endpoints.items()):
+            cumulative = 0
+            histogram = {}
+            for bound, count in zip(BUCKETS, stats.buckets):
+                cumulative += count
+                histogram['+Inf' if bound == math.inf else repr(bound)] = cumulative
+            endpoints[name] = {'calls': sum(stats.statuses.values()),
+                               'statuses': dict(stats.statuses),
+                               'seconds': round(stats.seconds, 6),
+                               'bytes_sent': stats.bytes_sent,
+                               'bytes_received': stats.bytes_received,
+                               'histogram': histogram}
+    return {'run_seconds': round(time.time() - _started, 3), 'endpoints': endpoints}
+
+
+def _label(value: 'str') -> 'str':
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def to_prometheus(run: 'dict', job: 'str') -> 'str':
+    """Format a summary in the Prometheus text exposition format."""
+    prefix = METRIC_PREFIX + '_call'
+    lines = ['# HELP {0}_duration_seconds Latency of the network calls of the last run'.format(prefix),
+             '# TYPE {0}_duration_seconds histogram'.format(prefix)]
+    for name, stats in run['endpoints'].items():
+        labels = 'job="{0}",endpoint="{1}"'.format(_label(job), _label(name))
+        for bound, count in stats['histogram'].items():
+            lines.append('{0}_duration_seconds_bucket{{{1},le="{2}"}} {3}'.format(prefix, labels, bound, count))
+        lines.append('{0}_duration_seconds_sum{{{1}}} {2}'.format(prefix, labels, stats['seconds']))
+        lines.append('{0}_duration_seconds_count{{{1}}} {2}'.format(prefix, labels, stats['calls']))
+    lines += ['# HELP {0}s_total Network calls of the last run by outcome'.format(prefix),
+              '# TYPE {0}s_total counter'.format(prefix)]
+    for name, stats in run['endpoints'].items():
+        for status, count in sorted(stats['statuses'].items()):
+            lines.append('{0}s_total{{job="{1}",endpoint="{2}",status="{3}"}} {4}'.format(
+                prefix, _label(job), _label(name), _label(status), count))
+    lines += ['# HELP {0}_bytes_total Bytes transferred by the network calls of the last run'.format(prefix),
+              '# TYPE {0}_bytes_total counter'.format(prefix)]
+    for name, stats in run['endpoints'].items():
+        for direction in ('sent', 'received'):
+            lines.append('{0}_bytes_total{{job="{1}",endpoint="{2}",direction="{3}"}} {4}'.format(
+                prefix, _label(job), _label(name), direction, stats['bytes_' + direction]))
+    lines += ['# HELP {0}_run_seconds Duration of the last run'.format(METRIC_PREFIX),
+              '# TYPE {0}_run_seconds gauge'.format(METRIC_PREFIX),
+              '{0}_run_seconds{{job="{1}"}} {2}'.format(METRIC_PREFIX, _label(job), run['run_seconds'])]
+    return '\n'.join(lines) + '\n'
+
+
+def write(path: 'str', job: 'str'):
+    """
+    Write the summary of the run, replacing the file atomically
+
+    Parameters
+    ----------
+    path : str
+        Output file, a Prometheus textfile if it ends in .prom, JSON otherwise
+
+    job : str
+        Name of the run in the output. example: daily
+    """
+    run = summary()
+    if path.endswith('.prom'):
+        content = to_prometheus(run, job)
+    else:
+        content = json.dumps(dict(run, job=job), indent=2)
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as out:
+        out.write(content)
+    os.replace(temporary, path)
+
+
+@contextlib.contextmanager
+def profiled(path: 'str'):
+    """
+    Run the block under cProfile, save the stats to path and print the top entries
+
+    Does nothing when path is None.
+    """
+    if path is None:
+        yield
+        return
+    import cProfile
+    import pstats
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
@@ -0,0 +1,366 @@
+"""
+Field extraction for the notification emails we reply to.
+
+All patterns are compiled once. The Name, Email and "View Response:" labels
+are found with a single finditer over the decoded text, and the value after
+each label is matched in place (pos/endpos) instead of slicing the body.
+The text/plain part is used when it has what we need, the text/html part
+(tags stripped) otherwise, so HTML-only notifications work too.
+
+Messages fetched by imap_fetch keep their body as the raw bytes of the
+server (RawMessage), never built into an email.message tree. TextPartParser
+reads them a line at a time: parts that
+are not text are skipped without being stored or decoded, a text part is
+decoded with its transfer encoding and declared charset once it ends, and
+parsing stops at the first text part holding the field we need.
+"""
+
+import binascii
+import codecs
+import email.message
+import email.parser
+import html
+import io
+import quopri
+import re
+
+# how far after a label its value may start, in characters
+NAME_WINDOW = 30
+EMAIL_WINDOW = 100
+
+# a plain alternation of literals lets re skip ahead on their first letters,
+# which is several times faster than grouping or anchoring the alternatives
+_FIELD_RE = re.compile(r'View Response:|Name|Email')
+_LABELS = {'View Response:': 'response', 'Name': 'name', 'Email': 'email'}
+_NAME_RE = re.compile(r'(\w+)\s+(\w+)')
+_EMAIL_RE = re.compile(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b')
+
+_HTML_SKIP_RE = re.compile(r'<(script|style)\b.*?</\1\s*>', re.S | re.I)
+_HTML_BREAK_RE = re.compile(r'<br\s*/?>|</(p|div|tr|li|h\d)\s*>', re.I)
+_HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+TEXT_TYPES = ('text/plain', 'text/html')
+# bytes kept of a text part or of a block of part headers, the rest is dropped
+MAX_TEXT_BYTES = 1024 * 1024
+MAX_HEADER_BYTES = 64 * 1024
+# bytes of an unfinished line kept outside of a text part (RFC 5322 lines are
+# at most 998 characters, a boundary line is far shorter); the rest of a
+# longer line, a binary attachment or one-line HTML, is dropped as it comes
+MAX_LINE_BYTES = 1000
+# bytes read from the fed data at a time
+_SEGMENT_BYTES = 64 * 1024
+
+
+class RawMessage(email.message.Message):
+    """
+    Message whose headers are parsed and whose body is kept as the bytes fetched
+
+    The content headers describe body, which parse_message reads with
+    TextPartParser instead of building a part per MIME section.
+    """
+    body = b''
+
+
+def html_to_text(content: 'str') -> 'str':
+    """
+    Turn an HTML body into plain text good enough for field extraction
+
+    Parameters
+    ----------
+    content : str
+        HTML source
+
+    Returns
+    -------
+    str
+        The text with tags removed and entities unescaped
+    """
+    content = _HTML_SKIP_RE.sub('', content)
+    content = _HTML_BREAK_RE.sub('\n', content)
+    content = _HTML_TAG_RE.sub(' ', content)
+    return html.unescape(content)
+
+
+def decode_text(payload: 'bytes', charset: 'str') -> 'str':
+    """
+    Decode a text payload with its declared charset
+
+    Parameters
+    ----------
+    payload : bytes
+        Payload, transfer encoding already removed
+
+    charset : str
+        Declared charset, None if the part has none
+
+    Returns
+    -------
+    str
+        The text; bytes invalid in the charset are replaced, and a charset
+        Python does not know is read as utf-8
+    """
+    try:
+        codecs.lookup(charset or 'utf-8')
+    except LookupError:
+        charset = 'utf-8'
+    return payload.decode(charset or 'utf-8', errors='replace')
+
+
+def _decode_transfer(data: 'bytes', encoding: 'str') -> 'bytes':
+    if encoding == 'base64':
+        data = b''.join(data.split())
+        # a part cut short by MAX_TEXT_BYTES or a partial fetch ends mid quantum
+        data = data[:len(data) - len(data) % 4]
+        try:
+            return binascii.a2b_base64(data)
+        except binascii.Error:
+            return b''
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
+
+
+class TextPartParser:
+    """
+    Feed parser of a MIME message that keeps only its text parts
+
+    Bytes are fed as they come and read a line at a time. Multipart
+    boundaries are followed to any depth; the bodies of parts other than
+    text/plain and text/html (attachments, images, forwarded messages) are
+    skipped as they go by. The first part of each text type is decoded when
+    it ends and handed to accept, and the parser stops at the first one
+    accept takes.
+
+    Parameters
+    ----------
+    accept : callable
+        Called with the content type and the decoded text of a text part,
+        True to stop there
+
+    headers : email.message.Message
+        Headers of the message when they were parsed already, so the bytes fed
+        start with the body; None if they start with the headers
+    """
+
+    def __init__(self, accept=None, headers: 'email.message.Message' = None):
+        self.accept = accept
+        self.texts = {}
+        self.done = False
+        self._pending = b''
+        self._discarding = False
+        self._boundaries = []
+        self._headerLines = []
+        self._headerSize = 0
+        self._collecting = None
+        self._size = 0
+        self._type = self._charset = self._encoding = None
+        if headers is None:
+            self._state = 'headers'
+        else:
+            self._start_part(headers)
+
+    def feed(self, data: 'bytes'):
+        """Parse the next bytes of the message, ignored once done."""
+        if self.done:
+            return
+        stream = io.BytesIO(data)
+        # a line longer than a segment comes in several pieces
+        for piece in iter(lambda: stream.readline(_SEGMENT_BYTES), b''):
+            if self._discarding:
+                self._discarding = not piece.endswith(b'\n')
+                continue
+            if not piece.endswith(b'\n'):
+                # the rest of the line comes with the next bytes
+                self._hold(piece)
+                continue
+            if self._pending:
+                piece = self._pending + piece
+                self._pending = b''
+            self._line(piece)
+            if self.done:
+                break
+
+    def _hold(self, piece: 'bytes'):
+        self._pending += piece
+        limit = MAX_LINE_BYTES
+        if self._collecting is not None:
+            limit = max(limit, MAX_TEXT_BYTES - self._size)
+        if len(self._pending) > limit:
+            # too long for a boundary: keep what still fits of a text part, drop the rest of the line
+            self._line(self._pending[:limit])
+            self._pending = b''
+            self._discarding = True
+
+    def close(self) -> 'dict[str, str]':
+        """
+        End the message, finishing a part cut short
+
+        Returns
+        -------
+        dict[str, str]
+            Content type to decoded text, of the text parts read
+        """
+        if not self.done:
+            if self._pending:
+                self._line(self._pending)
+                self._pending = b''
+            self._end_part()
+        return self.texts
+
+    def _line(self, line: 'bytes'):
+        if self._boundaries and line.startswith(b'--'):
+            marker = line.rstrip()
+            # an inner boundary never prefixes an outer one, see RFC 2046
+            for depth in range(len(self._boundaries) - 1, -1, -1):
+                delimiter = b'--' + self._boundaries[depth]
+                if marker == delimiter or marker == delimiter + b'--':
+                    self._end_part()
+                    if self.done:
+                        return
+                    if marker == delimiter:
+                        del self._boundaries[depth + 1:]
+                        self._state = 'headers'
+                        self._headerLines, self._headerSize = [], 0
+                    else:
+                        # the epilogue is skipped until a boundary of an outer multipart
+                        del self._boundaries[depth:]
+                        self._state = 'skip'
+                    return
+
+        if self._state == 'headers':
+            if line in (b'\r\n', b'\n'):
+                self._start_part(email.parser.BytesHeaderParser().parsebytes(b''.join(self._headerLines)))
+            elif self._headerSize < MAX_HEADER_BYTES:
+                self._headerLines.append(line)
+                self._headerSize += len(line)
+        elif self._collecting is not None and self._size < MAX_TEXT_BYTES:
+            self._collecting.append(line)
+            self._size += len(line)
+
+    def _start_part(self, headers: 'email.message.Message'):
+        self._state = 'skip'
+        self._collecting = None
+        content_type = headers.get_content_type()
+        if headers.get_content_maintype() == 'multipart':
+            boundary = headers.get_boundary()
+            if boundary:
+                self._boundaries.append(boundary.encode('ascii', 'replace'))
+        elif content_type in TEXT_TYPES and content_type not in self.texts:
+            self._state = 'body'
+            self._collecting = []
+            self._size = 0
+            self._type = content_type
+            self._charset = headers.get_content_charset()
+            self._encoding = str(headers.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+
+    def _end_part(self):
+        if self._collecting is None:
+            return
+        data = b''.join(self._collecting)
+        self._collecting = None
+        # the line break before a boundary belongs to the boundary
+        if data.endswith(b'\r\n'):
+            data = data[:-2]
+        elif data.endswith(b'\n'):
+            data = data[:-1]
+        text = decode_text(_decode_transfer(data, self._encoding), self._charset)
+        if self._type == 'text/html':
+            text = html_to_text(text)
+        self.texts[self._type] = text
+        if self.accept is not None and self.accept(self._type, text):
+            self.done = True
+
+
+def extract_fields(content: 'str') -> 'dict[str, str]':
+    """
+    Find the Name, Email and "View Response:" fields in one pass over the text
+
+    Parameters
+    ----------
+    content : str
+        Decoded body text
+
+    Returns
+    -------
+    dict[str, str]
+        'name': the two words after the last Name label before the email,
+        'email': the address after the first Email label that has one,
+        'response': the address after "View Response:".
+        Fields that were not found are left out.
+    """
+    fields = {}
+    for match in _FIELD_RE.finditer(content):
+        start = match.end()
+        # Name and Email must be whole words, not part of e.g. "Username"
+        if (match.start() > 0 and content[match.start() - 1].isalnum()) or \
+                (start < len(content) and content[start].isalnum()):
+            continue
+        label = _LABELS[match.group()]
+        if label == 'name':
+            if 'email' not in fields:
+                name = _NAME_RE.search(content, start, start + NAME_WINDOW)
+                if name:
+                    fields['name'] = name.group()
+        elif label not in fields:
+            address = _EMAIL_RE.search(content, start, start + EMAIL_WINDOW)
+            if address:
+                fields[label] = address.group()
+    return fields
+
+
+def parse_bytes(chunks, required: 'str', headers: 'email.message.Message' = None) -> 'dict[str, str]':
+    """
+    Extract the fields of a raw notification, reading it only up to the first text part that has them
+
+    Parameters
+    ----------
+    chunks : bytes or iterable of bytes
+        The message, or its body if headers is given
+
+    required : str
+        The field that must be present. example: email
+
+    headers : email.message.Message
+        Headers of the message when chunks is only its body
+
+    Returns
+    -------
+    dict[str, str]
+        Fields as returned by extract_fields, empty if required was not found
+    """
+    found = {}
+
+    def accept(content_type, text):
+        fields = extract_fields(text)
+        if required in fields:
+            found.update(fields)
+            return True
+        return False
+
+    parser = TextPartParser(accept, headers)
+    for chunk in ([chunks] if isinstance(chunks, (bytes, bytearray)) else chunks):
+        parser.feed(chunk)
+        if parser.done:
+            break
+    parser.close()
+    return found
+
+
+def parse_message(msg: 'RawMessage', required: 'str') -> 'dict[str, str]':
+    """
+    Extract the fields of a notification fetched by imap_fetch, falling back to its HTML part
+
+    Parameters
+    ----------
+    msg : RawMessage
+        The notification message, its body is streamed through TextPartParser
+
+    required : str
+        The field that must be present. example: email
+
+    Returns
+    -------
+    dict[str, str]
+        Fields as returned by extract_fields, empty if required was not found
+    """
+    return parse_bytes(msg.body, required, msg)
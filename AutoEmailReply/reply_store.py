@@ -0,0 +1,395 @@
+"""
+Local index of the recipients we have already written to.
+
+The index lives in a small SQLite file next to token.json, in two tables:
+
+- sent: every address we ever mailed, from any workflow or by hand. It is
+  filled by one incremental sync of the Sent Mail folder per run (only UIDs
+  newer than the last synced one are looked at, whatever the subject) and
+  by every reply sent, see has_mailed.
+- replied: the replies of each workflow, per topic, see has_replied. Volunteer
+  match answers one notification per opportunity, so a volunteer applying
+  to a second one is answered again.
+
+Checking for a duplicate is a local primary-key lookup instead of an IMAP
+SEARCH per recipient.
+
+The same file keeps a (UIDVALIDITY, last processed UID) checkpoint per
+workflow and mailbox, so each run only asks the inbox for new messages. A
+message that fails is retried on the next runs. The time of its first
+failure is kept, and once it has kept failing for GIVE_UP_DAYS the
+checkpoint moves past it, so one bad notification cannot hold back every
+later one. Network errors (see is_transient) are not counted as failures:
+the daemon runs on every new mail and would count an outage many times.
+"""
+
+import email.utils
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+import imap_fetch
+
+DB_PATH = 'reply_store.db'
+SENT_MAILBOX = '"[Gmail]/Sent Mail"'
+INBOX = 'inbox'
+# checkpoint name of the Sent Mail sync, shared by every workflow
+SENT_SYNC = 'sent'
+# how far back to look when there is no usable checkpoint
+FALLBACK_DAYS = 2
+# days a message keeps failing before the checkpoint moves past it
+GIVE_UP_DAYS = 3
+
+_connection = None
+# the connection is shared by the pipeline threads, one statement at a time
+_lock = threading.RLock()
+
+
+def connect(path: 'str' = DB_PATH) -> 'sqlite3.Connection':
+    """
+    Open (and create if needed) the store, once per process
+
+    Parameters
+    ----------
+    path : str
+        Location of the SQLite file
+
+    Returns
+    -------
+    sqlite3.Connection
+        The shared connection
+    """
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(path, check_same_thread=False)
+        _connection.executescript("""
+            CREATE TABLE IF NOT EXISTS sent (
+                email TEXT PRIMARY KEY,
+                seen_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS replied (
+                workflow TEXT NOT NULL,
+                email TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                replied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (workflow, email, topic)
+            );
+            CREATE TABLE IF NOT EXISTS checkpoint (
+                workflow TEXT NOT NULL,
+                mailbox TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                last_uid INTEGER NOT NULL,
+                PRIMARY KEY (workflow, mailbox)
+            );
+            CREATE TABLE IF NOT EXISTS failure (
+                workflow TEXT NOT NULL,
+                mailbox TEXT NOT NULL,
+                uidvalidity INTEGER NOT NULL,
+                uid INTEGER NOT NULL,
+                first_failed TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (workflow, mailbox, uid)
+            );
+        """)
+    return _connection
+
+
+def _normalize(address: 'str') -> 'str':
+    return address.strip().lower()
+
+
+def has_mailed(address: 'str') -> 'bool':
+    """
+    Check whether we have ever sent mail to an address
+
+    Parameters
+    ----------
+    address : str
+        Email address of the recipient
+
+    Returns
+    -------
+    bool
+        True if the address is in Sent Mail as of the last sync, or was replied to since
+    """
+    with _lock:
+        row = connect().execute('SELECT 1 FROM sent WHERE email = ?', (_normalize(address),)).fetchone()
+    return row is not None
+
+
+def has_replied(workflow: 'str', address: 'str', topic: 'str' = '') -> 'bool':
+    """
+    Check whether a workflow has already replied to an address about a topic
+
+    Parameters
+    ----------
+    workflow : str
+        Name of the reply workflow. example: volunteer_match
+
+    address : str
+        Email address of the recipient
+
+    topic : str
+        What the reply was about. example: the title of the opportunity
+
+    Returns
+    -------
+    bool
+        True if a reply to this address about this topic is recorded for this workflow
+    """
+    with _lock:
+        row = connect().execute('SELECT 1 FROM replied WHERE workflow = ? AND email = ? AND topic = ?',
+                                (workflow, _normalize(address), topic)).fetchone()
+    return row is not None
+
+
+def record_reply(workflow: 'str', address: 'str', topic: 'str' = ''):
+    """
+    Remember that a workflow has replied to an address about a topic
+
+    Parameters
+    ----------
+    workflow : str
+        Name of the reply workflow. example: google_form
+
+    address : str
+        Email address of the recipient
+
+    topic : str
+        What the reply was about, see has_replied
+    """
+    with _lock, connect() as conn:
+        conn.execute('INSERT OR IGNORE INTO replied (workflow, email, topic) VALUES (?, ?, ?)',
+                     (workflow, _normalize(address), topic))
+        conn.execute('INSERT OR IGNORE INTO sent (email) VALUES (?)', (_normalize(address),))
+
+
+def get_checkpoint(workflow: 'str', mailbox: 'str') -> 'tuple[int, int]':
+    """
+    Return the (UIDVALIDITY, last processed UID) saved for a workflow and mailbox
+
+    Parameters
+    ----------
+    workflow : str
+        Name of the workflow
+
+    mailbox : str
+        Name of the mailbox
+
+    Returns
+    -------
+    tuple[int, int]
+        The saved checkpoint, or None if there is none yet
+    """
+    with _lock:
+        return connect().execute('SELECT uidvalidity, last_uid FROM checkpoint WHERE workflow = ? AND mailbox = ?',
+                                 (workflow, mailbox)).fetchone()
+
+
+def set_checkpoint(workflow: 'str', mailbox: 'str', uidvalidity: 'int', last_uid: 'int'):
+    """
+    Save the UIDVALIDITY and last processed UID for a workflow and mailbox
+
+    Parameters
+    ----------
+    workflow : str
+        Name of the workflow
+
+    mailbox : str
+        Name of the mailbox
+
+    uidvalidity : int
+        UIDVALIDITY of the mailbox the UID belongs to
+
+    last_uid : int
+        Highest UID that has been processed
+    """
+    with _lock, connect() as conn:
+        conn.execute('INSERT OR REPLACE INTO checkpoint (workflow, mailbox, uidvalidity, last_uid) VALUES (?, ?, ?, ?)',
+                     (workflow, mailbox, uidvalidity, last_uid))
+
+
+def is_transient(err: 'Exception') -> 'bool':
+    """
+    Tell whether an error comes from the network or a server rather than the message
+
+    Parameters
+    ----------
+    err : Exception
+        Error raised while handling a message
+
+    Returns
+    -------
+    bool
+        True for socket, SMTP and Google api errors, which are retried without
+        counting as a failure of the message
+    """
+    import smtplib
+
+    from googleapiclient.errors import HttpError
+
+    return isinstance(err, (OSError, smtplib.SMTPException, HttpError))
+
+
+def record_failures(workflow: 'str', mailbox: 'str', uidvalidity: 'int', uids: 'list[int]') -> 'list[int]':
+    """
+    Remember when each message first failed and return the ones to give up on
+
+    Parameters
+    ----------
+    workflow : str
+        Name of the workflow
+
+    mailbox : str
+        Name of the mailbox
+
+    uidvalidity : int
+        UIDVALIDITY of the mailbox the UIDs belong to
+
+    uids : list[int]
+        UIDs of the messages that failed this run
+
+    Returns
+    -------
+    list[int]
+        UIDs among uids that first failed GIVE_UP_DAYS or more ago
+    """
+    with _lock, connect() as conn:
+        # failures counted under another UIDVALIDITY are for other messages
+        conn.execute('DELETE FROM failure WHERE workflow = ? AND mailbox = ? AND uidvalidity != ?',
+                     (workflow, mailbox, uidvalidity))
+        conn.executemany('INSERT OR IGNORE INTO failure (workflow, mailbox, uidvalidity, uid) VALUES (?, ?, ?, ?)',
+                         [(workflow, mailbox, uidvalidity, uid) for uid in uids])
+        expired = set(uid for uid, in conn.execute(
+            "SELECT uid FROM failure WHERE workflow = ? AND mailbox = ? "
+            "AND julianday('now') - julianday(first_failed) >= ?", (workflow, mailbox, GIVE_UP_DAYS)))
+    return sorted(uid for uid in uids if uid in expired)
+
+
+def clear_failures(workflow: 'str', mailbox: 'str', last_uid: 'int'):
+    """Forget the failures of the messages the checkpoint of a workflow has moved past."""
+    with _lock, connect() as conn:
+        conn.execute('DELETE FROM failure WHERE workflow = ? AND mailbox = ? AND uid <= ?',
+                     (workflow, mailbox, last_uid))
+
+
+def sync_sent_mail(mail):
+    """
+    Record the recipients of everything found in Sent Mail since the last sync
+
+    Any mail we sent to an address counts, whatever its subject, see
+    has_mailed. Run once per run for every workflow. Leaves Sent Mail
+    selected, the caller selects the mailbox it needs next.
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection
+    """
+    uidvalidity, uidnext = imap_fetch.select_mailbox(mail, SENT_MAILBOX, readonly=True)
+
+    last_uid = 0
+    checkpoint = get_checkpoint(SENT_SYNC, SENT_MAILBOX)
+    if checkpoint is not None and checkpoint[0] == uidvalidity:
+        last_uid = checkpoint[1]
+
+    uids = imap_fetch.search_uids(mail, '(UID {0}:*)'.format(last_uid + 1))
+    # "n:*" always matches the newest message, even if it is older than n
+    uids = [uid for uid in uids if int(uid) > last_uid]
+
+    for uid, msg in imap_fetch.fetch_headers(mail, uids, 'TO'):
+        addresses = [address for name, address in email.utils.getaddresses(msg.get_all('To', [])) if address]
+        with _lock, connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO sent (email) VALUES (?)',
+                             [(_normalize(address),) for address in addresses])
+
+    # everything below UIDNEXT has been looked at
+    last_uid = max([last_uid, uidnext - 1] + [int(uid) for uid in uids])
+    set_checkpoint(SENT_SYNC, SENT_MAILBOX, uidvalidity, last_uid)
+
+
+def search_new_messages(mail, workflow: 'str', criteria: 'str', mailbox: 'str' = INBOX) -> 'tuple[list[bytes], tuple[int, int]]':
+    """
+    Select a mailbox and find the messages that arrived since the workflow last ran
+
+    With a checkpoint for the current UIDVALIDITY only "UID n+1:*" is searched.
+    Without one (first run, or the mailbox was rebuilt) we fall back to unseen
+    messages of the last FALLBACK_DAYS days.
+
+    Parameters
+    ----------
+    mail : imaplib.IMAP4
+        Logged in IMAP connection
+
+    workflow : str
+        Name of the reply workflow
+
+    criteria : str
+        IMAP search criteria matching the notifications. example: SUBJECT "hello"
+
+    mailbox : str
+        Name of the mailbox to search
+
+    Returns
+    -------
+    tuple[list[bytes], tuple[int, int]]
+        UIDs of the new matching messages, and the (UIDVALIDITY, UIDNEXT) of
+        the mailbox to pass on to update_checkpoint
+    """
+    uidvalidity, uidnext = imap_fetch.select_mailbox(mail, mailbox)
+
+    checkpoint = get_checkpoint(workflow, mailbox)
+    if checkpoint is not None and checkpoint[0] == uidvalidity:
+        last_uid = checkpoint[1]
+        uids = imap_fetch.search_uids(mail, '(UID {0}:* {1})'.format(last_uid + 1, criteria))
+        # "n:*" always matches the newest message, even if it is older than n
+        uids = [uid for uid in uids if int(uid) > last_uid]
+    else:
+        since_date = (datetime.now() - timedelta(days=FALLBACK_DAYS)).strftime('%d-%b-%Y')
+        uids = imap_fetch.search_uids(mail, '(UNSEEN {0} SINCE {1})'.format(criteria, since_date))
+
+    return uids, (uidvalidity, uidnext)
+
+
+def update_checkpoint(workflow: 'str', state: 'tuple[int, int]', uids: 'list[bytes]',
+                      done_uids: 'list[bytes]', failed_uids: 'list[bytes]', mailbox: 'str' = INBOX):
+    """
+    Move the checkpoint of a workflow past the messages it is done with
+
+    The checkpoint stops right before the first message that was not handled,
+    so that message is searched again on the next run, unless it has been
+    failing for GIVE_UP_DAYS: it is then logged and skipped for good. Messages
+    that were not tried, or hit a network error, are only searched again.
+
+    Parameters
+    ----------
+    workflow : str
+        Name of the reply workflow
+
+    state : tuple[int, int]
+        (UIDVALIDITY, UIDNEXT) returned by search_new_messages
+
+    uids : list[bytes]
+        UIDs returned by search_new_messages
+
+    done_uids : list[bytes]
+        UIDs of the messages that have been handled
+
+    failed_uids : list[bytes]
+        UIDs of the messages that were tried and failed because of their content
+
+    mailbox : str
+        Name of the mailbox that was searched
+    """
+    uidvalidity, uidnext = state
+    pending = set(int(uid) for uid in uids) - set(int(uid) for uid in done_uids)
+    failed = sorted(pending & set(int(uid) for uid in failed_uids))
+    if failed:
+        for uid in record_failures(workflow, mailbox, uidvalidity, failed):
+            print("{0}: giving up on message {1}, failing for {2} days".format(workflow, uid, GIVE_UP_DAYS))
+            pending.discard(uid)
+    if pending:
+        last_uid = min(pending) - 1
+    else:
+        last_uid = max([uidnext - 1] + [int(uid) for uid in uids])
+    set_checkpoint(workflow, mailbox, uidvalidity, last_uid)
+    clear_failures(workflow, mailbox, last_uid)
@@ -1,43 +1,28 @@
-import imaplib
-import smtplib
 import email
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import config     # stores the email
-from datetime import datetime, timedelta
-import re
 
-def extractEmail(content):
-    email = re.search(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', content)
+import imap_fetch
+import instrumentation
+import mail_transport
+import message_parser
+import reply_store
 
-    if email:
-        return email.group(0)
+# Name of this workflow in the reply store and the subject of our replies
+WORKFLOW = 'volunteer_match'
+REPLY_SUBJECT = 'RE: Zenativity Volunteer Opportunity'
 
-def extractName(content):
-    name = re.search("(\w+)\s+(\w+)", content).group()
-    return name
+# Search for emails with the desired subject line
+subject1 = 'Someone wants to help: Volunteer with us and maintain your OPT status!'
+subject2 = 'Someone wants to help: Laid off? Losing OPT status? Volunteer with us and maintain your OPT status!'
+SEARCH_CRITERIA = 'OR SUBJECT "{0}" SUBJECT "{1}"'.format(subject1, subject2)
 
 def getCandidateEmailnName(mgs):
-    if mgs.is_multipart():
-        content = ""
-        for part in mgs.get_payload():
-            try:
-                nn = part.get_payload(decode=True).decode()
-                content += nn
-            except:
-                pass
-    else:
-        content = mgs.get_payload(decode=True).decode()
-
-    for i in range(len(content)-10):
-        if(content[i:i+4] == "Name"):
-            candidate_name = extractName(content[i+6: i+30])
-
-        if(content[i:i+5] == "Email"):
-            print(1)
-            candidate_email = extractEmail(content[i+6:i+106])
-            break
-    return (candidate_name, candidate_email)
+    fields = message_parser.parse_message(mgs, 'email')
+    if not fields:
+        raise Exception("Didn't find email after Email")
+
+    # greet generically if the notification has no name field
+    return (fields.get('name', 'there'), fields['email'])
 
 def obtain_header(msg):
     # decode the email subject
@@ -47,71 +32,141 @@ def obtain_header(msg):
 
     return subject
 
+def parse(msg) -> 'dict':
+    """
+    Read the candidate out of a volunteer match notification
+
+    Parameters
+    ----------
+    msg : email.message.Message
+        The notification message
+
+    Returns
+    -------
+    dict
+        'email', 'name' and 'subject' (the opportunity title) of the candidate
+    """
+    candidate_name, toEmail = getCandidateEmailnName(msg)
+    print(toEmail)
+    return {'email': toEmail, 'name': candidate_name, 'subject': obtain_header(msg)}
+
+def enrich(candidate: 'dict') -> 'dict':
+    """
+    Nothing to look up for volunteer match, the notification has everything
+
+    Parameters
+    ----------
+    candidate : dict
+        Candidate returned by parse
+
+    Returns
+    -------
+    dict
+        The same candidate
+    """
+    return candidate
+
+def topic(candidate: 'dict') -> 'str':
+    """Return what the reply to a candidate is about, the opportunity, see reply_store.has_replied."""
+    return candidate['subject']
+
+def compose(candidate: 'dict', smtp_username: 'str'):
+    """
+    Compose the reply to one volunteer match candidate
+
+    Parameters
+    ----------
+    candidate : dict
+        Candidate returned by enrich
+
+    smtp_username : str
+        The address we reply from
+
+    Returns
+    -------
+    email.message.Message
+        The reply, or None if this candidate already got one
+    """
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
+    # Extract the sender's email address
+    sender_email = candidate['email']
+
+    # one reply per opportunity, a volunteer applying to another one is answered again
+    if reply_store.has_replied(WORKFLOW, sender_email, topic(candidate)):
+        print("have sent to " + sender_email)
+        return None
+
+    # Compose the reply message
+    reply_subject = REPLY_SUBJECT
+
+    # parallel reply email
+    reply_body = 'Hi {0}, Thank you for your interest in this volunteer opportunity! We are glad to connect with you and get to know you better! Please make an appointment with us using the following link: {1}'.format(candidate['name'], config.CALENDLY_LINK)
+    reply_info = "OPPORTUNITY INFORMATION: Title: {0} Organization: Zenativity, Inc.".format(candidate['subject'])
+
+    # create http email content
+    message = MIMEMultipart()
+    message["From"] = smtp_username
+    message["To"] = sender_email
+    message["Subject"] = reply_subject
+
+    html = """
+    <html>
+        <body>
+            <p>{0}</p><br>
+            <p>{1}</p>
+        </body>
+    </html>
+    """.format(reply_body, reply_info)
+
+    # Add HTML content to message body
+    body = MIMEText(html, "html")
+    message.attach(body)
+
+    return message
+
 # SMTP settings
 def reply():
-    smtp_server = 'smtp.gmail.com'
-    smtp_port = 587
     smtp_username = config.USER
     smtp_password = config.PASSWORD
 
+    import imaplib
+
     # IMAP settings
-    mail = imaplib.IMAP4_SSL('imap.gmail.com')
+    mail = instrumentation.instrument_imap(imaplib.IMAP4_SSL('imap.gmail.com'))
     mail.login(smtp_username, smtp_password)
-    mail.select('inbox')
 
-    # Search for emails with the desired subject line
-    since_date = (datetime.now() - timedelta(days=2)).strftime('%d-%b-%Y')
-    subject1 = 'Someone wants to help: Volunteer with us and maintain your OPT status!'
-    subject2 = 'Someone wants to help: Laid off? Losing OPT status? Volunteer with us and maintain your OPT status!'
-    typ, data = mail.search(None, '(UNSEEN OR SUBJECT "{0}" SUBJECT "{1}" SINCE {2})'.format(subject1, subject2, since_date))
-    print(data)
+    # pick up replies sent since the last run, then work on the inbox
+    reply_store.sync_sent_mail(mail)
+    uids, inbox_state = reply_store.search_new_messages(mail, WORKFLOW, SEARCH_CRITERIA)
+
+    transport = mail_transport.get_transport(smtp_username, smtp_password)
 
     # Loop through each email and send a reply
-    for num in data[0].split():
-        typ, msg_data = mail.fetch(num, '(RFC822)')
-
-        msg_str = msg_data[0][1].decode('utf-8')
-        msg = email.message_from_string(msg_str)
-
-        msg_subject = obtain_header(msg)
-        candidate_name, toEmail = getCandidateEmailnName(msg)
-        print(toEmail)
-        # Extract the sender's email address
-        sender_email = toEmail
-
-
-        # Compose the reply message
-        reply_subject = 'RE: Zenativity Volunteer Opportunity'
-
-        # parallel reply email
-        reply_body = 'Hi {0}, Thank you for your interest in this volunteer opportunity! We are glad to connect with you and get to know you better! Please make an appointment with us using the following link: {1}'.format(candidate_name, config.CALENDLY_LINK)
-        reply_info = "OPPORTUNITY INFORMATION: Title: {0} Organization: Zenativity, Inc.".format(msg_subject)
-
-        # create http email content
-        message = MIMEMultipart()
-        message["From"] = smtp_username
-        message["To"] = sender_email
-        message["Subject"] = reply_subject
-
-        html = """
-        <html>
-            <body>
-                <p>{0}</p><br>
-                <p>{1}</p>
-            </body>
-        </html>
-        """.format(reply_body, reply_info)
-
-        # Add HTML content to message body
-        body = MIMEText(html, "html")
-        message.attach(body)
-
-        # Send the reply message
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_username, smtp_password)
-            print(smtp_username, sender_email)
-            server.sendmail(smtp_username, sender_email, message.as_string())
+    replied_uids = []
+    failed_uids = []
+    try:
+        for uid, msg in imap_fetch.fetch_messages(mail, uids):
+            # a bad notification is left for the next run, see reply_store.update_checkpoint
+            try:
+                candidate = enrich(parse(msg))
+                message = compose(candidate, smtp_username)
+                if message is not None:
+                    # Send the reply message over the shared session
+                    print(smtp_username, message["To"])
+                    transport.send(message["To"], message)
+                    reply_store.record_reply(WORKFLOW, message["To"], topic(candidate))
+            except Exception as err:
+                print("{0} failed on message {1}: {2}".format(WORKFLOW, uid, err))
+                if not reply_store.is_transient(err):
+                    failed_uids.append(uid)
+                continue
+            replied_uids.append(uid)
+    finally:
+        # Only messages we actually replied to are marked as seen
+        imap_fetch.mark_seen(mail, replied_uids)
+        reply_store.update_checkpoint(WORKFLOW, inbox_state, uids, replied_uids, failed_uids)
 
     # Close the connection to the mail server
     mail.close()
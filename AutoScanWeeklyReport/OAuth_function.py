@@ -5,28 +5,27 @@ https://numpydoc.readthedocs.io/en/latest/format.html#docstring-standard
 
 from __future__ import print_function
 
-import os.path
 # libraries for google API
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
 import datetime
 import dateutil.relativedelta as dateDelta
 
-#libraries for sending email
-import imaplib
-import smtplib
-from email.mime.text import MIMEText
-
+import duplicate_index
 import email_data
+import google_clients
+import mail_transport
+import report_validation
+import roster
 
 
 weekDays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
-dateFormat = '%m-%d-%y'
+dateFormat = roster.DATE_FORMAT
 
+# Drive folder holding every weekly report sheet
+WEEKLY_REPORT_FOLDER_ID = '1w-41nhWBFJFjWGXTT4WOTfSbbN-GVbyx'
+# files per Drive list page, 1000 is the maximum the api allows
+DRIVE_PAGE_SIZE = 1000
 
 def get_values(spreadsheet_id: 'str', range_name: 'str', creds: 'Credentials') -> 'list[list[str]]':
     """
@@ -49,12 +48,10 @@ def get_values(spreadsheet_id: 'str', range_name: 'str', creds: 'Credentials') -
         The value of the cells you retrived
     """
     try:
-        service = build('sheets', 'v4', credentials=creds)
-
         # Call the Sheets API
-        sheet = service.spreadsheets()
-        result = sheet.values().get(spreadsheetId=spreadsheet_id,
-                                    range=range_name).execute()
+        values_resource = google_clients.get_resource('sheets', 'v4', 'spreadsheets', 'values')
+        result = values_resource.get(spreadsheetId=spreadsheet_id,
+                                     range=range_name).execute(http=google_clients.get_http(creds))
         values = result.get('values', [])
         
         return values
@@ -62,7 +59,111 @@ def get_values(spreadsheet_id: 'str', range_name: 'str', creds: 'Credentials') -
         print(err)
 
 
-def get_sheet_id(name: 'str', creds: 'Credentials') -> 'str':
+def batch_get_values(spreadsheet_id: 'str', ranges: 'list[str]', creds: 'Credentials') -> 'list[list[list[str]]]':
+    """
+    Get several ranges from a google sheets in a single batchGet request
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The id of the spreadsheet.
+
+    ranges : list[str]
+        Ranges you want to retrieve. example: ['C8:C20', 'D8:F20']
+
+    creds : Credentials
+        Credentials of google api
+
+    Returns
+    -------
+    list[list[list[str]]]
+        The rows of each requested range, in the same order as ranges
+    """
+    values_resource = google_clients.get_resource('sheets', 'v4', 'spreadsheets', 'values')
+
+    # Call the Sheets API once for all ranges
+    result = values_resource.batchGet(spreadsheetId=spreadsheet_id, ranges=ranges,
+                                      fields='valueRanges(values)').execute(http=google_clients.get_http(creds))
+    return [valueRange.get('values', []) for valueRange in result.get('valueRanges', [])]
+
+
+def list_folder_files(folder_id: 'str', creds: 'Credentials', fields: 'str' = 'id, name') -> 'list[dict]':
+    """
+    List every file in a Drive folder, following nextPageToken over all pages
+
+    Parameters
+    ----------
+    folder_id : str
+        The id of the Drive folder.
+
+    fields : str
+        File fields to retrieve, keep it to what is used. example: id, name
+
+    creds : Credentials
+        Credentials of google api
+
+    Returns
+    -------
+    list[dict]
+        One dict per file with the requested fields
+    """
+    files_resource = google_clients.get_resource('drive', 'v3', 'files')
+
+    files = []
+    page_token = None
+    while True:
+        # Call the Drive v3 API
+        results = files_resource.list(
+            q="'" + folder_id + "' in parents and trashed = false",
+            fields="nextPageToken, files(" + fields + ")",
+            pageSize=DRIVE_PAGE_SIZE,
+            pageToken=page_token).execute(http=google_clients.get_http(creds))
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+
+def get_sheet_index(creds: 'Credentials') -> 'dict[str, str]':
+    """
+    List the weekly report folder once and index the sheets by volunteer name
+
+    Parameters
+    ----------
+    creds : Credentials
+        Credentials of google api
+
+    Returns
+    -------
+    dict[str, str]
+        Volunteer name (the part of the file name before the first '-') to sheet id
+    """
+    index = {}
+    for item in list_folder_files(WEEKLY_REPORT_FOLDER_ID, creds):
+        # keep the first file listed for a name, like the linear scan did
+        index.setdefault(item['name'].split('-')[0], item['id'])
+    return index
+
+
+def get_sheet_files(creds: 'Credentials') -> 'dict[str, dict]':
+    """
+    List the weekly report folder once, with what is needed to spot changed sheets
+
+    Parameters
+    ----------
+    creds : Credentials
+        Credentials of google api
+
+    Returns
+    -------
+    dict[str, dict]
+        Sheet id to its Drive file: name (the sheet title), modifiedTime and version
+    """
+    files = list_folder_files(WEEKLY_REPORT_FOLDER_ID, creds, fields='id, name, modifiedTime, version')
+    return {item['id']: item for item in files}
+
+
+def get_sheet_id(name: 'str', creds: 'Credentials', sheet_index: 'dict[str, str]' = None) -> 'str':
     """
     Get the weekly report sheets id by name and credentials
 
@@ -73,26 +174,20 @@ def get_sheet_id(name: 'str', creds: 'Credentials') -> 'str':
 
     creds : Credentials
         Credentials of google api
-    
+
+    sheet_index : dict[str, str]
+        Index returned by get_sheet_index, pass it when looking up several names
+        so the folder is only listed once. Listed on every call when omitted.
+
     Returns
     -------
     str
         The weekly report sheets id
     """
     try:
-        service = build('drive', 'v3', credentials=creds)
-
-        # Call the Drive v3 API
-        results = service.files().list(
-            q="'1w-41nhWBFJFjWGXTT4WOTfSbbN-GVbyx' in parents", fields="nextPageToken, files(id, name)").execute()
-        items = results.get('files', [])
-        
-        for item in items:
-            cur_name = item['name'].split('-')[0]
-            if cur_name == name:
-                return item['id']
-            
-        return 'No files found.'
+        if sheet_index is None:
+            sheet_index = get_sheet_index(creds)
+        return sheet_index.get(name, 'No files found.')
     except HttpError as err:
         print(err)
 
@@ -121,20 +216,124 @@ def update_values(spreadsheet_id: 'str', range_name: 'str', value_input_option:
     
     try:
 
-        service = build('sheets', 'v4', credentials=creds)
+        values_resource = google_clients.get_resource('sheets', 'v4', 'spreadsheets', 'values')
         body = {
             'values': values
         }
-        result = service.spreadsheets().values().update(
+        result = values_resource.update(
             spreadsheetId=spreadsheet_id, range=range_name,
-            valueInputOption=value_input_option, body=body).execute()
+            valueInputOption=value_input_option, body=body).execute(http=google_clients.get_http(creds))
         print(f"{result.get('updatedCells')} cells updated.")
     except HttpError as error:
         print(f"An error occurred: {error}")
         return error
 
 
-def get_volunteer_info(mainTrackingForm_id: 'str', creds: 'Credentials') -> 'list[list[str]]':
+def batch_update_values(spreadsheet_id: 'str', data: 'list[tuple[str, list[list[str]]]]', value_input_option: 'str', creds: 'Credentials'):
+    """
+    Write several ranges of a google sheets in one request
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The id of the spreadsheet.
+
+    data : list[tuple[str, list[list[str]]]]
+        (range name, values) pairs to write. example: ("Sheet1!G2", [["id"]])
+
+    value_input_option : str
+        How we want to input our value
+
+    creds : Credentials
+        Credentials of google api
+    """
+    if not data:
+        return
+
+    try:
+        values_resource = google_clients.get_resource('sheets', 'v4', 'spreadsheets', 'values')
+        body = {
+            'valueInputOption': value_input_option,
+            'data': [{'range': range_name, 'values': values} for range_name, values in data]
+        }
+        result = values_resource.batchUpdate(
+            spreadsheetId=spreadsheet_id, body=body).execute(http=google_clients.get_http(creds))
+        print(f"{result.get('totalUpdatedCells')} cells updated.")
+    except HttpError as error:
+        print(f"An error occurred: {error}")
+        return error
+
+
+def column_letter(index: 'int') -> 'str':
+    """Return the A1 letters of a 0-based column index. example: 0 -> A, 27 -> AB"""
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def update_changed_values(spreadsheet_id: 'str', tab: 'str', firstColumn: 'int', rows: 'dict[int, list[str]]',
+                          creds: 'Credentials', current: 'list[list[str]]' = None) -> 'int':
+    """
+    Write rows of cells, sending only the cells that differ from the sheet
+
+    The current values are read with one request (unless given) and every
+    changed cell is written with one batchUpdate, so a run that changes
+    nothing writes nothing. Values are written RAW and compared as the
+    strings the api returns.
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The id of the spreadsheet.
+
+    tab : str
+        Name of the tab. example: OPT subscription tracking
+
+    firstColumn : int
+        0-based column of the first value of every row. example: 7 for H
+
+    rows : dict[int, list[str]]
+        Sheet row (1-based) to the values of its cells from firstColumn
+
+    creds : Credentials
+        Credentials of google api
+
+    current : list[list[str]]
+        Values the sheet holds in those columns, from row 1, as already read
+        (see roster_snapshot); None to read them
+
+    Returns
+    -------
+    int
+        Number of cells written, None if the current values could not be read
+        or the cells could not be written
+    """
+    if not rows:
+        return 0
+    width = max(len(values) for values in rows.values())
+    if current is None:
+        current = get_values(spreadsheet_id, "'{0}'!{1}1:{2}".format(tab, column_letter(firstColumn),
+                                                                    column_letter(firstColumn + width - 1)), creds)
+    if current is None:
+        return None
+
+    data = []
+    for row, values in sorted(rows.items()):
+        existing = current[row - 1] if row <= len(current) else []
+        for offset, value in enumerate(values):
+            if str(value) != (existing[offset] if offset < len(existing) else ''):
+                data.append(("'{0}'!{1}{2}".format(tab, column_letter(firstColumn + offset), row), [[str(value)]]))
+
+    if batch_update_values(spreadsheet_id, data, "RAW", creds) is not None:
+        return None
+    return len(data)
+
+
+def get_volunteer_info(mainTrackingForm_id: 'str', creds: 'Credentials',
+                       snapshot: 'roster_snapshot.RosterSnapshot' = None) -> 'list[roster.Volunteer]':
     """
     Return the formated information retrieved from the main tracking google sheet for all active volunteers.
 
@@ -146,65 +345,59 @@ def get_volunteer_info(mainTrackingForm_id: 'str', creds: 'Credentials') -> 'lis
     creds : Credentials
         Credentials of google api
 
+    snapshot : roster_snapshot.RosterSnapshot
+        Tracking sheet already read this run, None to read it
+
     Returns
     -------
-    list[list[str]]
-        Information for each active volunteers in format:
+    list[roster.Volunteer]
+        Information for each active volunteers, indexable like the former format:
         [Name, Email, Start Week, Start Monday, Start Date, End Date, Sheet URL ID]
+        plus the number of weeks due
     """
-    service = build('sheets', 'v4', credentials=creds)
-    sheet = service.spreadsheets()
+    if snapshot is not None:
+        return snapshot.volunteers(get_current_monday())
 
     # Access the form and retrieve all data
     mainTrackingFormData = get_values(mainTrackingForm_id, "'OPT subscription tracking'!A2:G", creds)
 
-    volunteerInfo = []
-    for formData in mainTrackingFormData:
-
-        renewed = 0
-        if (formData[1] != ""):
-            renewed = int(formData[1])
+    # Every volunteer is computed at once, see roster
+    return roster.build_roster(mainTrackingFormData, get_current_monday())
 
-        if (renewed >= 0):
-            name = formData[4]
-            email = formData[5]
 
-            endDate = formData[3].split('/')
-            endDateFormated = datetime.date(int(endDate[2]), int(endDate[0]), int(endDate[1]))
-
-            # [Year, Week Number, Weekday (1 - 7)]
-            endDateWeekInfo = endDateFormated.isocalendar()
-
-            # Calculate the start date based on end date and renewed times
-            startDateFormated = (endDateFormated - 
-                                    dateDelta.relativedelta(months = (renewed + 1) * 3) + 
-                                    dateDelta.relativedelta(days = 1))
-            startDateWeekInfo = startDateFormated.isocalendar()
-            startDateAsWeekday = startDateWeekInfo[2]
+def get_current_monday() -> 'datetime.date':
+    """
+    Return the Monday after today, the verification covers every week before it
 
-            # Temperary Solution:   Some people will delay their start week to the week after their start date week
-            #                       i.e., start at Wed/Fri, but start record by next Mon (week)
-            deltaFromStartDateToClosestMonday = (1 if startDateAsWeekday < 3 else 8) - startDateAsWeekday
-            mondayAtStartWeek = startDateFormated + dateDelta.relativedelta(days = deltaFromStartDateToClosestMonday)
-            startWeekInfo = mondayAtStartWeek.isocalendar()
+    Returns
+    -------
+    datetime.date
+        Monday of next week
+    """
+    currentDate = datetime.date.today()
+    return currentDate + dateDelta.relativedelta(days = 8 - currentDate.isocalendar()[2])
 
-            sheetURL = formData[6]
 
-            # Format the volunteer information
-            info = [name,
-                    email,
-                    startWeekInfo,
-                    mondayAtStartWeek.strftime(dateFormat),
-                    startDateFormated.strftime(dateFormat),
-                    endDateFormated.strftime(dateFormat),
-                    sheetURL]
+def get_working_weeks(startMonday: 'str') -> 'int':
+    """
+    Return the number of weeks from the start Monday up to and including the current week
 
-            volunteerInfo.append(info)
+    Parameters
+    ----------
+    startMonday : str
+        Start Monday of the volunteer, as in the volunteer information
 
-    return volunteerInfo
+    Returns
+    -------
+    int
+        Number of weeks a report row is expected for
+    """
+    startMonday = datetime.datetime.strptime(startMonday, dateFormat).date()
+    return int((get_current_monday() - startMonday).days / 7)
 
 
-def verify_weekly_report(volunteerInfo: 'list[str]', spreadsheet_id: 'str', creds: 'Credentials') -> bool:
+def verify_weekly_report(volunteerInfo: 'list[str]', spreadsheet_id: 'str', creds: 'Credentials', title: 'str' = None,
+                         verifiedWeeks: 'int' = 0) -> 'report_validation.ValidationResult':
     """
     Verfiy the validity for a given weekly report sheet:
 
@@ -212,7 +405,7 @@ def verify_weekly_report(volunteerInfo: 'list[str]', spreadsheet_id: 'str', cred
     2. Records should match the activity period (start/end date).
     3. Record for each week should be unique.
 
-    TODO: Update the verification logic after confirming the sheet format
+    The checks are made by report_validation on the rows after verifiedWeeks.
 
     Parameters
     ----------
@@ -226,52 +419,80 @@ def verify_weekly_report(volunteerInfo: 'list[str]', spreadsheet_id: 'str', cred
     creds : Credentials
         Credentials of google api
 
+    title : str
+        Title of the sheet, as listed by get_sheet_files. When omitted it is
+        read from the sheet with an extra request.
+
+    verifiedWeeks : int
+        Number of weeks, from the start week, already verified on an earlier run.
+        Only the rows after them are fetched and checked.
+
     Returns
     -------
-    bool
-        Boolean indicates if the given report sheet is valid with given volunteer information
+    report_validation.ValidationResult
+        Weeks missing, out of the volunteer's term and recorded twice, and the
+        records copying another one (see duplicate_index.get_duplicates).
+        None if the sheet could not be read
     """
     try:
-        service = build('sheets', 'v4', credentials=creds)
-        sheet = service.spreadsheets()
-
-        # Retrieve the basic information of the volunteer
-        weeklyReport = sheet.get(spreadsheetId = spreadsheet_id).execute()
+        if title is None:
+            spreadsheets = google_clients.get_resource('sheets', 'v4', 'spreadsheets')
+            # Only ask for the title, not the metadata of every tab
+            title = spreadsheets.get(spreadsheetId = spreadsheet_id, fields = 'properties.title').execute(
+                http=google_clients.get_http(creds))['properties']['title']
 
         # Verify if we are on the correct sheet
-        volunteerName = weeklyReport['properties']['title'].split('-')[0]
+        volunteerName = title.split('-')[0]
         if volunteerName != volunteerInfo[0]:
             raise Exception("Given volunteer name doesn't match with name on given sheet!")
 
-        currentDate = datetime.date.today()
-        currentMonday = currentDate + dateDelta.relativedelta(days = 8 - currentDate.isocalendar()[2])
-
+        workingWeeksByStartEndDate = get_working_weeks(volunteerInfo[3])
+        # the current week can still be filled in, the ones before it are due
+        dueWeeks = workingWeeksByStartEndDate - 1
+        # weeks whose Monday falls in the term, and not after the current week
         startMonday = datetime.datetime.strptime(volunteerInfo[3], dateFormat).date()
+        endDate = datetime.datetime.strptime(volunteerInfo[5], dateFormat).date()
+        windowWeeks = min((endDate - startMonday).days // 7 + 1, workingWeeksByStartEndDate)
 
-        workingWeeksByStartEndDate = int((currentMonday - startMonday).days / 7)
+        # The weeks before the watermark were fine last time, nothing to fetch
+        if verifiedWeeks >= workingWeeksByStartEndDate:
+            return report_validation.ValidationResult(verifiedWeeks + 1, dueWeeks)
 
 
-        # Start checking the report content
+        # Start checking the report content, from the first week not verified yet
 
         startWeekNumColumn = 'C'
-        startWeekNumRow = 8
-        endWeekNumRow = startWeekNumRow + workingWeeksByStartEndDate - 1
+        startWeekNumRow = 8 + verifiedWeeks
+        endWeekNumRow = 8 + workingWeeksByStartEndDate - 1
 
         startRecordColumn = 'D'
         endRecordColumn = 'F'
-        startRecordRow = 8
-        endRecordRow = startRecordRow + workingWeeksByStartEndDate - 1
+        startRecordRow = 8 + verifiedWeeks
+        endRecordRow = 8 + workingWeeksByStartEndDate - 1
 
         weekNumGrid = startWeekNumColumn + str(startWeekNumRow) + ':' + startWeekNumColumn + str(endWeekNumRow)
         recordGrid = startRecordColumn + str(startRecordRow) + ':' + endRecordColumn + str(endRecordRow)
 
-        rawWeekInfo = get_values(spreadsheet_id, weekNumGrid, creds)
-        rawRecordInfo = get_values(spreadsheet_id, recordGrid, creds)
-
-        for week, record in zip(rawWeekInfo, rawRecordInfo):
-            print(week, " ", record)
-
-        return True
+        # Week numbers and records come back from the same request
+        rawWeekInfo, rawRecordInfo = batch_get_values(spreadsheet_id, [weekNumGrid, recordGrid], creds)
+
+        # Records copied from an earlier week, of this volunteer or another one; the
+        # week of a row is counted from the volunteer's start, Mondays compare across sheets
+        duplicates = duplicate_index.add_records(
+            spreadsheet_id, [(row, (startMonday + datetime.timedelta(weeks=row - 8)).isoformat(), ' '.join(record))
+                             for row, record in enumerate(rawRecordInfo, startRecordRow)])
+        for row, original in duplicates.items():
+            print(f"Row {row} duplicates {original}")
+
+        result = report_validation.validate(rawWeekInfo, rawRecordInfo, verifiedWeeks + 1, dueWeeks, windowWeeks,
+                                            duplicates)
+        if result.missingWeeks:
+            print(f"Weeks missing: {result.missingWeeks}")
+        if result.outOfWindowWeeks:
+            print(f"Weeks out of the term: {result.outOfWindowWeeks}")
+        if result.duplicateWeeks:
+            print(f"Weeks recorded twice: {result.duplicateWeeks}")
+        return result
     
     except HttpError as err:
         print(err)
@@ -289,16 +510,12 @@ def send_email(to_email: 'str', to_name: 'str', duplicate: 'bool'):
     duplicate: bool
         Whether the email is a reminder of duplicate content
     """
+    from email.mime.text import MIMEText
+
     # SMTP settings
-    smtp_server = 'smtp.gmail.com'
-    smtp_port = 587
     smtp_username = email_data.USER
     smtp_password = email_data.PASSWORD
 
-    # IMAP settings
-    mail = imaplib.IMAP4_SSL('imap.gmail.com')
-    mail.login(smtp_username, smtp_password)
-    mail.select('inbox')
     if duplicate:
         reply_body = ("Hi " + to_name + ",\n\n" + 
                             "Our weekly scanning system identifies that you have duplicate check-in contents in your weekly report, please DO NOT copy any weekly work content, please input new contents that summarizes your work.\n\n" +
@@ -312,10 +529,5 @@ def send_email(to_email: 'str', to_name: 'str', duplicate: 'bool'):
     reply_msg['To'] = to_email
     reply_msg['Subject'] = 'Reminder for your Weekly Report'
 
-    with smtplib.SMTP(smtp_server, smtp_port) as server:
-        server.starttls()
-        server.login(smtp_username, smtp_password)
-        server.sendmail(smtp_username, to_email, reply_msg.as_string())
-        
-    mail.close()
-    mail.logout()
+    # Reuse the session shared by every reminder of this run
+    mail_transport.get_transport(smtp_username, smtp_password).send(to_email, reply_msg)
@@ -1,83 +1,264 @@
 from __future__ import print_function
 
-import os.path
-
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import OAuth_function
+import credentials_manager
+import duplicate_index
+import instrumentation
+import rate_limiter
+import roster_snapshot
+import verification_store
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive.metadata.readonly']
 
 SPREADSHEET_ID = '1zM-9tdsbCMwqEdGILtiHE6WPUMCkpEk5kdKcYBAICA4'
-RANGE_NAME = 'OPT subscription tracking!A:G'
+TRACKING_TAB = 'OPT subscription tracking'
+
+# verification status written back next to every volunteer, from column H on
+STATUS_COLUMN = 7
+STATUS_HEADER = ['Report Status', 'Weeks Missing', 'Copied Records', 'Verified Through', 'Reminders Sent']
+
+# last column of the tracking tab a run reads: the volunteers (A:G) and their status
+TRACKING_LAST_COLUMN = OAuth_function.column_letter(STATUS_COLUMN + len(STATUS_HEADER) - 1)
 
+# number of weekly report sheets verified at the same time
+VERIFY_WORKERS = 8
 
-def update_OPT_tracking_sheet(creds: 'Credentials'):
+
+def update_OPT_tracking_sheet(creds: 'Credentials', snapshot: 'roster_snapshot.RosterSnapshot'):
     """
     Update the volunteer information in the OPT tracking sheet,
     specifically the URL ID of each weekly report sheet for each volunteer
+
+    The ids are backfilled in snapshot too, so the verification sees them.
     """
 
     #Get information from OPT subscription tracking sheets
-    values = OAuth_function.get_values(SPREADSHEET_ID, RANGE_NAME, creds)[1:]
-    
+    values = snapshot.columns(0, 6)[1:]
+
+    # the weekly report folder is listed at most once, and only if an id is missing
+    sheet_index = None
+    missing = []
+
     #loop into each person
     for row, person in enumerate(values):
         #get name and day
         month, day, year, name = person[0].split('-')
 
         #add sheet id if miss
-        if len(person) <= 6 or person[6] == "No files found.":
-            cur_id = OAuth_function.get_sheet_id(name, creds)
-            OAuth_function.update_values(SPREADSHEET_ID,
-                  "OPT subscription tracking!G" + str(row + 2), "USER_ENTERED",
-                  [[cur_id]], creds)
+        if len(person) <= 6 or person[6] in ("", "No files found."):
+            if sheet_index is None:
+                sheet_index = OAuth_function.get_sheet_index(creds)
+            cur_id = OAuth_function.get_sheet_id(name, creds, sheet_index)
+            missing.append((row + 2, "OPT subscription tracking!G" + str(row + 2), cur_id))
+
+    # every missing cell is written in a single request
+    data = [(range_name, [[cur_id]]) for row, range_name, cur_id in missing]
+    if OAuth_function.batch_update_values(SPREADSHEET_ID, data, "USER_ENTERED", creds) is None:
+        for row, _, cur_id in missing:
+            snapshot.set_cell(row, 6, cur_id)
 
 
-def verify_all_weekly_report(creds: 'Credentials'):
+def verification_status(info: 'roster.Volunteer', result: 'report_validation.ValidationResult') -> 'list[str]':
+    """
+    Return the status columns of a volunteer, see STATUS_HEADER
+
+    Parameters
+    ----------
+    info : roster.Volunteer
+        Information of the volunteer
+
+    result : report_validation.ValidationResult
+        Result of the verification of the weekly report, None if it could not be read
+
+    Returns
+    -------
+    list[str]
+        Problems found, weeks missing, number of records copied, Monday of the
+        last verified week and number of reminders sent, as the strings the sheet returns
+    """
+    if result is None:
+        status = 'Not verified'
+    elif result.ok:
+        status = 'OK'
+    else:
+        problems = [(result.missingWeeks, 'Missing weeks'), (result.outOfWindowWeeks, 'Weeks out of term'),
+                    (result.duplicateWeeks, 'Weeks recorded twice'), (result.copiedRows, 'Copied records')]
+        status = ', '.join(text for found, text in problems if found)
+
+    verifiedWeeks = verification_store.get_watermark(info[6], info[3])
+    verifiedThrough = ''
+    if verifiedWeeks:
+        startMonday = datetime.datetime.strptime(info[3], OAuth_function.dateFormat).date()
+        verifiedThrough = (startMonday + datetime.timedelta(weeks=verifiedWeeks - 1)).strftime(OAuth_function.dateFormat)
+    return [status,
+            ', '.join(str(week) for week in result.missingWeeks) if result is not None else '',
+            str(len(duplicate_index.get_duplicates(info[6]))),
+            verifiedThrough,
+            str(verification_store.get_reminders(info[6]))]
+
+
+def verify_all_weekly_report(creds: 'Credentials', workers: 'int' = VERIFY_WORKERS,
+                             snapshot: 'roster_snapshot.RosterSnapshot' = None):
     """
     Retrieve formated volunteer information from the main OPT tracking sheet,
     and verify the weekly report sheet for each volunteer.
 
-    TODO: Update the verification logic after confirming the sheet format
+    The sheets are verified by a pool of workers sharing the google api
+    clients, each on its own HTTP connection; results are reported in the
+    order of the tracking sheet. Sheets that did not change on Drive since
+    their last verification this week reuse the result kept in
+    verification_store.
+
+    The status of every volunteer is then written back to the tracking sheet
+    (see STATUS_HEADER), only the cells that changed and in one request. Rows
+    no longer in the active roster get their status cleared. Nothing is
+    written unless the status columns start with our header, or are empty.
+
+    Parameters
+    ----------
+    creds : Credentials
+        Credentials of google api
+
+    workers : int
+        Number of weekly report sheets verified at the same time
+
+    snapshot : roster_snapshot.RosterSnapshot
+        Tracking sheet read at the start of the run, None to read it here
     """
+    if snapshot is None:
+        snapshot = roster_snapshot.RosterSnapshot.load(SPREADSHEET_ID, TRACKING_TAB, TRACKING_LAST_COLUMN, creds)
+        if snapshot is None:
+            return
 
     # Retrieve all volunteer information from the main tracking form
-    volunteerInfo = OAuth_function.get_volunteer_info(SPREADSHEET_ID, creds)
-    for info in volunteerInfo:
+    volunteerInfo = OAuth_function.get_volunteer_info(SPREADSHEET_ID, creds, snapshot)
+
+    # One folder listing gives the title and the version of every sheet, so
+    # each changed sheet is read with a single request and the others not at all
+    files = OAuth_function.get_sheet_files(creds)
+    currentMonday = OAuth_function.get_current_monday().strftime(OAuth_function.dateFormat)
+
+    def verify(info):
+        # only the weeks after the last fully verified one are read; a sheet that
+        # fails (renamed, timed out) is reported as not verified, the others go on
+        try:
+            return OAuth_function.verify_weekly_report(info, info[6], creds, files.get(info[6], {}).get('name'),
+                                                       verification_store.get_watermark(info[6], info[3]))
+        except Exception as err:
+            print("Could not verify the weekly report of {0}: {1}".format(info[0], err))
+            return None
+
+    # records of sheets removed from the folder are no originals any more
+    if files:
+        duplicate_index.remove_sheets(duplicate_index.get_sheets() - set(files))
+
+    cached = [verification_store.get_cached_result(info[6], files.get(info[6]), info[3], currentMonday)
+              for info in volunteerInfo]
+    changed = [info for info, result in zip(volunteerInfo, cached) if result is None]
+    print(f"{len(volunteerInfo) - len(changed)} weekly reports unchanged, {len(changed)} to verify.")
+
+    statuses = {1: STATUS_HEADER}
+
+    # which of two similar records is the copy depends on every sheet indexed,
+    # so the results are only looked at once all the sheets are verified
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # map keeps the order of volunteerInfo whatever order the sheets finish in
+        results = iter(list(executor.map(verify, changed)))
+
+    for info, result in zip(volunteerInfo, cached):
+        verified = result is None
+        if verified:
+            result = next(results)
+        # a sheet that could not be read is tried again next run
+        if result is not None:
+            copied = duplicate_index.get_duplicates(info[6])
+            flagsChanged = copied != (result.copiedRows or {})
+            if flagsChanged:
+                result = result._replace(copiedRows=copied)
+            if verified or flagsChanged:
+                verification_store.record_result(info[6], files.get(info[6]), info[3], currentMonday, result)
+            if verified:
+                # remind the volunteer once per change of the sheet, or per week
+                # while weeks are missing, of every problem found
+                for duplicate in result.reminders():
+                    OAuth_function.send_email(info[1], info[0], duplicate)
+                    verification_store.record_reminder(info[6])
+            # the current week can still be filled in, every week before it is done;
+            # a failing sheet keeps its watermark so a fix is picked up
+            if result.ok:
+                verification_store.set_watermark(info[6], info[3], info.weeksDue - 1)
+            elif copied:
+                # a record can become a copy after its week was verified, when a similar
+                # record shows up in an earlier row; its week is read again once edited
+                firstCopiedWeek = min(copied) - 7
+                if firstCopiedWeek <= verification_store.get_watermark(info[6], info[3]):
+                    verification_store.set_watermark(info[6], info[3], firstCopiedWeek - 1)
+        statuses[info.row] = verification_status(info, result)
         print()
         print(info[0])
-        print(OAuth_function.verify_weekly_report(info, info[6], creds))
+        print(result)
+
+    # the columns are ours once they hold our header; before the first write
+    # nothing may be in them, not even below an empty header row
+    block = snapshot.columns(STATUS_COLUMN, STATUS_COLUMN + len(STATUS_HEADER) - 1)
+    if block[:1] != [STATUS_HEADER] and any(any(cells) for cells in block):
+        print("Columns {0}:{1} of the tracking sheet hold something else than the status, "
+              "status not written.".format(OAuth_function.column_letter(STATUS_COLUMN),
+                                           OAuth_function.column_letter(STATUS_COLUMN + len(STATUS_HEADER) - 1)))
+        return
+
+    # volunteers who left the roster keep no stale status
+    for row in range(2, len(snapshot.rows) + 1):
+        statuses.setdefault(row, [''] * len(STATUS_HEADER))
 
+    # the snapshot holds the status columns, nothing is read again to diff them
+    snapshot.update_changed(STATUS_COLUMN, statuses, creds)
 
-def main():
-    creds = None
+
+def main(workers: 'int' = VERIFY_WORKERS, rosterCache: 'str' = None):
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                'credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-
-    update_OPT_tracking_sheet(creds)
-
-    verify_all_weekly_report(creds)
+    creds = credentials_manager.get_credentials(SCOPES)
+    # the scan leaves part of the Sheets quota to the auto reply lookups
+    rate_limiter.set_priority(rate_limiter.BULK)
+
+    # the tracking sheet is read once, every stage works on the same snapshot
+    snapshot = roster_snapshot.RosterSnapshot.load(SPREADSHEET_ID, TRACKING_TAB, TRACKING_LAST_COLUMN, creds,
+                                                  rosterCache)
+    if snapshot is None:
+        print("Could not read the OPT tracking sheet, nothing done.")
+        return
+
+    update_OPT_tracking_sheet(creds, snapshot)
+
+    verify_all_weekly_report(creds, workers, snapshot)
+
+    if rosterCache is not None:
+        # the writes of this run bumped the Drive version, the snapshot already holds them
+        snapshot.save_current(rosterCache, creds)
     
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Update the OPT tracking sheet and verify every weekly report")
+    parser.add_argument('--workers', type=int, default=VERIFY_WORKERS,
+                        help="number of weekly report sheets verified at the same time")
+    parser.add_argument('--metrics', metavar='PATH',
+                        help="write the latency and status of every Sheets, Drive and SMTP call to PATH "
+                             "(Prometheus textfile if it ends in .prom, JSON otherwise)")
+    parser.add_argument('--profile', metavar='PATH', help="run under cProfile and save the stats to PATH")
+    parser.add_argument('--roster-cache', metavar='PATH',
+                        help="keep the tracking sheet in PATH, the next run skips the download if it did not change")
+    args = parser.parse_args()
+
+    with instrumentation.profiled(args.profile):
+        try:
+            main(args.workers, args.roster_cache)
+        finally:
+            if args.metrics:
+                instrumentation.write(args.metrics, 'weekly')
@@ -0,0 +1,91 @@
+"""
+Benchmark of the roster computation behind get_volunteer_info.
+
+Builds a synthetic OPT tracking sheet (end dates spread over several years,
+month ends included, blank and negative renewal counts) and times
+roster.build_roster against the row by row loop it replaced, after checking
+that both give the same volunteers.
+
+Usage: python bench_roster.py [number of rows]
+"""
+
+import datetime
+import random
+import sys
+import timeit
+
+import dateutil.relativedelta as dateDelta
+
+import roster
+
+dateFormat = roster.DATE_FORMAT
+
+
+def synthetic_rows(count: 'int') -> 'list[list[str]]':
+    rng = random.Random(0)
+    first = datetime.date(2021, 1, 1)
+    rows = []
+    for i in range(count):
+        endDate = first + datetime.timedelta(days=rng.randrange(4 * 365))
+        if i % 10 == 0:
+            # month ends exercise the clamping of shorter months
+            endDate = datetime.date(endDate.year, endDate.month, 1) + dateDelta.relativedelta(months=1, days=-1)
+        renewed = rng.choice(["", "0", "1", "2", "3", "4", "-1"])
+        name = "Volunteer{0}".format(i)
+        rows.append([endDate.strftime('%m-%d-%Y-') + name,
+                     renewed,
+                     "",
+                     "{0}/{1}/{2}".format(endDate.month, endDate.day, endDate.year),
+                     name,
+                     "volunteer{0}@example.com".format(i),
+                     "sheet{0}".format(i)])
+    return rows
+
+
+def legacy_volunteer_info(rows: 'list[list[str]]', currentMonday: 'datetime.date') -> 'list[list]':
+    """The loop used before roster, kept here for comparison."""
+    volunteerInfo = []
+    for formData in rows:
+        renewed = 0
+        if (formData[1] != ""):
+            renewed = int(formData[1])
+        if (renewed >= 0):
+            endDate = formData[3].split('/')
+            endDateFormated = datetime.date(int(endDate[2]), int(endDate[0]), int(endDate[1]))
+            startDateFormated = (endDateFormated -
+                                    dateDelta.relativedelta(months = (renewed + 1) * 3) +
+                                    dateDelta.relativedelta(days = 1))
+            startDateAsWeekday = startDateFormated.isocalendar()[2]
+            deltaFromStartDateToClosestMonday = (1 if startDateAsWeekday < 3 else 8) - startDateAsWeekday
+            mondayAtStartWeek = startDateFormated + dateDelta.relativedelta(days = deltaFromStartDateToClosestMonday)
+            volunteerInfo.append([formData[4],
+                                  formData[5],
+                                  tuple(mondayAtStartWeek.isocalendar()),
+                                  mondayAtStartWeek.strftime(dateFormat),
+                                  startDateFormated.strftime(dateFormat),
+                                  endDateFormated.strftime(dateFormat),
+                                  formData[6],
+                                  int((currentMonday - mondayAtStartWeek).days / 7)])
+    return volunteerInfo
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    rows = synthetic_rows(count)
+    currentMonday = datetime.date(2024, 6, 3)
+
+    # both implementations must give the same volunteers
+    assert [list(volunteer[:8]) for volunteer in roster.build_roster(rows, currentMonday)] == \
+        legacy_volunteer_info(rows, currentMonday)
+
+    cases = [
+        ('legacy loop', lambda: legacy_volunteer_info(rows, currentMonday)),
+        ('roster', lambda: roster.build_roster(rows, currentMonday)),
+    ]
+    for label, run in cases:
+        best = min(timeit.repeat(run, number=1, repeat=3))
+        print('{0:<12} {1:9.1f} ms  {2:6.2f} us/row'.format(label, best * 1000, best * 1e6 / count))
+
+
+if __name__ == '__main__':
+    main()
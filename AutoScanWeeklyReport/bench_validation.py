@@ -0,0 +1,84 @@
+"""
+Benchmark of the weekly report validation behind verify_weekly_report.
+
+Builds synthetic report grids covering one to five years of weeks (weeks
+left blank, relabelled twice, numbered past the term, "Week n" labels) and
+times report_validation.validate, a single pass over the rows, against
+running each check as its own linear pass (labels first, then a set lookup
+per week), after checking that both find the same weeks.
+
+Usage: python bench_validation.py [number of sheets]
+"""
+
+import random
+import sys
+import timeit
+
+import report_validation
+
+MAX_YEARS = 5
+
+
+def synthetic_sheet(rng: 'random.Random') -> 'tuple':
+    weeks = rng.randint(52, 52 * MAX_YEARS)
+    weekRows, recordRows = [], []
+    for week in range(1, weeks + 1):
+        roll = rng.random()
+        if roll < 0.03:
+            weekRows.append([str(week)])
+            recordRows.append([])
+            continue
+        if roll < 0.05:
+            label = str(rng.randint(1, week))
+        elif roll < 0.06:
+            label = str(weeks + rng.randint(1, 10))
+        elif roll < 0.3:
+            label = 'Week {0}'.format(week)
+        else:
+            label = str(week)
+        weekRows.append([label])
+        recordRows.append(['worked on week {0}'.format(week), 'with the team', ''])
+    # the window ends a little before the last rows, the last week is not due yet
+    return weekRows, recordRows, 1, weeks - 1, weeks - rng.randint(0, 4)
+
+
+def check_by_check(weekRows, recordRows, firstWeek, dueWeeks, windowWeeks):
+    """Run each check as its own linear pass over the week labels, with a set for lookups."""
+    labels = [report_validation.normalize_week(cell, position) if any(part.strip() for part in record) else None
+              for position, (cell, record) in enumerate(zip(weekRows, recordRows), firstWeek)]
+    labelled = set(labels)
+    missing = [week for week in range(firstWeek, min(dueWeeks, windowWeeks) + 1) if week not in labelled]
+    outOfWindow = [week for week in labels if week is not None and not 1 <= week <= windowWeeks]
+    seen, duplicates = set(), {}
+    for week in labels:
+        if week is None or not 1 <= week <= windowWeeks:
+            continue
+        if week < firstWeek or week in seen:
+            duplicates[week] = None
+        seen.add(week)
+    return tuple(missing), tuple(outOfWindow), tuple(duplicates)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rng = random.Random(0)
+    sheets = [synthetic_sheet(rng) for _ in range(count)]
+    rows = sum(len(sheet[0]) for sheet in sheets)
+
+    # both must find the same weeks
+    for sheet in sheets:
+        result = report_validation.validate(*sheet)
+        assert (result.missingWeeks, result.outOfWindowWeeks, result.duplicateWeeks) == check_by_check(*sheet)
+
+    cases = [
+        ('check by check', lambda: [check_by_check(*sheet) for sheet in sheets]),
+        ('validate', lambda: [report_validation.validate(*sheet) for sheet in sheets]),
+    ]
+    print('{0} sheets, {1} rows'.format(count, rows))
+    for label, run in cases:
+        best = min(timeit.repeat(run, number=1, repeat=3))
+        print('{0:<16} {1:9.1f} ms  {2:6.2f} us/row'.format(label, best * 1000, best * 1e6 / rows))
+
+
+if __name__ == '__main__':
+    main()
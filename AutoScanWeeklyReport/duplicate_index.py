@@ -0,0 +1,301 @@
+"""
+Near-duplicate index of the weekly report records (the D:F cells of a row).
+
+Every record is normalized, cut into character shingles and summarized by a
+MinHash signature. The signatures are split into bands and hashed into
+buckets (locality sensitive hashing), so a new record is only compared with
+the few records sharing a bucket with it instead of with every record of
+every volunteer. A candidate counts as a copy when the signatures estimate a
+Jaccard similarity of at least SIMILARITY_THRESHOLD, which also catches
+lightly edited copies.
+
+Records are added incrementally and kept, with their signature, in a small
+SQLite file next to token.json; the buckets are rebuilt in memory from it.
+Of two similar records the one of the earlier calendar week (the Monday
+of its row, see OAuth_function.verify_weekly_report), then of the smaller
+spreadsheet id, is the original and the other one is flagged as its
+duplicate; within a sheet that is the earlier row. The flags only depend on
+the records indexed, not on the order the verification threads add them in:
+adding a record can make it the original of records indexed before it, and
+the copies of an edited or removed record are checked again.
+"""
+
+import hashlib
+import re
+import sqlite3
+import threading
+import zlib
+from collections import defaultdict
+
+import numpy as np
+
+DB_PATH = 'duplicate_index.db'
+
+# characters per shingle
+SHINGLE_SIZE = 5
+# MinHash permutations, BANDS * ROWS_PER_BAND
+NUM_PERM = 64
+BANDS = 16
+ROWS_PER_BAND = NUM_PERM // BANDS
+# estimated Jaccard similarity from which a record is a copy
+SIMILARITY_THRESHOLD = 0.7
+# shorter records ("N/A", "none", ...) are not worth flagging
+MIN_CHARS = 20
+
+# universal hashing (a * x + b) mod p over 32 bit shingle hashes, with a < 2 ** 31
+# so that a * x + b stays within uint64
+_PRIME = np.uint64(4294967311)
+_random = np.random.RandomState(1)
+_A = _random.randint(1, 2 ** 31, size=NUM_PERM).astype(np.uint64)
+_B = _random.randint(0, 2 ** 31, size=NUM_PERM).astype(np.uint64)
+
+_NON_WORD_RE = re.compile(r'[\W_]+')
+
+_connection = None
+# spreadsheet id -> row -> (digest, signature, duplicate of, Monday of its week)
+_records = None
+# band, band values -> (spreadsheet id, row) of the records in that bucket
+_buckets = defaultdict(set)
+# "spreadsheet id!row" of an original -> (spreadsheet id, row) of its copies
+_copies = defaultdict(set)
+# the index is shared by the verification threads
+_lock = threading.RLock()
+
+
+def connect(path: 'str' = DB_PATH) -> 'sqlite3.Connection':
+    """
+    Open (and create if needed) the index, once per process
+
+    Parameters
+    ----------
+    path : str
+        Location of the SQLite file
+
+    Returns
+    -------
+    sqlite3.Connection
+        The shared connection
+    """
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(path, check_same_thread=False)
+        _connection.executescript("""
+            CREATE TABLE IF NOT EXISTS record (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                spreadsheet_id TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                digest TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                duplicate_of TEXT,
+                week TEXT NOT NULL,
+                UNIQUE (spreadsheet_id, row)
+            );
+        """)
+    return _connection
+
+
+def normalize(text: 'str') -> 'str':
+    """Lower case the text and reduce punctuation and white space to single spaces."""
+    return _NON_WORD_RE.sub(' ', text.lower()).strip()
+
+
+def signature(text: 'str') -> 'np.ndarray':
+    """
+    Compute the MinHash signature of a normalized record
+
+    Parameters
+    ----------
+    text : str
+        Normalized record, see normalize
+
+    Returns
+    -------
+    np.ndarray
+        NUM_PERM minimum hash values (uint64)
+    """
+    shingles = {text[i:i + SHINGLE_SIZE] for i in range(max(1, len(text) - SHINGLE_SIZE + 1))}
+    hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    return ((_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME).min(axis=1)
+
+
+def _bands(sig: 'np.ndarray'):
+    for band in range(BANDS):
+        yield band, sig[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].tobytes()
+
+
+def _order(record: 'tuple[str, int]') -> 'tuple[str, str, int]':
+    # of two similar records the smaller one is the original; the week grows
+    # with the row within a sheet, across sheets the rows are not comparable
+    spreadsheet_id, row = record
+    return _records[spreadsheet_id][row][3], spreadsheet_id, row
+
+
+def _name(record: 'tuple[str, int]') -> 'str':
+    return record[0] + '!' + str(record[1])
+
+
+def _parse_name(name: 'str') -> 'tuple[str, int]':
+    spreadsheet_id, _, row = name.rpartition('!')
+    return spreadsheet_id, int(row)
+
+
+def _similar(sig: 'np.ndarray', record: 'tuple[str, int]') -> 'list[tuple[str, int]]':
+    candidates = set()
+    for bucket in _bands(sig):
+        candidates |= _buckets.get(bucket, set())
+    candidates.discard(record)
+    return [(spreadsheet_id, row) for spreadsheet_id, row in candidates
+            if np.count_nonzero(sig == _records[spreadsheet_id][row][1]) >= SIMILARITY_THRESHOLD * NUM_PERM]
+
+
+def _find_original(sig: 'np.ndarray', record: 'tuple[str, int]') -> 'str':
+    earlier = [other for other in _similar(sig, record) if _order(other) < _order(record)]
+    return _name(min(earlier, key=_order)) if earlier else None
+
+
+def _set_duplicate(conn: 'sqlite3.Connection', record: 'tuple[str, int]', duplicate_of: 'str'):
+    spreadsheet_id, row = record
+    digest, sig, previous, week = _records[spreadsheet_id][row]
+    if previous == duplicate_of:
+        return
+    if previous is not None:
+        _copies[previous].discard(record)
+    if duplicate_of is not None:
+        _copies[duplicate_of].add(record)
+    _records[spreadsheet_id][row] = (digest, sig, duplicate_of, week)
+    conn.execute('UPDATE record SET duplicate_of = ? WHERE spreadsheet_id = ? AND row = ?',
+                 (duplicate_of, spreadsheet_id, row))
+
+
+def _load():
+    global _records
+    if _records is not None:
+        return
+    _records = defaultdict(dict)
+    conn = connect()
+    rows = conn.execute('SELECT spreadsheet_id, row, digest, signature, duplicate_of, week FROM record')
+    for spreadsheet_id, row, digest, blob, duplicate_of, week in rows:
+        sig = np.frombuffer(blob, dtype=np.uint64)
+        _records[spreadsheet_id][row] = (digest, sig, duplicate_of, week)
+        if duplicate_of is not None:
+            _copies[duplicate_of].add((spreadsheet_id, row))
+        for bucket in _bands(sig):
+            _buckets[bucket].add((spreadsheet_id, row))
+
+
+def _remove(conn: 'sqlite3.Connection', spreadsheet_id: 'str', row: 'int'):
+    if row not in _records[spreadsheet_id]:
+        return
+    record = (spreadsheet_id, row)
+    _set_duplicate(conn, record, None)
+    for bucket in _bands(_records[spreadsheet_id].pop(row)[1]):
+        _buckets[bucket].discard(record)
+    conn.execute('DELETE FROM record WHERE spreadsheet_id = ? AND row = ?', record)
+    # its copies may have another original, or none left
+    for copy in list(_copies.pop(_name(record), ())):
+        _set_duplicate(conn, copy, _find_original(_records[copy[0]][copy[1]][1], copy))
+
+
+def _add(conn: 'sqlite3.Connection', spreadsheet_id: 'str', row: 'int', week: 'str', text: 'str') -> 'str':
+    text = normalize(text)
+    if len(text) < MIN_CHARS:
+        _remove(conn, spreadsheet_id, row)
+        return None
+
+    digest = hashlib.sha1(text.encode()).hexdigest()
+    record = _records[spreadsheet_id].get(row)
+    if record is not None:
+        if record[0] == digest and record[3] == week:
+            # unchanged since it was indexed, its flag is kept up to date by _add and _remove
+            return record[2]
+        # an edited record, or one whose week moved with the start Monday, is indexed again as a new one
+        _remove(conn, spreadsheet_id, row)
+
+    sig = signature(text)
+    record = (spreadsheet_id, row)
+    conn.execute('INSERT INTO record (spreadsheet_id, row, digest, signature, week) VALUES (?, ?, ?, ?, ?)',
+                 (spreadsheet_id, row, digest, sig.tobytes(), week))
+    _records[spreadsheet_id][row] = (digest, sig, None, week)
+    _set_duplicate(conn, record, _find_original(sig, record))
+    # records indexed before this one may now have it as their original
+    for other in _similar(sig, record):
+        current = _records[other[0]][other[1]][2]
+        if _order(record) < _order(other) and (current is None or _order(record) < _order(_parse_name(current))):
+            _set_duplicate(conn, other, _name(record))
+    for bucket in _bands(sig):
+        _buckets[bucket].add(record)
+    return _records[spreadsheet_id][row][2]
+
+
+def add_records(spreadsheet_id: 'str', records: 'list[tuple[int, str, str]]') -> 'dict[int, str]':
+    """
+    Index the records of a weekly report and tell which ones copy another record
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The Google Sheet URL ID of the weekly report
+
+    records : list[tuple[int, str, str]]
+        (sheet row, Monday of its week as YYYY-MM-DD, content of the record
+        cells) triples, in sheet order
+
+    Returns
+    -------
+    dict[int, str]
+        Sheet row to the record it copies, as "spreadsheet id!row", for the copies
+        only. Records of other sheets added later can still change the flags,
+        see get_duplicates
+    """
+    duplicates = {}
+    # one transaction per sheet
+    with _lock, connect() as conn:
+        _load()
+        for row, week, text in records:
+            original = _add(conn, spreadsheet_id, row, week, text)
+            if original is not None:
+                duplicates[row] = original
+    return duplicates
+
+
+def get_duplicates(spreadsheet_id: 'str') -> 'dict[int, str]':
+    """
+    Return the records of a sheet flagged as copies
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The Google Sheet URL ID of the weekly report
+
+    Returns
+    -------
+    dict[int, str]
+        Sheet row to the record it copies, as "spreadsheet id!row"
+    """
+    with _lock:
+        _load()
+        return {row: record[2] for row, record in _records[spreadsheet_id].items() if record[2] is not None}
+
+
+def remove_sheets(spreadsheet_ids: 'set[str]'):
+    """
+    Drop the records of sheets that are gone, and check their copies again
+
+    Parameters
+    ----------
+    spreadsheet_ids : set[str]
+        The Google Sheet URL IDs of the weekly reports no longer listed
+    """
+    with _lock, connect() as conn:
+        _load()
+        for spreadsheet_id in spreadsheet_ids:
+            for row in list(_records.get(spreadsheet_id, ())):
+                _remove(conn, spreadsheet_id, row)
+            _records.pop(spreadsheet_id, None)
+
+
+def get_sheets() -> 'set[str]':
+    """Return the Google Sheet URL IDs of the weekly reports with records in the index."""
+    with _lock:
+        _load()
+        return {spreadsheet_id for spreadsheet_id, records in _records.items() if records}
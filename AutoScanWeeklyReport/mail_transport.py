@@ -0,0 +1,180 @@
+"""
+Shared SMTP transport for all senders.
+
+Keeps one authenticated SMTP session per account for the whole run instead of
+doing connect + STARTTLS + login for every message. The session is reopened
+transparently when the server drops it, and recycled after a configurable
+number of messages so Gmail never closes it on us mid-batch.
+
+smtplib is only imported once a message is actually sent, runs with nothing
+to send never pay for it.
+
+AutoEmailReply and AutoScanWeeklyReport keep identical copies of this
+module, check_shared_modules.py tells when they drift apart.
+"""
+
+import atexit
+
+import instrumentation
+
+SMTP_SERVER = 'smtp.gmail.com'
+SMTP_PORT = 587
+MAX_MESSAGES_PER_CONNECTION = 50
+
+
+class MailTransport:
+    """
+    A reusable, authenticated SMTP session
+
+    Parameters
+    ----------
+    username : str
+        Account used to log in and as the envelope sender
+
+    password : str
+        Password (app password) of the account
+
+    max_messages_per_connection : int
+        Reconnect after this many messages have been sent on one session
+    """
+
+    def __init__(self, username: 'str', password: 'str',
+                 max_messages_per_connection: 'int' = MAX_MESSAGES_PER_CONNECTION,
+                 server: 'str' = SMTP_SERVER, port: 'int' = SMTP_PORT):
+        self.username = username
+        self.password = password
+        self.max_messages_per_connection = max_messages_per_connection
+        self.server = server
+        self.port = port
+        self._smtp = None
+        self._sent_on_connection = 0
+
+    def _connect(self):
+        import smtplib
+        self.close()
+        with instrumentation.timed('smtp connect'):
+            smtp = smtplib.SMTP(self.server, self.port)
+            smtp.starttls()
+            smtp.login(self.username, self.password)
+        self._smtp = smtp
+        self._sent_on_connection = 0
+
+    def _sendmail(self, smtp: 'smtplib.SMTP', to_email: 'str', msg_str: 'str'):
+        import smtplib
+        with instrumentation.timed('smtp send') as call:
+            call['bytes_sent'] = len(msg_str)
+            try:
+                smtp.sendmail(self.username, to_email, msg_str)
+            except smtplib.SMTPResponseException as err:
+                call['status'] = err.smtp_code
+                raise
+            call['status'] = 250
+
+    def _session(self) -> 'smtplib.SMTP':
+        if self._smtp is None or self._sent_on_connection >= self.max_messages_per_connection:
+            self._connect()
+        return self._smtp
+
+    def send(self, to_email: 'str', message):
+        """
+        Send one message, reconnecting once if the session was dropped
+
+        Parameters
+        ----------
+        to_email : str
+            The email address you want to send email to
+
+        message : email.message.Message
+            The composed message
+        """
+        import smtplib
+        msg_str = message.as_string()
+        try:
+            self._sendmail(self._session(), to_email, msg_str)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException) as err:
+            # 421: the server is closing the session, anything else is a real error
+            if isinstance(err, smtplib.SMTPResponseException) and err.smtp_code != 421:
+                raise
+            self._connect()
+            self._sendmail(self._smtp, to_email, msg_str)
+        self._sent_on_connection += 1
+
+    def send_batch(self, messages: 'list[tuple[str, object]]') -> 'list[bool]':
+        """
+        Send many messages over the pooled session
+
+        Parameters
+        ----------
+        messages : list[tuple[str, email.message.Message]]
+            (to_email, message) pairs
+
+        Returns
+        -------
+        list[bool]
+            Whether each message was sent, in the same order as messages
+        """
+        import smtplib
+        results = []
+        for to_email, message in messages:
+            try:
+                self.send(to_email, message)
+                results.append(True)
+            except smtplib.SMTPException as err:
+                print("Failed to send to " + to_email + ": " + str(err))
+                results.append(False)
+        return results
+
+    def close(self):
+        """Quit the current session, if any."""
+        if self._smtp is None:
+            return
+        import smtplib
+        try:
+            self._smtp.quit()
+        except smtplib.SMTPException:
+            pass
+        self._smtp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_transports = {}
+
+
+def get_transport(username: 'str', password: 'str',
+                  max_messages_per_connection: 'int' = MAX_MESSAGES_PER_CONNECTION) -> 'MailTransport':
+    """
+    Return the transport shared by every sender of this run for the given account
+
+    Parameters
+    ----------
+    username : str
+        Account used to log in and as the envelope sender
+
+    password : str
+        Password (app password) of the account
+
+    max_messages_per_connection : int
+        Reconnect after this many messages have been sent on one session
+
+    Returns
+    -------
+    MailTransport
+        The shared transport, connected lazily on first send
+    """
+    transport = _transports.get(username)
+    if transport is None:
+        transport = MailTransport(username, password, max_messages_per_connection, SMTP_SERVER, SMTP_PORT)
+        _transports[username] = transport
+    return transport
+
+
+@atexit.register
+def close_all():
+    """Close every shared session, called automatically when the run ends."""
+    for transport in _transports.values():
+        transport.close()
@@ -0,0 +1,189 @@
+"""
+Process-wide rate limiter for the Sheets and Drive apis.
+
+Every google api request goes through a token bucket per api and kind of
+request (read for GET, write for everything else) sized from the per-user
+per-minute quota, so a run goes as fast as the quota allows without tripping
+it. A bucket holds BURST_SHARE of the quota and refills with the rest over
+the minute, which keeps any 60 second window within the quota.
+
+Requests answered 429 or 5xx are retried with exponential backoff and full
+jitter (or after Retry-After when the server sends one), up to MAX_RETRIES
+times; a 429 also drains the bucket so the other threads back off with it.
+
+Interactive requests (the reply lookups of AutoEmailReply) go first: bulk
+requests (the weekly report scan, see set_priority) wait while an
+interactive one is waiting, and only ever use 1 - INTERACTIVE_SHARE of the
+quota, leaving the rest to an auto reply run sharing the same account.
+
+AutoEmailReply and AutoScanWeeklyReport keep identical copies of this
+module, check_shared_modules.py tells when they drift apart.
+"""
+
+import random
+import threading
+import time
+import urllib.parse
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# requests per minute per user, (api, kind) -> quota; a missing entry is not limited
+QUOTAS = {
+    ('sheets', 'read'): 60,
+    ('sheets', 'write'): 60,
+    ('drive', 'read'): 12000,
+    ('drive', 'write'): 12000,
+}
+# share of the quota a bucket can spend at once
+BURST_SHARE = 0.25
+# share of the quota bulk requests leave to interactive ones
+INTERACTIVE_SHARE = 0.2
+
+MAX_RETRIES = 6
+MIN_BACKOFF = 1
+MAX_BACKOFF = 64
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+_priority = INTERACTIVE
+
+
+class TokenBucket:
+    """
+    Token bucket shared by every thread of the process
+
+    Parameters
+    ----------
+    per_minute : int
+        Requests allowed per minute
+    """
+
+    def __init__(self, per_minute: 'int'):
+        self.rate = per_minute * (1 - BURST_SHARE) / 60
+        self.capacity = max(1.0, per_minute * BURST_SHARE)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.waiting = {INTERACTIVE: 0, BULK: 0}
+        self.condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority: 'str' = INTERACTIVE) -> 'float':
+        """
+        Wait for the budget of one request
+
+        Parameters
+        ----------
+        priority : str
+            INTERACTIVE or BULK
+
+        Returns
+        -------
+        float
+            Seconds waited
+        """
+        # bulk requests pay more so they only get their share of the quota
+        cost = 1.0 if priority == INTERACTIVE else 1 / (1 - INTERACTIVE_SHARE)
+        started = time.monotonic()
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    self._refill()
+                    yielding = priority == BULK and self.waiting[INTERACTIVE] > 0
+                    if not yielding and self.tokens >= cost:
+                        self.tokens -= cost
+                        return time.monotonic() - started
+                    # woken up early when an interactive request got its token
+                    self.condition.wait(max(cost - self.tokens, 0.1) / self.rate)
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def drain(self, seconds: 'float'):
+        """Hold every request of this bucket for the next seconds."""
+        with self.condition:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+def set_priority(priority: 'str'):
+    """
+    Set the priority of every request of this process
+
+    Parameters
+    ----------
+    priority : str
+        INTERACTIVE (default) or BULK
+    """
+    global _priority
+    _priority = priority
+
+
+def get_bucket(api: 'str', kind: 'str') -> 'TokenBucket':
+    """
+    Return the bucket of a kind of request, None if it is not limited
+
+    Parameters
+    ----------
+    api : str
+        sheets or drive
+
+    kind : str
+        read or write
+    """
+    with _buckets_lock:
+        if (api, kind) not in _buckets:
+            quota = QUOTAS.get((api, kind))
+            _buckets[api, kind] = TokenBucket(quota) if quota else None
+        return _buckets[api, kind]
+
+
+def _backoff(attempt: 'int', response) -> 'float':
+    retry_after = response.get('retry-after')
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return random.uniform(0, min(MAX_BACKOFF, MIN_BACKOFF * 2 ** attempt))
+
+
+def limit_http(http):
+    """
+    Send every request of a google api HTTP connection through the rate limiter
+
+    Parameters
+    ----------
+    http : google_auth_httplib2.AuthorizedHttp
+        The connection, wrapped in place
+
+    Returns
+    -------
+    google_auth_httplib2.AuthorizedHttp
+        The same connection
+    """
+    request = http.request
+
+    def limited_request(uri, method='GET', body=None, *args, **kwargs):
+        api = 'drive' if '/drive/' in urllib.parse.urlsplit(uri).path else 'sheets'
+        bucket = get_bucket(api, 'read' if method == 'GET' else 'write')
+        attempt = 0
+        while True:
+            if bucket is not None:
+                bucket.acquire(_priority)
+            response, content = request(uri, method, body, *args, **kwargs)
+            if response.status not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                return response, content
+            delay = _backoff(attempt, response)
+            print("{0} {1} answered {2}, retrying in {3:.1f}s".format(api, method, response.status, delay))
+            if bucket is not None and response.status == 429:
+                bucket.drain(delay)
+            else:
+                time.sleep(delay)
+            attempt += 1
+
+    http.request = limited_request
+    return http
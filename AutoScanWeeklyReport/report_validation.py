@@ -0,0 +1,144 @@
+"""
+Validation of the rows of a weekly report sheet.
+
+A report row holds the week number in column C and the record of the week
+in D:F. The rows are normalized into the set of the weeks that have a
+record, and the volunteer's term into an interval of weeks, so the three
+checks of a sheet are one pass over its rows plus set lookups:
+
+1. missing weeks: weeks of the term that are over but have no record,
+2. out of window weeks: records labelled with a week outside the term, or
+   after the current week,
+3. duplicate weeks: weeks recorded on more than one row, or again after
+   they were verified on an earlier run. Records copying another record
+   are found by duplicate_index and reported alongside.
+"""
+
+import json
+import re
+from itertools import zip_longest
+from typing import NamedTuple
+
+_NUMBER_RE = re.compile(r'-?\d+')
+
+
+class ValidationResult(NamedTuple):
+    """
+    Outcome of the validation of a weekly report sheet
+    """
+    # weeks (from 1, the start week) that were checked for a record
+    firstWeek: int
+    lastWeek: int
+    missingWeeks: tuple = ()
+    outOfWindowWeeks: tuple = ()
+    duplicateWeeks: tuple = ()
+    # sheet row to the record it copies, as "spreadsheet id!row", see duplicate_index;
+    # None when no copies were looked for, a shared {} default could be mutated
+    copiedRows: dict = None
+
+    @property
+    def ok(self) -> 'bool':
+        return not (self.missingWeeks or self.outOfWindowWeeks or self.duplicateWeeks or self.copiedRows)
+
+    def reminders(self) -> 'list[bool]':
+        """
+        Return the reminders the volunteer should get, as the duplicate flag of send_email
+
+        Returns
+        -------
+        list[bool]
+            True for the copied content reminder, False for the missing check-in one
+        """
+        reminders = []
+        if self.duplicateWeeks or self.copiedRows:
+            reminders.append(True)
+        if self.missingWeeks:
+            reminders.append(False)
+        return reminders
+
+    def to_json(self) -> 'str':
+        return json.dumps(self._asdict())
+
+    @classmethod
+    def from_json(cls, text: 'str') -> 'ValidationResult':
+        fields = json.loads(text)
+        return cls(fields['firstWeek'], fields['lastWeek'],
+                   tuple(fields['missingWeeks']), tuple(fields['outOfWindowWeeks']), tuple(fields['duplicateWeeks']),
+                   {int(row): original for row, original in (fields['copiedRows'] or {}).items()})
+
+
+def normalize_week(cell: 'list[str]', position: 'int') -> 'int':
+    """
+    Return the week number of a report row
+
+    Parameters
+    ----------
+    cell : list[str]
+        The C column of the row, as returned by the api (empty when blank)
+
+    position : int
+        Week the row stands for by its place in the sheet, used when the cell
+        holds no number. example: 1 for row 8
+
+    Returns
+    -------
+    int
+        The first number in the cell ("Week 3" -> 3), else position
+    """
+    if cell:
+        number = _NUMBER_RE.search(cell[0])
+        if number is not None:
+            return int(number.group())
+    return position
+
+
+def validate(weekRows: 'list[list[str]]', recordRows: 'list[list[str]]', firstWeek: 'int', dueWeeks: 'int',
+             windowWeeks: 'int', copiedRows: 'dict[int, str]' = None) -> 'ValidationResult':
+    """
+    Check the rows of a weekly report in one pass
+
+    Parameters
+    ----------
+    weekRows : list[list[str]]
+        Rows of the C column, starting at the row of firstWeek
+
+    recordRows : list[list[str]]
+        Rows of the D:F columns, same rows as weekRows
+
+    firstWeek : int
+        Week of the first row, from 1 for the start week
+
+    dueWeeks : int
+        Last week that is over, every week from firstWeek up to it (and in the
+        window) needs a record
+
+    windowWeeks : int
+        Last week a record can be for: the end of the term, or the current week if earlier
+
+    copiedRows : dict[int, str]
+        Rows copying another record, from duplicate_index.add_records
+
+    Returns
+    -------
+    ValidationResult
+        Weeks missing, out of the window and recorded twice, in sheet order
+    """
+    recorded = set()
+    outOfWindow = []
+    duplicates = {}
+    for position, (weekCell, record) in enumerate(zip_longest(weekRows, recordRows, fillvalue=[]), firstWeek):
+        if not any(cell.strip() for cell in record):
+            continue
+        week = normalize_week(weekCell, position)
+        if not 1 <= week <= windowWeeks:
+            outOfWindow.append(week)
+        elif week in recorded or week < firstWeek:
+            # the weeks before firstWeek were all recorded and verified already;
+            # a dict keeps the order in which the weeks showed up twice
+            duplicates[week] = None
+        else:
+            recorded.add(week)
+
+    missing = tuple(week for week in range(firstWeek, min(dueWeeks, windowWeeks) + 1) if week not in recorded)
+    return ValidationResult(firstWeek, dueWeeks, missing, tuple(outOfWindow), tuple(duplicates),
+                            dict(copiedRows or {}))
@@ -0,0 +1,137 @@
+"""
+Columnar computation of the volunteer roster from the OPT tracking sheet.
+
+The A2:G block is split into columns once. Renewal counts and end dates are
+parsed once per distinct value (a roster shares few of them), then the
+start date, start Monday, ISO week and number of weeks due are computed for
+every volunteer at once with NumPy datetime64 arithmetic. Dates are turned
+back into strings once per distinct date as well.
+"""
+
+import datetime
+import itertools
+from typing import NamedTuple
+
+import numpy as np
+
+DATE_FORMAT = '%m-%d-%y'
+
+# months of volunteering bought by the first term and by every renewal
+TERM_MONTHS = 3
+
+
+class Volunteer(NamedTuple):
+    """
+    One active volunteer of the OPT tracking sheet
+
+    The first seven fields keep the positions of the former list format:
+    [Name, Email, Start Week, Start Monday, Start Date, End Date, Sheet URL ID]
+    """
+    name: str
+    email: str
+    # ISO (year, week, weekday) of the start Monday
+    startWeek: tuple
+    startMonday: str
+    startDate: str
+    endDate: str
+    sheetId: str
+    # weeks from the start Monday up to and including the current week
+    weeksDue: int
+    # row of the volunteer in the tracking sheet
+    row: int
+
+
+def _parse_renewed(value: 'str') -> 'int':
+    return int(value) if value != "" else 0
+
+
+def _parse_date(value: 'str') -> 'np.datetime64':
+    month, day, year = value.split('/')
+    return np.datetime64(datetime.date(int(year), int(month), int(day)), 'D')
+
+
+def _map_unique(values, parse, dtype) -> 'np.ndarray':
+    """Apply parse once per distinct value and spread the results back."""
+    unique, inverse = np.unique(np.asarray(values, dtype=object).astype(str), return_inverse=True)
+    return np.array([parse(value) for value in unique], dtype=dtype)[inverse]
+
+
+def _format_dates(dates: 'np.ndarray') -> 'list[str]':
+    unique, inverse = np.unique(dates, return_inverse=True)
+    formatted = np.array([date.strftime(DATE_FORMAT) for date in unique.astype(object)], dtype=object)
+    return formatted[inverse].tolist()
+
+
+def _subtract_months(dates: 'np.ndarray', months: 'np.ndarray') -> 'np.ndarray':
+    """Go back months from every date, clamping to the last day of shorter months like relativedelta."""
+    monthStart = dates.astype('M8[M]')
+    targetMonth = monthStart - months.astype('m8[M]')
+    dayOfMonth = (dates - monthStart.astype('M8[D]')).astype(int)
+    daysInMonth = ((targetMonth + 1).astype('M8[D]') - targetMonth.astype('M8[D]')).astype(int)
+    return targetMonth.astype('M8[D]') + np.minimum(dayOfMonth, daysInMonth - 1)
+
+
+def build_roster(rows: 'list[list[str]]', currentMonday: 'datetime.date', firstRow: 'int' = 2) -> 'list[Volunteer]':
+    """
+    Compute the information of every active volunteer from the tracking sheet rows
+
+    Parameters
+    ----------
+    rows : list[list[str]]
+        The A2:G values of the OPT tracking sheet
+
+    currentMonday : datetime.date
+        Monday after today, weeks are due up to the week before it
+
+    firstRow : int
+        Sheet row of the first of rows
+
+    Returns
+    -------
+    list[Volunteer]
+        One record per volunteer whose renewal count is not negative, in sheet order
+    """
+    if not rows:
+        return []
+
+    # trailing empty cells are not returned by the api, pad them back
+    columns = list(itertools.zip_longest(*rows, fillvalue=""))
+    columns += [("",) * len(rows)] * (7 - len(columns))
+
+    renewed = _map_unique(columns[1], _parse_renewed, int)
+    active = renewed >= 0
+    renewed = renewed[active]
+
+    endDate = _map_unique(np.asarray(columns[3], dtype=object)[active], _parse_date, 'M8[D]')
+
+    # Calculate the start date based on end date and renewed times
+    startDate = _subtract_months(endDate, (renewed + 1) * TERM_MONTHS) + np.timedelta64(1, 'D')
+
+    # ISO weekday, 1 (Monday) to 7 (Sunday); 1970-01-01 was a Thursday
+    startWeekday = (startDate.astype(int) + 3) % 7 + 1
+
+    # Temperary Solution:   Some people will delay their start week to the week after their start date week
+    #                       i.e., start at Wed/Fri, but start record by next Mon (week)
+    mondayAtStartWeek = startDate + (np.where(startWeekday < 3, 1, 8) - startWeekday).astype('m8[D]')
+
+    # the ISO year and week of a Monday are those of the Thursday after it
+    thursday = mondayAtStartWeek + np.timedelta64(3, 'D')
+    isoYear = thursday.astype('M8[Y]')
+    isoWeek = (thursday - isoYear.astype('M8[D]')).astype(int) // 7 + 1
+    startWeek = zip((isoYear.astype(int) + 1970).tolist(), isoWeek.tolist(), itertools.repeat(1))
+
+    # int() of the former loop truncated towards zero, so does astype
+    weeksDue = ((np.datetime64(currentMonday, 'D') - mondayAtStartWeek).astype(int) / 7).astype(int)
+
+    def select(column):
+        return np.asarray(column, dtype=object)[active].tolist()
+
+    return list(map(Volunteer._make, zip(select(columns[4]),
+                                         select(columns[5]),
+                                         startWeek,
+                                         _format_dates(mondayAtStartWeek),
+                                         _format_dates(startDate),
+                                         _format_dates(endDate),
+                                         select(columns[6]),
+                                         weeksDue.tolist(),
+                                         (np.flatnonzero(active) + firstRow).tolist())))
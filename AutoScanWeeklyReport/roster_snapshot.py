@@ -0,0 +1,210 @@
+"""
+Snapshot of the OPT tracking tab shared by every stage of a run.
+
+The tab is read once, with one batchGet covering the volunteer columns and
+the status columns written back by the scan. The sheet id backfill, the
+roster and the status write-back all work on the same rows, and the writes
+are applied to the snapshot in place so later stages see them.
+
+Optionally the rows are kept in a local JSON cache with their content hash
+and the Drive version of the spreadsheet. The next run compares the
+version with Drive (one metadata request) and reuses the cached rows when
+the sheet did not change and the hash still matches; any edit, ours
+included, bumps the version and the rows are downloaded again.
+"""
+
+import hashlib
+import json
+import os
+
+from googleapiclient.errors import HttpError
+
+import OAuth_function
+import google_clients
+import roster
+
+
+def content_hash(rows: 'list[list[str]]') -> 'str':
+    """Return the SHA-256 of rows, as hex."""
+    return hashlib.sha256(json.dumps(rows, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def get_drive_version(spreadsheet_id: 'str', creds: 'Credentials') -> 'str':
+    """
+    Return the Drive version of a spreadsheet, bumped by every change
+
+    Returns
+    -------
+    str
+        The version, None if Drive could not tell
+    """
+    try:
+        files = google_clients.get_resource('drive', 'v3', 'files')
+        request = files.get(fileId=spreadsheet_id, fields='version')
+        return request.execute(http=google_clients.get_http(creds)).get('version')
+    except HttpError as err:
+        print(err)
+        return None
+
+
+class RosterSnapshot:
+    """
+    Rows of the tracking tab, from row 1 (the header)
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The Google Sheet URL ID of the tracking sheet
+
+    tab : str
+        Name of the tracking tab
+
+    rows : list[list[str]]
+        Values of the tab from A1, trailing empty cells left out like the api does
+
+    version : str
+        Drive version of the spreadsheet the rows were read at
+    """
+
+    def __init__(self, spreadsheet_id: 'str', tab: 'str', rows: 'list[list[str]]', version: 'str' = None):
+        self.spreadsheet_id = spreadsheet_id
+        self.tab = tab
+        self.rows = rows
+        self.version = version
+
+    @classmethod
+    def load(cls, spreadsheet_id: 'str', tab: 'str', lastColumn: 'str', creds: 'Credentials',
+             cache_path: 'str' = None) -> 'RosterSnapshot':
+        """
+        Read the tab once, or reuse the cached rows if the sheet did not change
+
+        Parameters
+        ----------
+        spreadsheet_id : str
+            The Google Sheet URL ID of the tracking sheet
+
+        tab : str
+            Name of the tracking tab. example: OPT subscription tracking
+
+        lastColumn : str
+            Last column to read, from A. example: L
+
+        creds : Credentials
+            Credentials of google api
+
+        cache_path : str
+            JSON file keeping the rows between runs, None to always download them
+
+        Returns
+        -------
+        RosterSnapshot
+            The rows of this run, None if the tab could not be read
+        """
+        version = None
+        if cache_path is not None:
+            version = get_drive_version(spreadsheet_id, creds)
+            cached = cls._read_cache(cache_path, spreadsheet_id, tab, version)
+            if cached is not None:
+                print("Tracking sheet unchanged, using " + cache_path)
+                return cached
+
+        try:
+            ranges = OAuth_function.batch_get_values(spreadsheet_id, ["'{0}'!A1:{1}".format(tab, lastColumn)], creds)
+        except HttpError as err:
+            print(err)
+            return None
+        if not ranges:
+            return None
+        snapshot = cls(spreadsheet_id, tab, ranges[0], version)
+        if cache_path is not None and version is not None:
+            snapshot.save(cache_path)
+        return snapshot
+
+    @classmethod
+    def _read_cache(cls, cache_path: 'str', spreadsheet_id: 'str', tab: 'str', version: 'str') -> 'RosterSnapshot':
+        if version is None or not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path) as cache:
+                saved = json.load(cache)
+        except (OSError, ValueError):
+            return None
+        if (saved.get('spreadsheetId'), saved.get('tab'), saved.get('version')) != (spreadsheet_id, tab, version):
+            return None
+        # a cache edited or cut short is not trusted
+        if content_hash(saved.get('rows')) != saved.get('hash'):
+            return None
+        return cls(spreadsheet_id, tab, saved['rows'], version)
+
+    def save(self, cache_path: 'str'):
+        """Write the rows, their hash and the Drive version to cache_path, replacing it atomically."""
+        temporary = cache_path + '.tmp'
+        with open(temporary, 'w') as cache:
+            json.dump({'spreadsheetId': self.spreadsheet_id, 'tab': self.tab, 'version': self.version,
+                       'hash': content_hash(self.rows), 'rows': self.rows}, cache)
+        os.replace(temporary, cache_path)
+
+    def save_current(self, cache_path: 'str', creds: 'Credentials'):
+        """
+        Save the rows at the version Drive has now, after this run wrote its changes to them
+
+        A change someone else makes between the writes and this call would
+        be missed until the next change of the sheet, the run keeps that
+        window to the single request asking for the version.
+        """
+        self.version = get_drive_version(self.spreadsheet_id, creds)
+        if self.version is not None:
+            self.save(cache_path)
+
+    def get_cell(self, row: 'int', column: 'int') -> 'str':
+        """Return the value of a cell, row from 1 and column from 0, '' when empty."""
+        if row > len(self.rows) or column >= len(self.rows[row - 1]):
+            return ''
+        return self.rows[row - 1][column]
+
+    def set_cell(self, row: 'int', column: 'int', value: 'str'):
+        """Apply a value written to the sheet, row from 1 and column from 0."""
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        cells.extend([''] * (column + 1 - len(cells)))
+        cells[column] = value
+
+    def columns(self, firstColumn: 'int', lastColumn: 'int') -> 'list[list[str]]':
+        """Return the rows cut to the columns firstColumn to lastColumn (from 0), from row 1."""
+        return [cells[firstColumn:lastColumn + 1] for cells in self.rows]
+
+    def volunteers(self, currentMonday: 'datetime.date') -> 'list[roster.Volunteer]':
+        """Return the active volunteers, see roster.build_roster."""
+        return roster.build_roster(self.columns(0, 6)[1:], currentMonday)
+
+    def update_changed(self, firstColumn: 'int', rows: 'dict[int, list[str]]', creds: 'Credentials') -> 'int':
+        """
+        Write the cells of rows that differ from the snapshot, in one request, and apply them
+
+        Parameters
+        ----------
+        firstColumn : int
+            0-based column of the first value of every row
+
+        rows : dict[int, list[str]]
+            Sheet row (1-based) to the values of its cells from firstColumn
+
+        creds : Credentials
+            Credentials of google api
+
+        Returns
+        -------
+        int
+            Number of cells written, None if they could not be
+        """
+        width = max((len(values) for values in rows.values()), default=0)
+        written = OAuth_function.update_changed_values(self.spreadsheet_id, self.tab, firstColumn, rows, creds,
+                                                       self.columns(firstColumn, firstColumn + width - 1))
+        if written is None:
+            # a batchUpdate is all or nothing, the snapshot still holds what the sheet does
+            return None
+        for row, values in rows.items():
+            for offset, value in enumerate(values):
+                self.set_cell(row, firstColumn + offset, str(value))
+        return written
@@ -0,0 +1,217 @@
+"""
+Local cache of the last verification of every weekly report sheet.
+
+The cache lives in a small SQLite file next to token.json, keyed by
+spreadsheet ID. Next to the last result (a report_validation.ValidationResult,
+stored as JSON) it keeps the Drive modifiedTime and
+version the sheet had and the week the result was computed for. One Drive
+listing of the weekly report folder then tells which sheets changed, and
+only those (or the ones whose verification crossed into a new week) are
+fetched and verified again.
+
+A watermark per sheet records how many weeks, from the start week, were
+found valid and are over. Verifying a changed sheet only fetches the rows
+after the watermark; the weeks before it carry their result forward.
+
+It also counts the reminders sent about every sheet, for the status columns
+written back to the tracking sheet.
+"""
+
+import sqlite3
+import threading
+
+import report_validation
+
+DB_PATH = 'verification_store.db'
+
+_connection = None
+# the connection may be shared by the verification threads, one statement at a time
+_lock = threading.RLock()
+
+
+def connect(path: 'str' = DB_PATH) -> 'sqlite3.Connection':
+    """
+    Open (and create if needed) the store, once per process
+
+    Parameters
+    ----------
+    path : str
+        Location of the SQLite file
+
+    Returns
+    -------
+    sqlite3.Connection
+        The shared connection
+    """
+    global _connection
+    if _connection is None:
+        _connection = sqlite3.connect(path, check_same_thread=False)
+        _connection.executescript("""
+            CREATE TABLE IF NOT EXISTS verified (
+                spreadsheet_id TEXT PRIMARY KEY,
+                modified_time TEXT,
+                version TEXT,
+                start_monday TEXT NOT NULL,
+                current_monday TEXT NOT NULL,
+                verified_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                detail TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS watermark (
+                spreadsheet_id TEXT PRIMARY KEY,
+                start_monday TEXT NOT NULL,
+                verified_weeks INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS reminder (
+                spreadsheet_id TEXT PRIMARY KEY,
+                sent INTEGER NOT NULL,
+                last_sent TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+        """)
+    return _connection
+
+
+def get_cached_result(spreadsheet_id: 'str', drive_file: 'dict', start_monday: 'str',
+                      current_monday: 'str') -> 'report_validation.ValidationResult':
+    """
+    Return the last result of a sheet if it is still valid
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The Google Sheet URL ID of the weekly report
+
+    drive_file : dict
+        The sheet as listed by Drive, with its modifiedTime and version
+
+    start_monday : str
+        Start Monday of the volunteer, as in the volunteer information
+
+    current_monday : str
+        The Monday the verification runs up to
+
+    Returns
+    -------
+    report_validation.ValidationResult
+        The cached result, None if the sheet changed, the week or the volunteer
+        information moved on, or it was never verified
+    """
+    if not drive_file:
+        return None
+    with _lock:
+        row = connect().execute('SELECT modified_time, version, start_monday, current_monday, detail '
+                                'FROM verified WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchone()
+    if row is None:
+        return None
+    if row[:4] != (drive_file.get('modifiedTime'), drive_file.get('version'), start_monday, current_monday):
+        return None
+    return report_validation.ValidationResult.from_json(row[4])
+
+
+def record_result(spreadsheet_id: 'str', drive_file: 'dict', start_monday: 'str', current_monday: 'str',
+                  result: 'report_validation.ValidationResult'):
+    """
+    Remember the result of a verification and the sheet version it was made on
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The Google Sheet URL ID of the weekly report
+
+    drive_file : dict
+        The sheet as listed by Drive, with its modifiedTime and version
+
+    start_monday : str
+        Start Monday of the volunteer, as in the volunteer information
+
+    current_monday : str
+        The Monday the verification ran up to
+
+    result : report_validation.ValidationResult
+        Result of the verification
+    """
+    drive_file = drive_file or {}
+    with _lock, connect() as conn:
+        conn.execute('INSERT OR REPLACE INTO verified '
+                     '(spreadsheet_id, modified_time, version, start_monday, current_monday, detail) '
+                     'VALUES (?, ?, ?, ?, ?, ?)',
+                     (spreadsheet_id, drive_file.get('modifiedTime'), drive_file.get('version'),
+                      start_monday, current_monday, result.to_json()))
+
+
+def get_watermark(spreadsheet_id: 'str', start_monday: 'str') -> 'int':
+    """
+    Return how many weeks of a sheet are already verified
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The Google Sheet URL ID of the weekly report
+
+    start_monday : str
+        Start Monday of the volunteer, as in the volunteer information
+
+    Returns
+    -------
+    int
+        Number of weeks from the start week found valid, 0 if the start Monday changed
+    """
+    with _lock:
+        row = connect().execute('SELECT start_monday, verified_weeks FROM watermark WHERE spreadsheet_id = ?',
+                                (spreadsheet_id,)).fetchone()
+    if row is None or row[0] != start_monday:
+        return 0
+    return row[1]
+
+
+def set_watermark(spreadsheet_id: 'str', start_monday: 'str', verified_weeks: 'int'):
+    """
+    Remember how many weeks of a sheet are verified
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The Google Sheet URL ID of the weekly report
+
+    start_monday : str
+        Start Monday of the volunteer, as in the volunteer information
+
+    verified_weeks : int
+        Number of weeks from the start week that are over and found valid
+    """
+    with _lock, connect() as conn:
+        conn.execute('INSERT OR REPLACE INTO watermark (spreadsheet_id, start_monday, verified_weeks) VALUES (?, ?, ?)',
+                     (spreadsheet_id, start_monday, max(0, verified_weeks)))
+
+
+def record_reminder(spreadsheet_id: 'str'):
+    """
+    Count one more reminder sent about a sheet
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The Google Sheet URL ID of the weekly report
+    """
+    with _lock, connect() as conn:
+        conn.execute('INSERT INTO reminder (spreadsheet_id, sent) VALUES (?, 1) '
+                     'ON CONFLICT (spreadsheet_id) DO UPDATE SET sent = sent + 1, last_sent = CURRENT_TIMESTAMP',
+                     (spreadsheet_id,))
+
+
+def get_reminders(spreadsheet_id: 'str') -> 'int':
+    """
+    Return how many reminders were sent about a sheet
+
+    Parameters
+    ----------
+    spreadsheet_id : str
+        The Google Sheet URL ID of the weekly report
+
+    Returns
+    -------
+    int
+        Number of reminders sent, over every run
+    """
+    with _lock:
+        row = connect().execute('SELECT sent FROM reminder WHERE spreadsheet_id = ?', (spreadsheet_id,)).fetchone()
+    return row[0] if row else 0
@@ -0,0 +1,80 @@
+"""
+Check that the modules shared by the two projects are still identical.
+
+AutoEmailReply and AutoScanWeeklyReport are deployed separately, so each
+keeps its own copy of the modules in SHARED_MODULES. A fix made to one copy
+has to be made to the other; this compares every pair byte for byte and
+prints a diff of the ones that drifted apart.
+
+Usage: python check_shared_modules.py [--sync PROJECT]
+
+--sync copies the modules of PROJECT over those of the other project, once
+the diff shows PROJECT holds the version to keep.
+"""
+
+import argparse
+import difflib
+import os
+import shutil
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PROJECTS = ('AutoEmailReply', 'AutoScanWeeklyReport')
+SHARED_MODULES = ('credentials_manager.py', 'google_clients.py', 'instrumentation.py', 'mail_transport.py',
+                  'rate_limiter.py')
+
+
+def read(project: 'str', module: 'str') -> 'bytes':
+    with open(os.path.join(ROOT, project, module), 'rb') as source:
+        return source.read()
+
+
+def drifted() -> 'list[str]':
+    """
+    Return the shared modules whose copies differ, printing their diff
+
+    Returns
+    -------
+    list[str]
+        File names of the modules that are not identical in every project
+    """
+    modules = []
+    for module in SHARED_MODULES:
+        first, second = (read(project, module) for project in PROJECTS)
+        if first == second:
+            continue
+        modules.append(module)
+        sys.stdout.writelines(difflib.unified_diff(
+            first.decode('utf-8', errors='replace').splitlines(True),
+            second.decode('utf-8', errors='replace').splitlines(True),
+            '/'.join((PROJECTS[0], module)), '/'.join((PROJECTS[1], module))))
+    return modules
+
+
+def sync(source: 'str'):
+    """Copy the shared modules of project source over those of the other project."""
+    for target in PROJECTS:
+        if target == source:
+            continue
+        for module in SHARED_MODULES:
+            shutil.copyfile(os.path.join(ROOT, source, module), os.path.join(ROOT, target, module))
+            print("Copied {0}/{1} to {2}".format(source, module, target))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that the modules shared by the projects are identical")
+    parser.add_argument('--sync', choices=PROJECTS, metavar='PROJECT',
+                        help="copy the shared modules of PROJECT over the other project's")
+    args = parser.parse_args()
+
+    if args.sync:
+        sync(args.sync)
+    modules = drifted()
+    if modules:
+        print("Shared modules differ between {0}: {1}".format(' and '.join(PROJECTS), ', '.join(modules)))
+        sys.exit(1)
+    print("{0} shared modules identical.".format(len(SHARED_MODULES)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Local stand-in for the Google Sheets v4 and Drive v3 REST apis, used by the
+load tests.
+
+Serves the calls the projects make through googleapiclient once
+google_clients.API_ENDPOINTS point here: spreadsheets.get,
+spreadsheets.values get / update / batchGet / batchUpdate (A1 ranges, tab
+names, ROWS and COLUMNS major dimension), files.list of a folder with
+paging and files.get of a spreadsheet. Field masks are not applied. Every request can be delayed to
+simulate the network round trip, and the requests served are counted per
+operation.
+"""
+
+import collections
+import datetime
+import http.server
+import json
+import re
+import socket
+import threading
+import time
+import urllib.parse
+
+_A1_RE = re.compile(r"^(?:(?:'((?:[^']|'')+)'|([^!]+))!)?([A-Z]*)(\d*)(?::([A-Z]*)(\d*))?$")
+_PARENT_RE = re.compile(r"'([^']+)' in parents")
+
+# a column range without rows goes down to the last row, like Sheets
+MAX_ROWS = 10 ** 7
+
+
+def _column_index(letters: 'str') -> 'int':
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+class Spreadsheet:
+    """
+    A spreadsheet with its tabs, the first tab is the default one
+
+    Parameters
+    ----------
+    title : str
+        Title of the spreadsheet, also its Drive file name
+
+    tabs : dict[str, list[list[str]]]
+        Tab name to its rows, starting at row 1
+    """
+
+    def __init__(self, title: 'str', tabs: 'dict[str, list[list[str]]]'):
+        self.title = title
+        self.tabs = dict(tabs)
+        self.version = 1
+        self.modified = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+        self.lock = threading.Lock()
+
+    def _grid(self, range_name: 'str') -> 'tuple[list[list[str]], int, int, int, int]':
+        match = _A1_RE.match(range_name)
+        if match is None:
+            raise ValueError('bad range ' + range_name)
+        quoted, plain, first_col, first_row, last_col, last_row = match.groups()
+        tab = quoted.replace("''", "'") if quoted else plain
+        grid = self.tabs[tab] if tab else next(iter(self.tabs.values()))
+        has_end = ':' in range_name
+        first_col = _column_index(first_col) if first_col else 0
+        first_row = int(first_row) - 1 if first_row else 0
+        last_col = _column_index(last_col) if last_col else (first_col if not has_end else 10 ** 4)
+        last_row = int(last_row) - 1 if last_row else (first_row if not has_end else MAX_ROWS)
+        return grid, first_row, last_row, first_col, last_col
+
+    def get(self, range_name: 'str', major_dimension: 'str' = 'ROWS') -> 'dict':
+        """Return the ValueRange of a range, trailing empty cells and rows left out."""
+        with self.lock:
+            grid, first_row, last_row, first_col, last_col = self._grid(range_name)
+            rows = [list(row[first_col:last_col + 1]) for row in grid[first_row:last_row + 1]]
+        if major_dimension == 'COLUMNS':
+            width = max((len(row) for row in rows), default=0)
+            rows = [[row[col] if col < len(row) else '' for row in rows] for col in range(width)]
+        for row in rows:
+            while row and row[-1] == '':
+                row.pop()
+        while rows and not rows[-1]:
+            rows.pop()
+        result = {'range': range_name, 'majorDimension': major_dimension}
+        if rows:
+            result['values'] = rows
+        return result
+
+    def update(self, range_name: 'str', values: 'list[list[str]]') -> 'int':
+        """Write rows of values from the top left cell of a range, return the number of cells."""
+        with self.lock:
+            grid, first_row, _, first_col, _ = self._grid(range_name)
+            cells = 0
+            for offset, row_values in enumerate(values):
+                while len(grid) <= first_row + offset:
+                    grid.append([])
+                row = grid[first_row + offset]
+                row.extend([''] * (first_col + len(row_values) - len(row)))
+                row[first_col:first_col + len(row_values)] = [str(value) for value in row_values]
+                cells += len(row_values)
+            self.touch()
+        return cells
+
+    def touch(self):
+        """Record a change, like an edit made in the Sheets UI."""
+        self.version += 1
+        self.modified = self.modified + datetime.timedelta(seconds=1)
+
+    def drive_file(self, spreadsheet_id: 'str') -> 'dict':
+        return {'id': spreadsheet_id, 'name': self.title, 'version': str(self.version),
+                'modifiedTime': self.modified.strftime('%Y-%m-%dT%H:%M:%S.000Z')}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """One keep-alive HTTP connection."""
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status: 'int', body: 'dict'):
+        data = json.dumps(body).encode()
+        self.server.bytes_sent += len(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self, method: 'str'):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urllib.parse.urlsplit(self.path)
+        path = urllib.parse.unquote(url.path)
+        query = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        try:
+            operation, result = self.server.serve_call(method, path, query, body)
+        except KeyError as err:
+            self.server.count('not found')
+            self.respond(404, {'error': {'code': 404, 'message': 'not found: {0}'.format(err)}})
+            return
+        except ValueError as err:
+            self.server.count('bad request')
+            self.respond(400, {'error': {'code': 400, 'message': str(err)}})
+            return
+        self.server.count(operation)
+        self.respond(200, result)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_PUT(self):
+        self.route('PUT')
+
+
+class Server(http.server.ThreadingHTTPServer):
+    """
+    Sheets and Drive over plain HTTP on 127.0.0.1, on a free port
+
+    Parameters
+    ----------
+    latency : float
+        Seconds every request is delayed by
+    """
+    daemon_threads = True
+
+    def __init__(self, latency: 'float' = 0.0):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.latency = latency
+        self.spreadsheets = {}
+        # folder id to the ids of the spreadsheets in it
+        self.folders = collections.defaultdict(list)
+        self.requests = collections.Counter()
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def endpoint(self) -> 'str':
+        return 'http://127.0.0.1:{0}/'.format(self.server_address[1])
+
+    def add_spreadsheet(self, spreadsheet_id: 'str', spreadsheet: 'Spreadsheet', folder_id: 'str' = None):
+        self.spreadsheets[spreadsheet_id] = spreadsheet
+        if folder_id is not None:
+            self.folders[folder_id].append(spreadsheet_id)
+
+    def count(self, operation: 'str'):
+        with self._lock:
+            self.requests[operation] += 1
+
+    def serve_call(self, method: 'str', path: 'str', query: 'dict', body: 'dict') -> 'tuple[str, dict]':
+        """Serve one api call, return (operation name, response body)."""
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['drive', 'v3'] and parts[2:] == ['files'] and method == 'GET':
+            return 'drive.files.list', self.list_files(query)
+        if parts[:2] == ['drive', 'v3'] and parts[2] == 'files' and len(parts) == 4 and method == 'GET':
+            return 'drive.files.get', self.spreadsheets[parts[3]].drive_file(parts[3])
+        if parts[:2] != ['v4', 'spreadsheets'] or len(parts) < 3:
+            raise KeyError(path)
+
+        spreadsheet_id = parts[2]
+        spreadsheet = self.spreadsheets[spreadsheet_id]
+        major_dimension = query.get('majorDimension', ['ROWS'])[0]
+        if len(parts) == 3:
+            if method == 'GET':
+                return 'spreadsheets.get', {'spreadsheetId': spreadsheet_id, 'properties': {'title': spreadsheet.title}}
+            raise KeyError(path)
+        if parts[3].startswith('values:') and len(parts) == 4:
+            action = parts[3].partition(':')[2]
+            if action == 'batchGet' and method == 'GET':
+                return 'values.batchGet', {'spreadsheetId': spreadsheet_id, 'valueRanges': [
+                    spreadsheet.get(range_name, major_dimension) for range_name in query.get('ranges', [])]}
+            if action == 'batchUpdate' and method == 'POST':
+                cells = sum(spreadsheet.update(data['range'], data['values']) for data in body.get('data', []))
+                return 'values.batchUpdate', {'spreadsheetId': spreadsheet_id, 'totalUpdatedCells': cells}
+        if parts[3] == 'values' and len(parts) == 5:
+            if method == 'GET':
+                return 'values.get', spreadsheet.get(parts[4], major_dimension)
+            if method == 'PUT':
+                cells = spreadsheet.update(parts[4], body.get('values', []))
+                return 'values.update', {'spreadsheetId': spreadsheet_id, 'updatedCells': cells}
+        raise KeyError(path)
+
+    def list_files(self, query: 'dict') -> 'dict':
+        parent = _PARENT_RE.search(query.get('q', [''])[0])
+        if parent is None:
+            raise ValueError('only listing a folder is supported')
+        ids = self.folders[parent.group(1)]
+        page_size = int(query.get('pageSize', ['100'])[0])
+        start = int(query.get('pageToken', ['0'])[0])
+        result = {'files': [self.spreadsheets[spreadsheet_id].drive_file(spreadsheet_id)
+                            for spreadsheet_id in ids[start:start + page_size]]}
+        if start + page_size < len(ids):
+            result['nextPageToken'] = str(start + page_size)
+        return result
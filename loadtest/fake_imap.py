@@ -0,0 +1,386 @@
+"""
+Local stand-in for the Gmail IMAP server, used by the load tests.
+
+Implements the part of IMAP4rev1 the auto reply relies on, over implicit
+TLS: LOGIN, SELECT/EXAMINE, UID SEARCH (UID sets, SUBJECT, OR, NOT, UNSEEN,
+SEEN, SINCE, ALL), UID FETCH of header fields and whole or partial body
+parts, UID STORE of flags, NOOP, CLOSE and LOGOUT. Every command can be delayed to simulate the
+network round trip, and the commands served are counted.
+"""
+
+import bisect
+import collections
+import datetime
+import email
+import email.utils
+import re
+import socket
+import socketserver
+import ssl
+import threading
+import time
+
+_FOLDING_RE = re.compile(rb'\r\n[ \t]+')
+_HEADER_FIELDS_RE = re.compile(r'HEADER\.FIELDS \((.*)\)')
+_PARTIAL_RE = re.compile(r'\]<(\d+)\.(\d+)>$')
+_UID_SET_RE = re.compile(r'^[\d*:,]+$')
+
+
+class Message:
+    """
+    One stored message, split once into the pieces FETCH returns
+
+    Parameters
+    ----------
+    uid : int
+        UID of the message in its mailbox
+
+    raw : bytes
+        The whole message
+
+    flags : set[str]
+        Initial flags. example: {'\\Seen'}
+    """
+
+    def __init__(self, uid: 'int', raw: 'bytes', flags: 'set[str]' = ()):
+        self.uid = uid
+        self.flags = set(flags)
+        raw = raw.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+        head, _, self.body = raw.partition(b'\r\n\r\n')
+        self.header = head + b'\r\n\r\n'
+        # (upper case field name, raw lines of the field)
+        self.fields = []
+        for line in head.split(b'\r\n'):
+            if line[:1] in (b' ', b'\t') and self.fields:
+                self.fields[-1][1].append(line)
+            else:
+                self.fields.append((line.split(b':', 1)[0].strip().upper().decode(), [line]))
+        headers = email.message_from_bytes(self.header)
+        self.subject = _FOLDING_RE.sub(b' ', self._field('SUBJECT')).decode(errors='replace').lower()
+        date = headers['Date']
+        self.date = email.utils.parsedate_to_datetime(date).date() if date else None
+        self.boundary = headers.get_boundary()
+        self._part = None
+
+    def _field(self, name: 'str') -> 'bytes':
+        for field, lines in self.fields:
+            if field == name:
+                return b'\r\n'.join(lines).split(b':', 1)[1].strip()
+        return b''
+
+    def _first_part(self) -> 'tuple[bytes, bytes]':
+        if self._part is None:
+            if self.boundary is None:
+                self._part = (self.header, self.body)
+            else:
+                parts = self.body.split(b'--' + self.boundary.encode())
+                part = parts[1][2:] if len(parts) > 1 else b''
+                head, _, body = part.partition(b'\r\n\r\n')
+                self._part = (head + b'\r\n\r\n', body[:-2] if body.endswith(b'\r\n') else body)
+        return self._part
+
+    def section(self, name: 'str') -> 'bytes':
+        """Return the content of a BODY[name] section."""
+        name = name.upper()
+        if name == '':
+            return self.header + self.body
+        if name == 'HEADER':
+            return self.header
+        if name == 'TEXT':
+            return self.body
+        if name == '1.MIME':
+            return self._first_part()[0]
+        if name == '1':
+            return self._first_part()[1]
+        fields = _HEADER_FIELDS_RE.match(name)
+        if fields:
+            wanted = set(fields.group(1).split())
+            lines = [line for field, field_lines in self.fields if field in wanted for line in field_lines]
+            return b'\r\n'.join(lines) + b'\r\n\r\n'
+        raise ValueError('unsupported section ' + name)
+
+
+class Mailbox:
+    """Messages of one mailbox, in UID order."""
+
+    def __init__(self, uidvalidity: 'int' = 1):
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages = []
+        self.uids = []
+
+    def select(self, spec: 'str') -> 'list[Message]':
+        """Return the messages of a UID set. example: 4,7:9,20:*"""
+        largest = self.uids[-1] if self.uids else 0
+        selected = {}
+        for part in spec.split(','):
+            first, _, last = part.partition(':')
+            first = largest if first == '*' else int(first)
+            last = first if not last else largest if last == '*' else int(last)
+            low, high = min(first, last), max(first, last)
+            start = bisect.bisect_left(self.uids, low)
+            stop = bisect.bisect_right(self.uids, high)
+            for message in self.messages[start:stop]:
+                selected[message.uid] = message
+        return [selected[uid] for uid in sorted(selected)]
+
+
+class Store:
+    """Every mailbox of the fake account, shared by all connections."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.mailboxes = {}
+
+    def mailbox(self, name: 'str') -> 'Mailbox':
+        name = name.strip('"')
+        if name.upper() == 'INBOX':
+            name = 'INBOX'
+        with self.lock:
+            return self.mailboxes.setdefault(name, Mailbox())
+
+    def append(self, name: 'str', raw: 'bytes', flags: 'set[str]' = ()):
+        """Deliver a message to a mailbox."""
+        with self.lock:
+            mailbox = self.mailbox(name)
+            message = Message(mailbox.uidnext, raw, flags)
+            mailbox.messages.append(message)
+            mailbox.uids.append(message.uid)
+            mailbox.uidnext += 1
+
+
+def _tokenize(text: 'str') -> 'list':
+    """Split a command into atoms, ('quoted', str) strings and parentheses."""
+    tokens = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == ' ':
+            i += 1
+        elif char in '()':
+            tokens.append(char)
+            i += 1
+        elif char == '"':
+            j = i + 1
+            value = []
+            while text[j] != '"':
+                if text[j] == '\\':
+                    j += 1
+                value.append(text[j])
+                j += 1
+            tokens.append(('quoted', ''.join(value)))
+            i = j + 1
+        else:
+            j = i
+            depth = 0
+            while j < len(text) and (text[j] not in ' ()' or depth):
+                depth += {'[': 1, ']': -1}.get(text[j], 0)
+                j += 1
+            tokens.append(text[i:j])
+            i = j
+    return tokens
+
+
+def _value(token) -> 'str':
+    return token[1] if isinstance(token, tuple) else token
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """One IMAP connection."""
+
+    def setup(self):
+        self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connection = self.request
+        super().setup()
+
+    def send(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.server.bytes_sent += len(data)
+        self.wfile.write(data)
+
+    def handle(self):
+        self.selected = None
+        self.send('* OK fake IMAP4rev1 ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            tag, _, rest = line.decode().rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            uid = command == 'UID'
+            if uid:
+                command, _, args = args.partition(' ')
+                command = command.upper()
+            self.server.commands[('UID ' if uid else '') + command] += 1
+            try:
+                if command == 'LOGOUT':
+                    self.send('* BYE logging out\r\n{0} OK LOGOUT completed\r\n'.format(tag))
+                    return
+                handler = getattr(self, 'do_' + command, None)
+                if handler is None:
+                    self.send('{0} BAD unknown command\r\n'.format(tag))
+                    continue
+                handler(args, uid)
+                self.send('{0} OK {1} completed\r\n'.format(tag, command))
+            except Exception as err:
+                self.send('{0} BAD {1}\r\n'.format(tag, err))
+
+    def do_CAPABILITY(self, args, uid):
+        self.send('* CAPABILITY IMAP4rev1 IDLE\r\n')
+
+    def do_LOGIN(self, args, uid):
+        pass
+
+    def do_NOOP(self, args, uid):
+        pass
+
+    def do_SELECT(self, args, uid):
+        store = self.server.store
+        with store.lock:
+            self.selected = store.mailbox(args)
+            self.send('* {0} EXISTS\r\n* 0 RECENT\r\n* OK [UIDVALIDITY {1}]\r\n* OK [UIDNEXT {2}]\r\n'.format(
+                len(self.selected.messages), self.selected.uidvalidity, self.selected.uidnext))
+
+    do_EXAMINE = do_SELECT
+
+    def do_CLOSE(self, args, uid):
+        self.selected = None
+
+    def _criteria(self, tokens: 'list', pos: 'int'):
+        """Parse one search key at pos into a predicate over (sequence number, message)."""
+        token = tokens[pos]
+        if token == '(':
+            keys = []
+            pos += 1
+            while tokens[pos] != ')':
+                key, pos = self._criteria(tokens, pos)
+                keys.append(key)
+            return (lambda seq, msg: all(key(seq, msg) for key in keys)), pos + 1
+        name = _value(token).upper()
+        if name == 'ALL':
+            return (lambda seq, msg: True), pos + 1
+        if name == 'OR':
+            first, pos = self._criteria(tokens, pos + 1)
+            second, pos = self._criteria(tokens, pos)
+            return (lambda seq, msg: first(seq, msg) or second(seq, msg)), pos
+        if name == 'NOT':
+            key, pos = self._criteria(tokens, pos + 1)
+            return (lambda seq, msg: not key(seq, msg)), pos
+        if name == 'UNSEEN':
+            return (lambda seq, msg: '\\Seen' not in msg.flags), pos + 1
+        if name == 'SEEN':
+            return (lambda seq, msg: '\\Seen' in msg.flags), pos + 1
+        if name == 'SUBJECT':
+            text = _value(tokens[pos + 1]).lower()
+            return (lambda seq, msg: text in msg.subject), pos + 2
+        if name == 'SINCE':
+            since = datetime.datetime.strptime(_value(tokens[pos + 1]), '%d-%b-%Y').date()
+            return (lambda seq, msg: msg.date is None or msg.date >= since), pos + 2
+        if name == 'UID':
+            uids = {msg.uid for msg in self.selected.select(_value(tokens[pos + 1]))}
+            return (lambda seq, msg: msg.uid in uids), pos + 2
+        raise ValueError('unsupported search key ' + name)
+
+    def do_SEARCH(self, args, uid):
+        tokens = _tokenize(args)
+        if tokens and _value(tokens[0]).upper() == 'CHARSET':
+            tokens = tokens[2:]
+        keys = []
+        pos = 0
+        while pos < len(tokens):
+            key, pos = self._criteria(tokens, pos)
+            keys.append(key)
+        with self.server.store.lock:
+            found = [msg.uid if uid else seq for seq, msg in enumerate(self.selected.messages, 1)
+                     if all(key(seq, msg) for key in keys)]
+        self.send('* SEARCH' + ''.join(' ' + str(number) for number in found) + '\r\n')
+
+    def _targets(self, spec: 'str', uid: 'bool') -> 'list[tuple[int, Message]]':
+        messages = self.selected.messages
+        if uid:
+            selected = self.selected.select(spec)
+            positions = {msg.uid: seq for seq, msg in enumerate(messages, 1)} if selected else {}
+            return [(positions[msg.uid], msg) for msg in selected]
+        if not _UID_SET_RE.match(spec):
+            raise ValueError('bad message set ' + spec)
+        wanted = set()
+        for part in spec.split(','):
+            first, _, last = part.partition(':')
+            first = len(messages) if first == '*' else int(first)
+            last = first if not last else len(messages) if last == '*' else int(last)
+            wanted.update(range(min(first, last), max(first, last) + 1))
+        return [(seq, messages[seq - 1]) for seq in sorted(wanted) if 0 < seq <= len(messages)]
+
+    def do_FETCH(self, args, uid):
+        spec, _, items = args.partition(' ')
+        items = [token for token in _tokenize(items) if token not in ('(', ')')]
+        with self.server.store.lock:
+            for seq, msg in self._targets(spec, uid):
+                out = [b'UID %d' % msg.uid] if uid else []
+                for item in items:
+                    name = _value(item).upper()
+                    if name == 'UID':
+                        if not uid:
+                            out.append(b'UID %d' % msg.uid)
+                    elif name == 'FLAGS':
+                        out.append(('FLAGS (' + ' '.join(sorted(msg.flags)) + ')').encode())
+                    elif name.startswith('BODY'):
+                        section = item[item.index('[') + 1:item.rindex(']')]
+                        data = msg.section(section)
+                        label = 'BODY[' + section.upper() + ']'
+                        partial = _PARTIAL_RE.search(item)
+                        if partial:
+                            start = int(partial.group(1))
+                            data = data[start:start + int(partial.group(2))]
+                            label += '<{0}>'.format(start)
+                        out.append((label + ' {' + str(len(data)) + '}\r\n').encode() + data)
+                        if not name.startswith('BODY.PEEK'):
+                            msg.flags.add('\\Seen')
+                    else:
+                        raise ValueError('unsupported fetch item ' + name)
+                self.send(b'* %d FETCH (' % seq + b' '.join(out) + b')\r\n')
+
+    def do_STORE(self, args, uid):
+        spec, operation, flags = args.split(' ', 2)
+        flags = set(flags.strip('()').split())
+        with self.server.store.lock:
+            for seq, msg in self._targets(spec, uid):
+                if operation.startswith('+'):
+                    msg.flags |= flags
+                elif operation.startswith('-'):
+                    msg.flags -= flags
+                else:
+                    msg.flags = set(flags)
+
+
+class Server(socketserver.ThreadingTCPServer):
+    """
+    IMAP over TLS on 127.0.0.1, on a free port
+
+    Parameters
+    ----------
+    store : Store
+        The mailboxes served
+
+    certfile : str
+        PEM file with the certificate and its private key
+
+    latency : float
+        Seconds every command is delayed by
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, store: 'Store', certfile: 'str', latency: 'float' = 0.0):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.store = store
+        self.latency = latency
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(certfile)
+        self.commands = collections.Counter()
+        self.bytes_sent = 0
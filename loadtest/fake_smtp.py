@@ -0,0 +1,109 @@
+"""
+Local stand-in for the Gmail SMTP submission server, used by the load tests.
+
+Speaks enough ESMTP for smtplib: EHLO, STARTTLS, AUTH, MAIL, RCPT, DATA,
+RSET, NOOP and QUIT. Accepted messages are counted and handed to a callback
+(the load test files them in the fake Sent Mail folder, like Gmail does).
+"""
+
+import socket
+import socketserver
+import ssl
+import time
+
+
+class Handler(socketserver.StreamRequestHandler):
+    """One SMTP connection."""
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super().setup()
+
+    def reply(self, line: 'str'):
+        self.wfile.write(line.encode() + b'\r\n')
+        self.wfile.flush()
+
+    def start_tls(self):
+        self.rfile.close()
+        self.wfile.close()
+        self.request = self.connection = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+        self.rfile = self.connection.makefile('rb')
+        self.wfile = self.connection.makefile('wb')
+        self.server.count('handshakes')
+
+    def handle(self):
+        server = self.server
+        server.count('connections')
+        recipients = []
+        self.reply('220 fake ESMTP ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if server.latency:
+                time.sleep(server.latency)
+            command = line.decode().strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250-fake\r\n250-STARTTLS\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME')
+            elif verb == 'STARTTLS':
+                self.reply('220 ready to start TLS')
+                self.start_tls()
+            elif verb == 'AUTH':
+                server.count('logins')
+                self.reply('235 accepted')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 ok')
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[1].strip().strip('<>'))
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 go ahead')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b'.\r\n', b'.\n', b''):
+                        break
+                    lines.append(line[1:] if line.startswith(b'..') else line)
+                server.count('messages')
+                if server.on_message is not None:
+                    server.on_message(recipients, b''.join(lines))
+                self.reply('250 queued')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 ok')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('502 not implemented')
+
+
+class Server(socketserver.ThreadingTCPServer):
+    """
+    SMTP with STARTTLS on 127.0.0.1, on a free port
+
+    Parameters
+    ----------
+    certfile : str
+        PEM file with the certificate and its private key
+
+    latency : float
+        Seconds every command is delayed by
+
+    on_message : callable
+        Called with (recipients, message bytes) for every accepted message
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, certfile: 'str', latency: 'float' = 0.0, on_message=None):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.latency = latency
+        self.on_message = on_message
+        self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.ssl_context.load_cert_chain(certfile)
+        self.counters = dict.fromkeys(('connections', 'handshakes', 'logins', 'messages'), 0)
+
+    def count(self, name: 'str'):
+        self.counters[name] += 1
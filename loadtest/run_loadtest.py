@@ -0,0 +1,239 @@
+"""
+Offline load test of the daily auto reply and the weekly report scan.
+
+Starts local stand-ins for the Gmail IMAP and SMTP servers and for the
+Sheets/Drive apis, loads them with a synthetic inbox and roster, and runs
+the real entry points against them: AutoEmailReply/daily.py main() and
+AutoScanWeeklyReport/OAuth_main.py main(). Each run happens in its own
+process (the two projects have modules of the same name) with the server
+addresses patched into daily, mail_transport and google_clients. Both are
+run twice, the second time with nothing new to do.
+
+Reported per run: wall time, messages or volunteers per second, IMAP
+commands, SMTP connections and messages, Google api requests per operation
+and the peak memory (max RSS) of the run.
+
+Usage: python run_loadtest.py [--emails 10000] [--volunteers 2000]
+                              [--imap-latency MS] [--smtp-latency MS] [--google-latency MS]
+
+Needs the openssl command line tool for a throwaway TLS certificate.
+"""
+
+import argparse
+import ast
+import collections
+import contextlib
+import datetime
+import importlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import fake_google
+import fake_imap
+import fake_smtp
+import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+AUTO_EMAIL_REPLY = os.path.join(ROOT, 'AutoEmailReply')
+AUTO_SCAN_WEEKLY_REPORT = os.path.join(ROOT, 'AutoScanWeeklyReport')
+
+# scenario -> (project directory, entry point module)
+SCENARIOS = {
+    'daily': (AUTO_EMAIL_REPLY, 'daily'),
+    'weekly': (AUTO_SCAN_WEEKLY_REPORT, 'OAuth_main'),
+}
+SENT_MAILBOX = '[Gmail]/Sent Mail'
+
+
+def read_constant(path: 'str', name: 'str'):
+    """Read a module level constant of a project file without importing it."""
+    with open(path) as source:
+        for node in ast.parse(source.read()).body:
+            if isinstance(node, ast.Assign) and any(getattr(target, 'id', None) == name for target in node.targets):
+                return ast.literal_eval(node.value)
+    raise KeyError(name)
+
+
+def make_certificate(directory: 'str') -> 'str':
+    """Create a self-signed certificate for the fake IMAP and SMTP servers."""
+    key = os.path.join(directory, 'key.pem')
+    cert = os.path.join(directory, 'cert.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    pem = os.path.join(directory, 'server.pem')
+    with open(pem, 'wb') as out:
+        for part in (cert, key):
+            with open(part, 'rb') as data:
+                out.write(data.read())
+    return pem
+
+
+def write_token(directory: 'str'):
+    """Write a token.json the projects accept as valid without refreshing it."""
+    token = {'token': 'load-test', 'refresh_token': 'load-test', 'client_id': 'load-test',
+             'client_secret': 'load-test', 'token_uri': 'https://oauth2.googleapis.com/token',
+             'scopes': ['https://www.googleapis.com/auth/spreadsheets',
+                        'https://www.googleapis.com/auth/drive.metadata.readonly'],
+             'expiry': '2099-01-01T00:00:00Z'}
+    with open(os.path.join(directory, 'token.json'), 'w') as out:
+        json.dump(token, out)
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def build_servers(args, certfile: 'str') -> 'tuple':
+    """Start the three fake servers and load them with synthetic data."""
+    store = fake_imap.Store()
+    imap = start(fake_imap.Server(store, certfile, args.imap_latency / 1000))
+    # Gmail files what we send in Sent Mail, the auto reply reads it back
+    smtp = start(fake_smtp.Server(certfile, args.smtp_latency / 1000,
+                                  on_message=lambda recipients, data: store.append(SENT_MAILBOX, data, {'\\Seen'})))
+    google = start(fake_google.Server(args.google_latency / 1000))
+
+    emails, responses = synthetic.notifications(args.emails, args.seed)
+    for raw in emails:
+        store.append('INBOX', raw)
+    store.mailbox(SENT_MAILBOX)
+
+    tracking, reports = synthetic.roster(args.volunteers, datetime.date.today(), args.seed)
+    # the form responses and the OPT tracking are two tabs of one spreadsheet
+    tracking_id = read_constant(os.path.join(AUTO_SCAN_WEEKLY_REPORT, 'OAuth_main.py'), 'SPREADSHEET_ID')
+    form_id = read_constant(os.path.join(AUTO_EMAIL_REPLY, 'google_form_reply.py'), 'SPREADSHEET_ID')
+    folder_id = read_constant(os.path.join(AUTO_SCAN_WEEKLY_REPORT, 'OAuth_function.py'), 'WEEKLY_REPORT_FOLDER_ID')
+    tabs = {'Form Responses 1': responses, 'OPT subscription tracking': tracking}
+    if form_id == tracking_id:
+        google.add_spreadsheet(tracking_id, fake_google.Spreadsheet('Volunteers', tabs))
+    else:
+        google.add_spreadsheet(form_id, fake_google.Spreadsheet('Form Responses', {'Form Responses 1': responses}))
+        google.add_spreadsheet(tracking_id, fake_google.Spreadsheet('OPT tracking', {'OPT subscription tracking': tracking}))
+    for sheet_id, (title, rows) in reports.items():
+        google.add_spreadsheet(sheet_id, fake_google.Spreadsheet(title, {'Weekly Report': rows}), folder_id)
+    return imap, smtp, google
+
+
+def counters(imap, smtp, google) -> 'collections.Counter':
+    snapshot = collections.Counter()
+    for command, count in imap.commands.items():
+        snapshot['imap ' + command] = count
+    snapshot['imap bytes'] = imap.bytes_sent
+    for name, count in smtp.counters.items():
+        snapshot['smtp ' + name] = count
+    for operation, count in google.requests.items():
+        snapshot['google ' + operation] = count
+    snapshot['google bytes'] = google.bytes_sent
+    return snapshot
+
+
+def run_scenario(scenario: 'str', endpoints: 'dict', workdir: 'str', workers: 'int') -> 'dict':
+    """Run one entry point in a child process, return its timing and memory."""
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', scenario,
+                             '--endpoints', json.dumps(endpoints), '--workers', str(workers)],
+                            cwd=workdir, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise RuntimeError('{0} run failed'.format(scenario))
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def report(label: 'str', units: 'str', count: 'int', stats: 'dict', calls: 'collections.Counter'):
+    print('{0}: {1:.2f} s, {2:.0f} {3}/s, peak memory {4:.0f} MB'.format(
+        label, stats['seconds'], count / stats['seconds'] if count else 0, units, stats['peak_rss_mb']))
+    for name in ('imap', 'smtp', 'google'):
+        items = sorted((key[len(name) + 1:], value) for key, value in calls.items()
+                       if key.startswith(name + ' ') and value)
+        if items:
+            total = sum(value for key, value in items if key != 'bytes' and key not in
+                        ('connections', 'handshakes', 'logins'))
+            print('    {0:<6} {1:>7} | {2}'.format(name, total, ', '.join('{0} {1}'.format(*item) for item in items)))
+
+
+def peak_memory() -> 'float':
+    """
+    Return the peak resident memory of this process in MB
+
+    ru_maxrss also counts the pages of the parent process this one was forked
+    from, so the high water mark of /proc is preferred where there is one.
+    """
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def child_main(scenario: 'str', endpoints: 'dict', workers: 'int'):
+    """Run a real entry point against the fake servers and print its stats as JSON."""
+    project, module = SCENARIOS[scenario]
+    sys.path.insert(0, project)
+    import google_clients
+    import mail_transport
+    import rate_limiter
+    google_clients.API_ENDPOINTS = {'sheets': endpoints['google'], 'drive': endpoints['google'] + 'drive/v3/'}
+    # the fake servers have no quota, measure the code rather than the Google limits
+    rate_limiter.QUOTAS = {}
+    mail_transport.SMTP_SERVER, mail_transport.SMTP_PORT = '127.0.0.1', endpoints['smtp']
+    entry = importlib.import_module(module)
+
+    # the entry points print every message and sheet, keep that out of the report
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        started = time.perf_counter()
+        if scenario == 'daily':
+            entry.IMAP_SERVER, entry.IMAP_PORT = '127.0.0.1', endpoints['imap']
+            entry.main()
+        else:
+            entry.main(workers)
+        mail_transport.close_all()
+        seconds = time.perf_counter() - started
+    print(json.dumps({'seconds': seconds, 'peak_rss_mb': peak_memory()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the auto reply and weekly report scan against local fake servers")
+    parser.add_argument('--emails', type=int, default=10000, help="notification emails in the inbox")
+    parser.add_argument('--volunteers', type=int, default=2000, help="volunteers in the OPT tracking sheet")
+    parser.add_argument('--imap-latency', type=float, default=0, help="milliseconds added to every IMAP command")
+    parser.add_argument('--smtp-latency', type=float, default=0, help="milliseconds added to every SMTP command")
+    parser.add_argument('--google-latency', type=float, default=0, help="milliseconds added to every api request")
+    parser.add_argument('--workers', type=int, default=8, help="weekly report sheets verified at the same time")
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS) + ['all'], default='all')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--child', choices=sorted(SCENARIOS), help=argparse.SUPPRESS)
+    parser.add_argument('--endpoints', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child_main(args.child, json.loads(args.endpoints), args.workers)
+        return
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print("Generating {0} emails and {1} volunteers...".format(args.emails, args.volunteers))
+        imap, smtp, google = build_servers(args, make_certificate(workdir))
+        write_token(workdir)
+        endpoints = {'imap': imap.server_address[1], 'smtp': smtp.server_address[1], 'google': google.endpoint}
+
+        scenarios = sorted(SCENARIOS) if args.scenario == 'all' else [args.scenario]
+        for scenario in scenarios:
+            units, count = ('messages', args.emails) if scenario == 'daily' else ('volunteers', args.volunteers)
+            for label in (scenario, scenario + ' (nothing new)'):
+                before = counters(imap, smtp, google)
+                stats = run_scenario(scenario, endpoints, workdir, args.workers)
+                report(label, units, count, stats, counters(imap, smtp, google) - before)
+                # the second run has no new work, report its cost rather than a rate
+                count = 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""
+Synthetic inboxes and rosters for the load tests.
+
+Everything is generated from a seed, so two runs with the same arguments
+load the fake servers with the same data.
+"""
+
+import datetime
+import email.utils
+import random
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+import dateutil.relativedelta as dateDelta
+
+VOLUNTEER_MATCH_SUBJECT = 'Someone wants to help: Volunteer with us and maintain your OPT status!'
+GOOGLE_FORM_SUBJECT = 'Your form, Zenativity Volunteer Application Form, has new responses.'
+OPT_OPTION = 'OPT (Optional Practical Training) Maintenance'
+
+# share of notifications from someone who already wrote in, of OPT applicants,
+# of volunteer match notifications with an attachment
+REPEAT_RATE = 0.05
+OPT_RATE = 0.8
+ATTACHMENT_RATE = 0.1
+
+# share of tracking rows without a sheet id, of weeks left empty, of records copied
+MISSING_SHEET_RATE = 0.1
+MISSING_WEEK_RATE = 0.03
+COPY_RATE = 0.02
+
+FIRST_REPORT_ROW = 8
+
+FILLER = ('VolunteerMatch connects good people with good causes. '
+          'Please respond to this volunteer within 48 hours. ') * 20
+
+
+def _volunteer_match(i: 'int', rng: 'random.Random') -> 'bytes':
+    plain = '{0}\nName: Volunteer{1} Person\nEmail: volunteer{1}@example.com\nPhone: 555-0100\n{0}'.format(FILLER, i)
+    rich = ('<html><body><p>{0}</p><table><tr><td>Name:</td><td><b>Volunteer{1} Person</b></td></tr>'
+            '<tr><td>Email:</td><td>volunteer{1}@example.com</td></tr></table></body></html>').format(FILLER, i)
+    alternative = MIMEMultipart('alternative')
+    alternative.attach(MIMEText(plain, 'plain'))
+    alternative.attach(MIMEText(rich, 'html'))
+    if rng.random() < ATTACHMENT_RATE:
+        msg = MIMEMultipart('mixed')
+        msg.attach(alternative)
+        msg.attach(MIMEApplication(rng.randbytes(200 * 1024), Name='resume.pdf'))
+    else:
+        msg = alternative
+    msg['Subject'] = VOLUNTEER_MATCH_SUBJECT
+    msg['From'] = 'noreply@volunteermatch.org'
+    msg['Date'] = email.utils.formatdate(localtime=True)
+    return msg.as_bytes()
+
+
+def _google_form(i: 'int') -> 'bytes':
+    msg = MIMEText('Zenativity Volunteer Application Form has a new response.\n'
+                   'View Response: applicant{0}@example.com\n'.format(i), 'plain')
+    msg['Subject'] = GOOGLE_FORM_SUBJECT
+    msg['From'] = 'forms-receipts-noreply@google.com'
+    msg['Date'] = email.utils.formatdate(localtime=True)
+    return msg.as_bytes()
+
+
+def notifications(count: 'int', seed: 'int' = 0) -> 'tuple[list[bytes], list[list[str]]]':
+    """
+    Generate the notification emails of an inbox and the matching form responses
+
+    Parameters
+    ----------
+    count : int
+        Number of notifications, half of them from volunteer match
+
+    seed : int
+        Seed of the generator
+
+    Returns
+    -------
+    tuple[list[bytes], list[list[str]]]
+        The raw emails, and the rows of the form responses tab
+        (name in B, selected programs in L, email in N)
+    """
+    rng = random.Random(seed)
+    emails = []
+    responses = [[''] * 14]
+    responses[0][1], responses[0][11], responses[0][13] = 'Name', 'Programs', 'Email'
+    for i in range(count):
+        # someone who already wrote in writes again
+        sender = rng.randrange(i) if i > 1 and rng.random() < REPEAT_RATE else i
+        if i % 2 == 0:
+            emails.append(_volunteer_match(sender, rng))
+        else:
+            emails.append(_google_form(sender))
+            row = [''] * 14
+            row[1] = 'Applicant{0} Person'.format(sender)
+            row[11] = OPT_OPTION + ',Other' if rng.random() < OPT_RATE else 'Other'
+            row[13] = 'applicant{0}@example.com'.format(sender)
+            responses.append(row)
+    return emails, responses
+
+
+def _sentence(rng: 'random.Random', words: 'list[str]') -> 'str':
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(8, 16)))
+
+
+def roster(volunteers: 'int', today: 'datetime.date', seed: 'int' = 0) -> 'tuple[list[list[str]], dict]':
+    """
+    Generate the OPT tracking tab and the weekly report sheet of every volunteer
+
+    Parameters
+    ----------
+    volunteers : int
+        Number of volunteers
+
+    today : datetime.date
+        Date the reports are filled up to
+
+    seed : int
+        Seed of the generator
+
+    Returns
+    -------
+    tuple[list[list[str]], dict]
+        The rows of the tracking tab (with a header row), and
+        sheet id to (sheet title, rows of the sheet) for every volunteer
+    """
+    rng = random.Random(seed)
+    words = ['{0}{1}'.format(rng.choice('bcdfghjklmnpstvz'), rng.randrange(10 ** 6)) for _ in range(5000)]
+    tracking = [['Key', 'Renewed', '', 'End Date', 'Name', 'Email', 'Sheet ID']]
+    reports = {}
+    history = []
+    for i in range(volunteers):
+        name = 'Volunteer{0:05d}'.format(i)
+        sheet_id = 'sheet-{0:05d}'.format(i)
+        renewed = -1 if rng.random() < 0.05 else rng.randint(0, 3)
+        endDate = today + datetime.timedelta(days=rng.randint(1, 90))
+        startDate = endDate - dateDelta.relativedelta(months=(max(renewed, 0) + 1) * 3)
+        row = [startDate.strftime('%m-%d-%Y-') + name,
+               str(renewed),
+               '',
+               '{0}/{1}/{2}'.format(endDate.month, endDate.day, endDate.year),
+               name,
+               '{0}@example.com'.format(name.lower())]
+        if rng.random() >= MISSING_SHEET_RATE:
+            row.append(sheet_id)
+        tracking.append(row)
+
+        rows = [['', '', name + ' weekly report']] + [[] for _ in range(FIRST_REPORT_ROW - 2)]
+        for week in range((today - startDate).days // 7 + 2):
+            if rng.random() < MISSING_WEEK_RATE:
+                rows.append([])
+                continue
+            if history and rng.random() < COPY_RATE:
+                record = list(rng.choice(history))
+            else:
+                record = [_sentence(rng, words) for _ in range(3)]
+                history.append(record)
+            rows.append(['', '', str(week + 1)] + record)
+        reports[sheet_id] = (name + '-Weekly Report', rows)
+    return tracking, reports